@@ -8,8 +8,11 @@ import langdetect
 import ast
 from openai import OpenAI
 
-from helpers import read_data
-from helpers import define_standard_info_mapper
+from helpers import read_archive
+from helpers import select_heatmap
+from helpers import search_reports
+from helpers import page_reports
+from helpers import REPORT_PAGE_SIZES
 from helpers import plot_ui
 from helpers import plot_heatmap
 from helpers import read_supabase_documents
@@ -18,288 +21,317 @@ from helpers import get_all_reports
 from helpers import query_single_report
 from helpers import define_popover_title
 from helpers import summarize_text_bygpt
+from helpers import answer_reports
+from helpers import prepare_query
+from helpers import MAX_QUERY_REPORTS
+from helpers import REPORT_PDF_URL
 from helpers import create_google_auth_credentials
 from helpers import get_most_similar_pages
 from helpers import read_supabase_pages
 from helpers import log_user_to_supabase
 from helpers import log_query_to_supabase
 from helpers import translate_prompt
+from helpers import tracer
+from helpers import debug_panel_enabled
+from helpers import plot_debug_panel
 
 
 
 # ------------------------------------ SETUP ----------------------------------
 st.set_page_config(layout="wide", page_title="CSRD Reports | SRN", page_icon="srn-icon.png")
 st.markdown("""<style> footer {visibility: hidden;} </style> """, unsafe_allow_html=True)
+app_span = tracer.start("app")
+try:
+    # Supabase
+    # supabase_url: str = st.secrets["SUPABASE_URL"]
+    # supabase_key: str = st.secrets["SUPABASE_KEY"]
+    # supabase: Client = create_client(supabase_url, supabase_key)
+
+    # log_user_to_supabase(supabase)
+
+    # OpenAI
+    openai_client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+
+    archive = read_archive()
+    filter_index = archive["filters"]
+    # hosted_docs = read_supabase_documents(supabase)
+    # pages = read_supabase_pages(supabase)
+
+    # The filterable reports; kept as the shared Arrow table, plot_ui only counts them
+    df = (
+        filter_index.table
+        # .to_pandas()
+        # .merge(hosted_docs, on=['company', 'isin'], how="outer", indicator="_mergeSupabase")
+        # .merge(pages, on=["document_id"], how="outer", indicator="_mergePages")
+        # .query('_mergePages != "right_only"')
+    )
 
-# Supabase
-# supabase_url: str = st.secrets["SUPABASE_URL"]
-# supabase_key: str = st.secrets["SUPABASE_KEY"]
-# supabase: Client = create_client(supabase_url, supabase_key)
 
-# log_user_to_supabase(supabase)
+    # ISINs of the reports selected in the table
+    if "selected_companies" not in st.session_state:
+        st.session_state.selected_companies = set()
+        st.session_state.selection_generation = 0
 
-# OpenAI
-openai_client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
 
-standard_info_mapper = define_standard_info_mapper()
+    # ------------------------------------ WELCOME ----------------------------------
+    left_main_col, right_main_col = st.columns((0.6, 0.4))
+    with left_main_col:
+        plot_ui("welcome-text", df=df)
 
-googlesheet = read_data()
-# hosted_docs = read_supabase_documents(supabase)
-# pages = read_supabase_pages(supabase)
+    with right_main_col:
+        # Custom CSS for Bubble Counter
+        plot_ui("bubble-counter", df=df)
 
-df = (
-    googlesheet
-    # .merge(hosted_docs, on=['company', 'isin'], how="outer", indicator="_mergeSupabase")
-    .dropna(subset=["company", "isin", "country", "sector", "industry"])
-    # .merge(pages, on=["document_id"], how="outer", indicator="_mergePages")
-    # .query('_mergePages != "right_only"')
-)
+    st.divider()
 
 
-if "selected_companies" not in st.session_state:
-    st.session_state.selected_companies = set()
+    # ------------------------------------ FILTERS ----------------------------------
+    st.markdown("### Filters")
 
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        country_options = ["All"] + filter_index.options["country"]
+        selected_countries = st.multiselect("Filter by country", options=country_options, default=["All"], key="tab1_country")
 
-# ------------------------------------ WELCOME ----------------------------------
-left_main_col, right_main_col = st.columns((0.6, 0.4))
-with left_main_col:
-    plot_ui("welcome-text", df=df)
+    with col2:
+        industry_options = ["All"] + filter_index.options["sector"]
+        selected_industries = st.multiselect("Filter by sector", options=industry_options, default=["All"], key="tab1_industry")
 
-with right_main_col:
-    # Custom CSS for Bubble Counter
-    plot_ui("bubble-counter", df=df)
+    with col3:
+        selected_companies = st.multiselect(
+            label="Filter by name",
+            options=[None] + filter_index.options["company"],
+            default=None,
+            key="tab1_selectbox"
+        )
 
-st.divider()
+    # Apply filtering logic: "All" leaves a filter open, no company selected keeps all rows.
+    # Rows come back already sorted by company name (case-insensitive).
+    filtered_rows = filter_index.filter(
+        countries=None if "All" in selected_countries else selected_countries,
+        sectors=None if "All" in selected_industries else selected_industries,
+        companies=selected_companies if len(selected_companies) != 0 else None,
+    )
 
 
-# ------------------------------------ FILTERS ----------------------------------
-st.markdown("### Filters")
+    def show_error(e: Exception) -> None:
+        st.error('This is an error. We are working on a fix. In the meantime, check out our Google Sheet!', icon="🚨")
+        print(e)
+        tracer.record_error(e)
 
-col1, col2, col3 = st.columns(3)
-with col1:
-    country_options = ["All"] + sorted(df["country"].unique())
-    selected_countries = st.multiselect("Filter by country", options=country_options, default=["All"], key="tab1_country")
 
-with col2:
-    industry_options = ["All"] + sorted(df["sector"].unique())
-    selected_industries = st.multiselect("Filter by sector", options=industry_options, default=["All"], key="tab1_industry")
+    # ------------------------------------ TABLE ----------------------------------
+    # Selecting reports (and searching them) only reruns this fragment; changing a filter reruns the page
+    @st.fragment
+    def report_table(archive, filtered_rows):
+        fragment_span = tracer.begin("table")
+        try:
+            # Search and paging work on row positions; only the visible page and columns are sent to the browser
+            filters = archive["filters"]
+            col_search, col_page_size, col_page = st.columns((0.6, 0.2, 0.2))
+            with col_search:
+                search = st.text_input("Search", placeholder="Search by company or ISIN", key="table_search", label_visibility="collapsed")
+            rows = search_reports(filters, filtered_rows, search)
+
+            with col_page_size:
+                page_size = st.selectbox("Reports per page", REPORT_PAGE_SIZES, key="table_page_size", label_visibility="collapsed", format_func=lambda x: f"{x} per page")
+            n_pages = max(1, -(-len(rows) // page_size))
+            if st.session_state.get("table_page", 1) > n_pages:
+                st.session_state.table_page = n_pages
+            with col_page:
+                page = st.number_input("Page", min_value=1, max_value=n_pages, step=1, key="table_page", label_visibility="collapsed")
+
+            page_df = page_reports(
+                archive,
+                rows[(page - 1) * page_size:page * page_size],
+                st.session_state.selected_companies,
+                ["company", "link", "country", "sector", "industry", "publication date", "pages PDF", "auditor"],
+            )
 
-# Apply filtering logic
-if "All" in selected_countries:
-    filtered_countries = df["country"].unique()
-else:
-    filtered_countries = selected_countries
+            # Selections are kept as ISINs, so they survive paging, searching and filtering
+            edited_df = st.data_editor(
+                page_df,
+                column_order=["selected", "company", "link", "country", "sector", "industry", "publication date", "pages PDF", "auditor"],
+                column_config={
+                    "selected": st.column_config.CheckboxColumn(label="", width="small"),
+                    "company": st.column_config.Column(width="medium", label="Company"),
+                    "link": st.column_config.LinkColumn(
+                        label="Download",
+                        width="small",
+                        display_text="Link"
+                    ),
+                    "country": st.column_config.Column(label="Country"),
+                    "sector": st.column_config.Column(width="medium", label="Sector"),
+                    "industry": st.column_config.Column(width="medium", label="Industry"),
+                    "publication date": st.column_config.DateColumn(
+                        format="DD.MM.YYYY", width="small", label="Published"
+                    ),
+                    "pages PDF": st.column_config.NumberColumn(
+                        help="Number of pages of the sustainability statement.",
+                        label="Pages"
+                    ),
+                    "auditor": st.column_config.TextColumn(label="Auditor"),
+                },
+                disabled=["company", "link", "country", "sector", "industry", "publication date", "pages PDF", "auditor"],
+                use_container_width=True,
+                hide_index=True,
+                key=f"table_{archive['version']}_{hash(tuple(page_df['isin']))}_{st.session_state.selection_generation}",
+            )
+            for isin, selected in zip(edited_df["isin"], edited_df["selected"]):
+                if selected:
+                    st.session_state.selected_companies.add(isin)
+                else:
+                    st.session_state.selected_companies.discard(isin)
+
+            query_companies = st.session_state.selected_companies
+            query_companies_df = filters.rows(filters.find_isins(query_companies))
+
+            col_caption, col_clear = st.columns((0.8, 0.2))
+            with col_caption:
+                st.caption(f"{len(rows)} report(s) · page {page} of {n_pages} · {len(query_companies)} selected")
+            with col_clear:
+                if query_companies and st.button("Clear selection", use_container_width=True):
+                    st.session_state.selected_companies = set()
+                    st.session_state.selection_generation += 1
+                    st.rerun(scope="fragment")
+
+            st.markdown("🚧 The AI-powered search engine is currently under construction. Follow us on LinkedIn and don't miss our upcoming rework!")
+
+            # # ----- SEARCH ENGINE -----
+            # with st.container():
+            #     st.markdown("### Search Engine")
+            #     st.caption(":gray[Reports marked with an asterisk (*) cannot yet be queried. We will upload them soon!]")
+
+            #     prompt = st.chat_input(define_popover_title(query_companies_df), disabled=len(query_companies) == 0 or len(query_companies) > MAX_QUERY_REPORTS)
+
+            #     if prompt:
+            #         query_documents = query_companies_df.to_dict("records")
+
+            #         # Page fetch, logging, embedding and translation all start now; each report joins what it needs
+            #         query = prepare_query(supabase, openai_client, prompt, [d['document_id'] for d in query_documents])
+
+            #         # Retrieve, answer and download all reports in parallel; render each one as soon as it is ready.
+            #         # A single report streams its answer live.
+            #         with st.spinner(f"Searching {len(query_documents)} report(s)", show_time=True):
+            #             for query_document, result, error in answer_reports(openai_client, query_documents, query):
+            #                 # Define stuff
+            #                 query_company_name = query_document['company']
+            #                 query_document_id = query_document['document_id']
+            #                 query_document_start_page_pdf = int(ast.literal_eval(query_document["pages"])[0])
+            #                 query_document_url = REPORT_PDF_URL.format(document_id=query_document_id)
+
+            #                 if error is not None:
+            #                     st.error(f"Could not find any relevant information in the PDF for {query_company_name}.")
+            #                     print(error)
+            #                     continue
+
+            #                 similar_pages = result["pages"]
+                                            
+            #                 if similar_pages == []:
+            #                     st.error(f"We have not processed the report of {query_company_name}.")
 
-if "All" in selected_industries:
-    filtered_industries = df["sector"].unique()
-else:
-    filtered_industries = selected_industries
+            #                 else:
+            #                     with st.expander(query_company_name, expanded=True):
+            #                         col_expander_response, col_expander_pdf = st.columns([0.35, 0.65])
 
-filtered_df = df[
-    df["country"].isin(filtered_countries) &
-    df["sector"].isin(filtered_industries)
-]
+            #                         # Left column: Prompt + OpenAI response (@To-Do: switch to Mistral)
+            #                         with col_expander_response:
+            #                             with st.chat_message("user"):
+            #                                 st.text(prompt)
 
-with col3:
-    selected_companies = st.multiselect(
-        label="Filter by name",
-        options=[None] + sorted(df["company"]),
-        default=None,
-        key="tab1_selectbox"
-    )
+            #                             with st.chat_message("assistant"):
+            #                                 gpt_response = st.write_stream(result["answer"])
+                                        
+            #                                 relevant_pages_first = int(similar_pages[0]["page"]) - query_document_start_page_pdf + 1
+            #                                 st.markdown(f"[Access the full report here]({query_document_url}) or jump directly [to the relevant pages]({query_document_url + f"#page={relevant_pages_first}"})")
+
+            #                         # Right column: Render relevant PDF pages
+            #                         with col_expander_pdf:
+            #                             if result["pages_to_render"]:
+            #                                 display_annotated_pdf(
+            #                                     query_document_url,
+            #                                     pages_to_render=result["pages_to_render"],
+            #                                     )
+            #                             else:
+            #                                 st.error("Failed to load PDF.")
+            
+            #     st.caption(
+            #         ":gray[How does this work?]", 
+            #         help="""### How does this work?\nThe search engine leverages Retrieval Augmented Generation (RAG), a technique that enhances the ability of large language models (LLMs) to retrieve information from unstructured sources. First, we convert all pages of the sustainability statement into machine-readable text using [MistralOCR](https://docs.mistral.ai/capabilities/document/).
+            #         \nNext, we embed this text using [Mistral's embedding model](https://docs.mistral.ai/capabilities/embeddings/), which converts the text into a numerical format. This numerical representation allows us to identify the 10 pages most relevant to the query.
+            #         \nFinally, [OpenAI's GPT 4o-mini](https://platform.openai.com/docs/models/gpt-4o-mini) reads the user prompt and reviews the 10 selected pages to generate an answer based on the retrieved information.
+            #         \n**Disclaimer:** The generated answer is produced by an artificial intelligence language model. While we strive for accuracy and quality through our prompt design and by using information provided solely by the company, please note that the content may not be completely error-free or up-to-date. We recommend independently verifying the information and consulting professionals for specific advice. We assume no responsibility or liability for the use or interpretation of this content, and it does not constitute investment advice.""")
 
-# If the user selects a company, we filter; otherwise we keep all rows.
-if len(selected_companies) != 0:
-    filtered_df = filtered_df[filtered_df["company"].isin(selected_companies)]
+            #     st.markdown("<div style='padding-bottom: 25px;'/>", unsafe_allow_html=True)
 
+        except Exception as e:
+            show_error(e)
+        finally:
+            tracer.end(fragment_span)
 
-filtered_and_sorted_df = (
-        filtered_df
-        .assign(
-            # company_withAccessInfo = lambda x: [
-            #     company if _mergePages == "both" else f"{company}*" 
-            #     for company, _mergePages in zip(x["company"], x["_mergePages"])
-            #     ],
-            company_withAccessInfo = lambda x : x["company"],
-            company_uncased = lambda x: x["company"].str.lower()
-            )
-        .sort_values("company_uncased", ascending=True)
-    )
 
-try:
-    tab1, tab2 = st.tabs(["List of reports", "Heatmap of topics reported"])
 
 
-    # ------------------------------------ TABLE ----------------------------------
-    with tab1:
-
-        table = st.dataframe(
-            filtered_and_sorted_df.loc[:, [
-                "company_withAccessInfo", "link", "country", "sector", "industry", "publication date", "pages PDF", "auditor"
-                ]],
-            column_config={
-                "company_withAccessInfo": st.column_config.Column(width="medium", label="Company"),
-                "link": st.column_config.LinkColumn(
-                    label="Download",
-                    width="small",
-                    display_text="Link"
-                ),
-                "country": st.column_config.Column(label="Country"),
-                "sector": st.column_config.Column(width="medium", label="Sector"),
-                "industry": st.column_config.Column(width="medium", label="Industry"),
-                "publication date": st.column_config.DateColumn(
-                    format="DD.MM.YYYY", width="small", label="Published"
-                ),
-                "pages PDF": st.column_config.NumberColumn(
-                    help="Number of pages of the sustainability statement.",
-                    label="Pages"
-                ),
-                "auditor": st.column_config.TextColumn(label="Auditor"),
-            },
-            use_container_width=True,
-            hide_index=True,
-            on_select="rerun",
-            selection_mode="multi-row",
-        )
+    # ------------------------------------ HEATMAP ----------------------------------
+    # The heatmap controls only rerun this fragment; `filter_key` identifies the filters for the chart cache
+    @st.fragment
+    def heatmap(archive, filtered_rows, filter_key):
+        fragment_span = tracer.begin("heatmap")
+        try:
+            col_tab2_left, col_tab2_right = st.columns([0.5, 0.5])
 
-        query_companies = table.selection.rows
-        query_companies_df = filtered_and_sorted_df.iloc[query_companies, :]
-
-        st.markdown("🚧 The AI-powered search engine is currently under construction. Follow us on LinkedIn and don't miss our upcoming rework!")
-
-        # # ----- SEARCH ENGINE -----
-        # with st.container():
-        #     st.markdown("### Search Engine")
-        #     st.caption(":gray[Reports marked with an asterisk (*) cannot yet be queried. We will upload them soon!]")
-
-        #     prompt = st.chat_input(define_popover_title(query_companies_df), disabled=query_companies == [] or len(query_companies) > 1)
-
-        #     if prompt:
-                
-        #         if not langdetect.detect(prompt) == "en":
-        #             translated_prompt = translate_prompt(openai_client, prompt)
-        #             prompt = translated_prompt + f" (original prompt: {prompt})"
-
-        #         for _, query_document in query_companies_df.iterrows():
-        #             # Define stuff
-        #             query_company_name = query_document['company']
-        #             query_document_id = query_document['document_id']
-        #             query_document_start_page_pdf = int(ast.literal_eval(query_document["pages"])[0])
-        #             query_document_url = f"https://gbixxtefgqebkaviusss.supabase.co/storage/v1/object/public/document-pdfs/{query_document_id}.pdf"
-                    
-        #             log_query_to_supabase(supabase, query_document_id, prompt)
-
-        #             try:
-        #                 with st.spinner():
-        #                     # Query all pages of the selected document
-        #                     query_report_allpages = (
-        #                         supabase.table("pages")
-        #                         .select("*")
-        #                         .eq("document_id", query_document_id)
-        #                         .execute()
-        #                     ).data
-
-        #                 similar_pages = get_most_similar_pages(prompt, query_report_allpages, top_pages=5)
-                                            
-        #                 if similar_pages == []:
-        #                     st.error(f"We have not processed the report of {query_company_name}.")
-
-        #                 else:
-        #                     with st.expander(query_company_name, expanded=True):
-        #                         col_expander_response, col_expander_pdf = st.columns([0.35, 0.65])
-
-        #                         # Left column: Prompt + OpenAI response (@To-Do: switch to Mistral)
-        #                         with col_expander_response:
-        #                             query_results_text = "\n".join([x["content"] for x in similar_pages])
-
-        #                             with st.chat_message("user"):
-        #                                 st.text(prompt)
-
-        #                             with st.chat_message("assistant"):
-        #                                 stream = summarize_text_bygpt(
-        #                                     client=openai_client, 
-        #                                     queryText=prompt, 
-        #                                     relevantChunkTexts=query_results_text
-        #                                     )
-                                        
-        #                                 gpt_response = st.write_stream(stream)
-                                        
-        #                                 relevant_pages_first = int(similar_pages[0]["page"]) - query_document_start_page_pdf + 1
-        #                                 st.markdown(f"[Access the full report here]({query_document_url}) or jump directly [to the relevant pages]({query_document_url + f"#page={relevant_pages_first}"})")
-
-        #                         # Right column: Render relevant PDF pages
-        #                         with col_expander_pdf:
-        #                             pages_to_render = [
-        #                                 int(p["page"]) - query_document_start_page_pdf + 1
-        #                                 for p in similar_pages
-        #                                 ]
-
-        #                             with st.spinner("Downloading and finding the relevant pages", show_time=True):
-        #                                 display_annotated_pdf(
-        #                                     query_document_url,
-        #                                     pages_to_render=pages_to_render[:3]
-        #                                     )
-
-
-        #             except Exception as e:
-        #                 st.error(f"Could not find any relevant information in the PDF for {query_company_name}.")
-        #                 print(e)
-            
-        #     st.caption(
-        #         ":gray[How does this work?]", 
-        #         help="""### How does this work?\nThe search engine leverages Retrieval Augmented Generation (RAG), a technique that enhances the ability of large language models (LLMs) to retrieve information from unstructured sources. First, we convert all pages of the sustainability statement into machine-readable text using [MistralOCR](https://docs.mistral.ai/capabilities/document/).
-        #         \nNext, we embed this text using [Mistral's embedding model](https://docs.mistral.ai/capabilities/embeddings/), which converts the text into a numerical format. This numerical representation allows us to identify the 10 pages most relevant to the query.
-        #         \nFinally, [OpenAI's GPT 4o-mini](https://platform.openai.com/docs/models/gpt-4o-mini) reads the user prompt and reviews the 10 selected pages to generate an answer based on the retrieved information.
-        #         \n**Disclaimer:** The generated answer is produced by an artificial intelligence language model. While we strive for accuracy and quality through our prompt design and by using information provided solely by the company, please note that the content may not be completely error-free or up-to-date. We recommend independently verifying the information and consulting professionals for specific advice. We assume no responsibility or liability for the use or interpretation of this content, and it does not constitute investment advice.""")
+            with col_tab2_left:
+                st.markdown("""##### Explanation \n\n This chart shows simple counts of how often a standard is referenced in the company's sustainability statement. To compute the count, we scan the pages of the sustainability statement and count the occurrences of the standard identifier (e.g., E1, E2, ..., G1).""")
 
-        #     st.markdown("<div style='padding-bottom: 25px;'/>", unsafe_allow_html=True)
+                st.markdown("###### Scaling\n\n")
+                st.checkbox(label="Scale the counts by the number of datapoints per standard from IG-3 (to control for longer standards)", key="scale_by_dp")
+                scale_by_dp = st.session_state.get("scale_by_dp", False)
 
+                st.markdown("###### Split view")
+                split_view = st.radio(label="None", options=("by sector", "by country", "by auditor", "no split"), index=0, horizontal=True, label_visibility="collapsed")
 
 
+            with col_tab2_right:
+                filtered_melted_df = select_heatmap(archive["heatmap_table"], filtered_rows, scale_by_dp=scale_by_dp)
 
-# ------------------------------------ HEATMAP ----------------------------------
-    with tab2:
-        col_tab2_left, col_tab2_right = st.columns([0.5, 0.5])
+                if filtered_melted_df.empty:
+                    st.error(f"We have not analyzed this company yet but will do so very soon!", icon="🚨")
 
-        with col_tab2_left:
-            st.markdown("""##### Explanation \n\n This chart shows simple counts of how often a standard is referenced in the company's sustainability statement. To compute the count, we scan the pages of the sustainability statement and count the occurrences of the standard identifier (e.g., E1, E2, ..., G1).""")
+                else:
+                    plot_heatmap(
+                        filtered_melted_df,
+                        split_view,
+                        cache_key=(
+                            archive["version"], filter_key, split_view, scale_by_dp,
+                            ),
+                        )
 
-            st.markdown("###### Scaling\n\n")
-            st.checkbox(label="Scale the counts by the number of datapoints per standard from IG-3 (to control for longer standards)", key="scale_by_dp")
-            scale_by_dp = st.session_state.get("scale_by_dp", False)
+        except Exception as e:
+            show_error(e)
+        finally:
+            tracer.end(fragment_span)
 
-            st.markdown("###### Split view")
-            split_view = st.radio(label="None", options=("by sector", "by country", "by auditor", "no split"), index=0, horizontal=True, label_visibility="collapsed")
 
+    try:
+        tab1, tab2 = st.tabs(["List of reports", "Heatmap of topics reported"])
 
-        with col_tab2_right:
-            filtered_melted_df = (
-                filtered_df
-                .loc[:, [
-                    'company', "sector", "country", "auditor", "pages PDF", 
-                    'e1', 'e2', "e3", "e4", "e5", "s1", "s2", "s3", "s4", "g1"
-                    ]
-                ]
-                .melt(id_vars=["company", "sector", "country", "auditor", "pages PDF"], value_name="hits", var_name="standard")
-                .merge(standard_info_mapper)
-                .assign(
-                    standard=lambda x: x['standard'].str.upper(),
-                    hits=lambda x: x["hits"] / x["ig3_dp"] if scale_by_dp else x["hits"],  
-                    )
-                .sort_values("sector")
-                .dropna()
-            )
+        with tab1:
+            report_table(archive, filtered_rows)
+
+        with tab2:
+            heatmap(archive, filtered_rows, (tuple(selected_countries), tuple(selected_industries), tuple(selected_companies)))
 
-            if filtered_melted_df.empty:
-                st.error(f"We have not analyzed this company yet but will do so very soon!", icon="🚨")
 
-            else:
-                plot_heatmap(filtered_melted_df, split_view)
 
 
+    # ------------------------------------ ERROR HANDLING ----------------------------------
+    except Exception as e:
+        show_error(e)
+finally:
+    # Also when a rerun or st.stop interrupts the script
+    tracer.end(app_span)
 
 
-# ------------------------------------ ERROR HANDLING ----------------------------------
-except Exception as e:
-    st.error('This is an error. We are working on a fix. In the meantime, check out our Google Sheet!', icon="🚨")
-    print(e)
\ No newline at end of file
+# ------------------------------------ DEBUG ----------------------------------
+if debug_panel_enabled():
+    plot_debug_panel()
@@ -1,40 +1,303 @@
+import collections
+import contextlib
+import copy
+import functools
+import hashlib
+import io
 import json
+import mmap
+import os
+import pathlib
+import queue
+import re
+import tempfile
+import threading
+import time
+import traceback
+import tracemalloc
+from ast import literal_eval
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import streamlit as st
 import altair as alt
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import requests
-from sklearn.metrics.pairwise import cosine_similarity
-from ast import literal_eval
+import langdetect
 from mistralai import Mistral
 
 from streamlit_pdf_viewer import pdf_viewer
+from pypdf import PageObject, PdfReader, PdfWriter
+from pypdf.generic import NameObject
+from pypdf.errors import PdfReadError
 
 from streamlit import runtime
 from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 
-def read_data() -> pd.DataFrame:
+ARCHIVE_SNAPSHOT_PATH = os.path.join("data", "archive.parquet")
+ARCHIVE_TTL_SECONDS = 15 * 60
+
+_archive_lock = threading.Lock()
+_archive_refresh_lock = threading.Lock()
+_archive = {"current": None, "fetched_at": 0.0, "refreshing": False}
+
+
+ARCHIVE_SHEET_URLS = {
+    "archive": "https://docs.google.com/spreadsheets/d/1Nlyf8Yz_9Fst8rEmQc2IMc-DWLF1fpmBTB7n4FlZwxs/export?format=csv&gid=0",
+    "industries": "https://docs.google.com/spreadsheets/d/1Nlyf8Yz_9Fst8rEmQc2IMc-DWLF1fpmBTB7n4FlZwxs/export?format=csv&gid=218767986#gid=218767986",
+    "counts": "https://docs.google.com/spreadsheets/d/1Vj8yau93kmSs_WqnV5w1V_tdU-JlMo-BV6htDvAv1TI/export?format=csv&gid=1792638779#gid=1792638779",
+}
+ARCHIVE_SHEETS_DIR = os.path.join("data", "sheets")
+ARCHIVE_KEY_COLUMNS = ['company', "isin", 'link', 'country', 'industry', "publication date", "pages PDF", "auditor"]
+STANDARDS = ['e1', 'e2', 'e3', 'e4', 'e5', 's1', 's2', 's3', 's4', 'g1']
+
+# Per sheet: HTTP validators, content digest and the parsed frame of the last download
+_sheets = {}
+_sheets_lock = threading.Lock()
+
+
+TRACE_DIR = os.path.join("data", "traces")
+TRACE_HISTORY_SIZE = 200
+
+
+class Tracer:
     """
-    Read data the SRN CSRD Archive Google Sheet, merge Industry-Sector lookup
-    add Standard-Counts dataframes, and return a cleaned DataFrame.
+    Lightweight tracing of reruns: nested spans, process-wide counters and
+    memory snapshots.
+
+    A span opened while no trace is active in the thread starts a trace (one
+    per script or fragment run); nested spans are recorded into it with their
+    offsets, so a trace renders as a waterfall. Spans also feed per-name
+    duration totals, which the Prometheus export reports alongside the
+    counters. Finished traces are kept in a bounded history. Worker threads
+    join the trace of the thread that submitted them through `bind`.
     """
+
+    def __init__(self, history_size: int = TRACE_HISTORY_SIZE):
+        self.history = collections.deque(maxlen=history_size)
+        self.counters = collections.Counter()
+        self.span_seconds = collections.Counter()
+        self.span_calls = collections.Counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self) -> dict:
+        """ The innermost open span of this thread (carries its trace), or None """
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def start(self, name: str, **attributes) -> dict:
+        """ Start a new trace in this thread, dropping spans a failed run left open """
+        self._local.stack = []
+        return self.begin(name, **attributes)
+
+    def begin(self, name: str, **attributes) -> dict:
+        """ Open a span; without an open span in this thread, it starts a new trace """
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        now = time.perf_counter()
+        if parent is None:
+            trace = {
+                "name": name, "started_at": time.time(), "start": now,
+                "spans": [], "errors": [], "memory_before": memory_snapshot(),
+            }
+        else:
+            trace = parent["trace"]
+        span = {
+            "trace": trace, "name": name, "attributes": attributes, "start": now,
+            "depth": parent["depth"] + 1 if parent is not None else 0,
+        }
+        stack.append(span)
+        return span
+
+    def end(self, span: dict, error: BaseException = None) -> float:
+        """ Close `span` (and anything left open inside it); closing a trace's root span finishes the trace """
+        stack = self._stack()
+        while stack and stack[-1] is not span:
+            stack.pop()
+        if stack:
+            stack.pop()
+        seconds = time.perf_counter() - span["start"]
+        trace = span["trace"]
+        trace["spans"].append({
+            "name": span["name"],
+            "depth": span["depth"],
+            "offset": span["start"] - trace["start"],
+            "seconds": seconds,
+            "thread": threading.current_thread().name,
+            "error": repr(error) if error is not None else None,
+            **({"attributes": span["attributes"]} if span["attributes"] else {}),
+        })
+        self.record(span["name"], seconds)
+        if span["depth"] == 0:
+            trace["seconds"] = seconds
+            trace["memory_after"] = memory_snapshot()
+            self.history.append(trace)
+        return seconds
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        span = self.begin(name, **attributes)
+        try:
+            yield span
+        except BaseException as e:
+            self.end(span, error=e)
+            raise
+        self.end(span)
+
+    def traced(self, name: str):
+        """ Decorator: run the function in a span called `name` """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name: str, seconds: float) -> None:
+        """ Add a duration timed without a span (e.g. across the yields of a generator) to the span totals """
+        with self._lock:
+            self.span_seconds[name] += seconds
+            self.span_calls[name] += 1
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] += value
+
+    def record_error(self, error: BaseException) -> None:
+        """ Attach a caught exception to the current trace and count it """
+        self.count("errors")
+        span = self.current()
+        if span is not None:
+            span["trace"]["errors"].append("".join(traceback.format_exception(error)))
+
+    def bind(self, function):
+        """ Wrap `function` for a worker thread so its spans join the current trace """
+        parent = self.current()
+        if parent is None:
+            return function
+
+        def bound(*args, **kwargs):
+            stack = self._stack()
+            stack.append(parent)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stack.clear()
+
+        return bound
+
+    def export_jsonl(self, path: str = None) -> str:
+        """ Append the finished traces to a JSONL file and return its path """
+        path = path or os.path.join(TRACE_DIR, "traces.jsonl")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            for trace in list(self.history):
+                f.write(json.dumps({k: v for k, v in trace.items() if k != "start"}, default=str) + "\n")
+        return path
+
+    def export_prometheus(self, path: str = None) -> str:
+        """ Write counters, span durations and memory in the Prometheus text format and return the path """
+        path = path or os.path.join(TRACE_DIR, "metrics.prom")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        metric = lambda name: "srn_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+        with self._lock:
+            lines = [f"{metric(name)}_total {value}" for name, value in sorted(self.counters.items())]
+            lines += ["# TYPE srn_span_seconds summary"]
+            for name in sorted(self.span_calls):
+                lines.append(f'srn_span_seconds_sum{{span="{name}"}} {self.span_seconds[name]:.6f}')
+                lines.append(f'srn_span_seconds_count{{span="{name}"}} {self.span_calls[name]}')
+        lines += ["# TYPE srn_process_rss_bytes gauge", f"srn_process_rss_bytes {memory_snapshot()['rss_bytes']}"]
+        temporary = path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temporary, path)
+        return path
+
+
+def memory_snapshot() -> dict:
+    """ Resident memory of the process (and the tracemalloc total when tracemalloc is running) """
+    try:
+        with open("/proc/self/statm") as f:
+            rss_bytes = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        import resource
+        rss_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    snapshot = {"rss_bytes": rss_bytes}
+    if tracemalloc.is_tracing():
+        snapshot["traced_bytes"] = tracemalloc.get_traced_memory()[0]
+    return snapshot
+
+
+tracer = Tracer()
+
+
+@functools.lru_cache(maxsize=None)
+def get_http_session() -> requests.Session:
+    """ One pooled, keep-alive HTTP session shared by all downloads of the process """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=16)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def parse_archive_sheet(content: bytes) -> pd.DataFrame:
     return (
-        pd.read_csv("https://docs.google.com/spreadsheets/d/1Nlyf8Yz_9Fst8rEmQc2IMc-DWLF1fpmBTB7n4FlZwxs/export?format=csv&gid=0", skiprows=2)
+        pd.read_csv(io.BytesIO(content), skiprows=2)
         .query("verified == 'yes'")
         .rename(columns={
             'SASB industry \n(SICS® Industries)': "industry",
             })
-        .merge(
-            # Merge Industry-Sector Lookup from separate sheet
-            pd.read_csv(
-                "https://docs.google.com/spreadsheets/d/1Nlyf8Yz_9Fst8rEmQc2IMc-DWLF1fpmBTB7n4FlZwxs/export?format=csv&gid=218767986#gid=218767986"
-                ).rename(columns={
-                    "SICS® Industries": "industry",
-                    "SICS® Sector": "sector"
-                    }
-                ), on="industry", how="left"
+    )
+
+
+def parse_industry_sheet(content: bytes) -> pd.DataFrame:
+    return (
+        pd.read_csv(io.BytesIO(content))
+        .rename(columns={
+            "SICS® Industries": "industry",
+            "SICS® Sector": "sector"
+            })
+    )
+
+
+def parse_counts_sheet(content: bytes) -> pd.DataFrame:
+    return (
+        pd.read_csv(io.BytesIO(content))
+        .assign(
+            isin = lambda x: x["isin"].str.strip(),
             )
+        .query("year == 2024")
+        .drop_duplicates(subset=['isin'])
+        .drop(["company", "pages", "year", "type"], axis=1)
+    )
+
+
+SHEET_PARSERS = {
+    "archive": parse_archive_sheet,
+    "industries": parse_industry_sheet,
+    "counts": parse_counts_sheet,
+}
+
+
+def merge_archive(archive: pd.DataFrame, industries: pd.DataFrame, counts: pd.DataFrame) -> pd.DataFrame:
+    """
+    Merge the Industry-Sector lookup and the Standard-Counts into the parsed
+    SRN CSRD Archive sheet and return a cleaned DataFrame.
+    """
+    return (
+        archive
+        # Merge Industry-Sector Lookup from separate sheet
+        .merge(industries, on="industry", how="left")
         .assign(
             # link = lambda x: [f"{y}#name={z}" for y, z in zip(x["link"], x["company"])],
             # link = lambda x: [f"{y}#download=⬇️" for y, z in zip(x["link"], x["company"])],
@@ -43,23 +306,674 @@ def read_data() -> pd.DataFrame:
         .loc[:, ['company', "isin", 'link', 'country', 'sector', 'industry', "publication date", "pages PDF", "auditor"]]
         .dropna()
         # Merge the standard-counts dataframe
-        .merge(
-            (
-                pd.read_csv("https://docs.google.com/spreadsheets/d/1Vj8yau93kmSs_WqnV5w1V_tdU-JlMo-BV6htDvAv1TI/export?format=csv&gid=1792638779#gid=1792638779")
-                .assign(
-                    isin = lambda x: x["isin"].str.strip(),
-                    )
-                .query("year == 2024")
-                .drop_duplicates(subset=['isin'])
-                .drop(["company", "pages", "year", "type"], axis=1)
-            ),
-            on=["isin"], how="outer", indicator="_mergeHeatmap"
-        )
+        .merge(counts, on=["isin"], how="outer", indicator="_mergeHeatmap")
         .query("_mergeHeatmap != 'right_only'")
         .sort_values("publication date", ascending=True)
     )
 
 
+def melt_heatmap(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Long format of the standard counts (one row per report and standard),
+    sorted by sector. `row` is the index label of the report in `df`.
+    """
+    return (
+        df
+        .loc[:, ["company", "isin", "sector", "country", "auditor", "pages PDF", *STANDARDS]]
+        .rename_axis("row")
+        .reset_index()
+        .melt(id_vars=["row", "company", "isin", "sector", "country", "auditor", "pages PDF"], value_name="hits", var_name="standard")
+        .dropna()
+        .sort_values("sector", kind="stable")
+        .reset_index(drop=True)
+    )
+
+
+def _hash_archive_rows(archive: pd.DataFrame) -> pd.Series:
+    """ One hash per ISIN over the archive columns that end up in the merged frame """
+    archive = archive.dropna(subset=["isin"])
+    row_hashes = pd.util.hash_pandas_object(archive.loc[:, ARCHIVE_KEY_COLUMNS], index=False)
+    return row_hashes.groupby(archive["isin"].to_numpy()).sum()
+
+
+def _insert_sorted(frame: pd.DataFrame, rows: pd.DataFrame, by: str) -> pd.DataFrame:
+    """ Insert `rows` into `frame`, both sorted by `by`, without sorting `frame` again """
+    positions = np.searchsorted(frame[by].to_numpy(), rows[by].to_numpy(), side="right")
+    order = np.insert(np.arange(len(frame)), positions, len(frame) + np.arange(len(rows)))
+    return pd.concat([frame, rows]).iloc[order]
+
+
+def merge_archive_incremental(previous: dict, old_archive: pd.DataFrame, new_archive: pd.DataFrame,
+                              industries: pd.DataFrame, counts: pd.DataFrame) -> dict:
+    """
+    Apply the ISINs that were inserted, updated or deleted between two versions
+    of the archive sheet to the merged archive and its heatmap table.
+
+    Only the changed rows go through `merge_archive`; they are spliced into the
+    sorted frames by binary search. Returns None when `previous` is not in the
+    expected order and a full rebuild is needed.
+    """
+    df, heatmap = previous["df"], previous["heatmap"]
+    if not df["publication date"].is_monotonic_increasing or not heatmap["sector"].is_monotonic_increasing:
+        return None
+
+    old_hashes = _hash_archive_rows(old_archive)
+    new_hashes = _hash_archive_rows(new_archive)
+    common = old_hashes.index.intersection(new_hashes.index)
+    changed = (
+        new_hashes.index.difference(old_hashes.index)
+        .union(old_hashes.index.difference(new_hashes.index))
+        .union(common[old_hashes[common].to_numpy() != new_hashes[common].to_numpy()])
+    )
+    if changed.empty:
+        return {"df": df, "heatmap": heatmap}
+
+    fresh = merge_archive(
+        new_archive[new_archive["isin"].isin(changed)],
+        industries,
+        counts[counts["isin"].isin(changed)],
+    )
+    next_label = df.index.max() + 1 if len(df) else 0
+    fresh.index = pd.RangeIndex(next_label, next_label + len(fresh))
+
+    return {
+        "df": _insert_sorted(df[~df["isin"].isin(changed)], fresh, "publication date"),
+        "heatmap": (
+            _insert_sorted(heatmap[~heatmap["isin"].isin(changed)], melt_heatmap(fresh), "sector")
+            .reset_index(drop=True)
+        ),
+    }
+
+
+STANDARD_COUNTS_PATH = os.path.join("data", "standard-counts.parquet")
+# ESRS identifiers not glued to other letters/digits ("E1", "E1-6", "ESRS S2" but not "E10" or "SE1")
+ESRS_PATTERN = re.compile(r"(?<![A-Za-z0-9])(E[1-5]|S[1-4]|G1)(?![0-9])")
+
+_standard_counts_lock = threading.Lock()
+
+
+def count_standards(texts: list) -> dict:
+    """ How often each ESRS standard is referenced in the page texts of a report """
+    hits = collections.Counter()
+    for text in texts:
+        hits.update(ESRS_PATTERN.findall(text or ""))
+    return {standard: hits[standard.upper()] for standard in STANDARDS}
+
+
+def hash_texts(texts: list) -> str:
+    digest = hashlib.sha256()
+    for text in texts:
+        digest.update((text or "").encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _count_document(item: tuple) -> dict:
+    """ Process pool task: the standard counts of one report """
+    isin, content_hash, texts = item
+    return {"isin": isin, "content_hash": content_hash, **count_standards(texts)}
+
+
+def load_standard_counts() -> pd.DataFrame:
+    """ The locally computed counts (isin, content_hash and one column per standard) """
+    try:
+        return pd.read_parquet(STANDARD_COUNTS_PATH)
+    except (OSError, ValueError):
+        return pd.DataFrame(columns=["isin", "content_hash", *STANDARDS])
+
+
+def overlay_standard_counts(counts: pd.DataFrame) -> pd.DataFrame:
+    """ The counts of the sheet, replaced by the locally computed ones where there are any """
+    local = load_standard_counts().drop(columns=["content_hash"])
+    return pd.concat([counts[~counts["isin"].isin(local["isin"])], local], ignore_index=True)
+
+
+def update_standard_counts(documents: dict, max_workers: int = None) -> pd.DataFrame:
+    """
+    Count the standards in the reports `documents` (ISIN -> page texts) that
+    are new or whose texts changed since the last run, one report per process,
+    store the counts and write them into the current archive and heatmap
+    table. Returns the counts of the reports that were recounted.
+    """
+    with _standard_counts_lock:
+        stored = load_standard_counts()
+        known = dict(zip(stored["isin"], stored["content_hash"]))
+        todo = []
+        for isin, texts in documents.items():
+            content_hash = hash_texts(texts)
+            if known.get(isin) != content_hash:
+                todo.append((isin, content_hash, texts))
+        if not todo:
+            return stored.iloc[:0]
+
+        if len(todo) == 1:
+            counted = [_count_document(todo[0])]
+        else:
+            with ProcessPoolExecutor(max_workers=min(max_workers or os.cpu_count(), len(todo))) as executor:
+                counted = list(executor.map(_count_document, todo))
+        counted = pd.DataFrame(counted, columns=stored.columns)
+
+        os.makedirs(os.path.dirname(STANDARD_COUNTS_PATH), exist_ok=True)
+        tmp_path = STANDARD_COUNTS_PATH + ".tmp"
+        (
+            pd.concat([stored[~stored["isin"].isin(counted["isin"])], counted], ignore_index=True)
+            .to_parquet(tmp_path, index=False)
+        )
+        os.replace(tmp_path, STANDARD_COUNTS_PATH)
+
+    _apply_standard_counts(counted)
+    return counted
+
+
+def _apply_standard_counts(counted: pd.DataFrame) -> None:
+    """ Write fresh counts into the current archive version and publish it """
+    with _archive_refresh_lock:
+        if _splice_standard_counts(counted):
+            _write_archive_snapshot(_archive["current"]["df"])
+
+
+def _splice_standard_counts(counted: pd.DataFrame) -> bool:
+    """
+    Publish a version of the current archive with the `counted` standard
+    counts; the caller holds `_archive_refresh_lock`. Only the reports whose
+    counts differ are touched: their cells are replaced in the long heatmap
+    and its plotting table, and the `FilterIndex` is shared with the current
+    version except for the count columns of its table. False if no count
+    changed.
+    """
+    current = _archive["current"]
+    if current is None or counted.empty:
+        return False
+    values = counted.drop_duplicates("isin", keep="last").set_index("isin").loc[:, STANDARDS].astype(float)
+    df = current["df"]
+    rows = np.flatnonzero(df["isin"].isin(values.index).to_numpy())
+    new = values.loc[df["isin"].to_numpy()[rows]].to_numpy()
+    old = df[STANDARDS].to_numpy(dtype=float)[rows]
+    changed = ~((new == old) | (np.isnan(new) & np.isnan(old))).all(axis=1)
+    rows, new = rows[changed], new[changed]
+    if not len(rows):
+        return False
+
+    with tracer.span("archive.counts", reports=len(rows)):
+        df = df.copy()
+        df.iloc[rows, df.columns.get_indexer(STANDARDS)] = new
+        labels = df.index[rows]
+        fresh = melt_heatmap(df.loc[labels])
+        heatmap = current["heatmap"]
+        heatmap = _insert_sorted(heatmap[~heatmap["row"].isin(labels)], fresh, "sector").reset_index(drop=True)
+
+        filters = copy.copy(current["filters"])
+        for column in STANDARDS:
+            if column in filters.table.column_names:
+                filters.table = filters.table.set_column(
+                    filters.table.column_names.index(column), column,
+                    pa.Array.from_pandas(df.loc[filters.labels, column].to_numpy(dtype=float)),
+                )
+        positions = pd.Index(filters.labels).get_indexer(labels)
+        heatmap_table = current["heatmap_table"]
+        heatmap_table = _insert_sorted(
+            heatmap_table[~heatmap_table["row"].isin(positions[positions >= 0])],
+            build_heatmap_table(filters, fresh), "sector",
+        ).reset_index(drop=True)
+
+        archive = {
+            **current,
+            "version": current["version"] + 1,
+            "df": df,
+            "heatmap": heatmap,
+            "filters": filters,
+            "heatmap_table": heatmap_table,
+            "reports": build_report_table(filters),
+        }
+    with _archive_lock:
+        _archive["current"] = archive
+    return True
+
+
+def _load_sheet_state(name: str) -> dict:
+    """ Validators and parsed frame of a sheet from the last run, if they were persisted """
+    meta_path = os.path.join(ARCHIVE_SHEETS_DIR, f"{name}.json")
+    frame_path = os.path.join(ARCHIVE_SHEETS_DIR, f"{name}.parquet")
+    try:
+        with open(meta_path) as f:
+            state = json.load(f)
+        state["frame"] = pd.read_parquet(frame_path)
+        return state
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_sheet_state(name: str, state: dict) -> None:
+    os.makedirs(ARCHIVE_SHEETS_DIR, exist_ok=True)
+    state["frame"].to_parquet(os.path.join(ARCHIVE_SHEETS_DIR, f"{name}.parquet"), index=False)
+    with open(os.path.join(ARCHIVE_SHEETS_DIR, f"{name}.json"), "w") as f:
+        json.dump({k: v for k, v in state.items() if k != "frame"}, f)
+
+
+def fetch_sheet(name: str, url: str, previous: dict, timeout: float = 30) -> tuple:
+    """
+    Conditionally download a sheet and parse it.
+
+    Sends the ETag/Last-Modified validators of the `previous` download and
+    returns `(state, changed)`. The frame of the previous download is reused
+    when the server answers 304 or the body is byte-identical, so unchanged
+    sheets are not parsed again.
+    """
+    headers = {}
+    if "frame" in previous:
+        if previous.get("etag"):
+            headers["If-None-Match"] = previous["etag"]
+        if previous.get("last_modified"):
+            headers["If-Modified-Since"] = previous["last_modified"]
+
+    response = get_http_session().get(url, headers=headers, timeout=timeout)
+    if response.status_code == 304:
+        return previous, False
+    response.raise_for_status()
+
+    digest = hashlib.sha256(response.content).hexdigest()
+    changed = "frame" not in previous or digest != previous.get("digest")
+    return {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "digest": digest,
+        "frame": SHEET_PARSERS[name](response.content) if changed else previous["frame"],
+    }, changed
+
+
+def fetch_data(previous: dict = None) -> dict:
+    """
+    Download the three source sheets in parallel and merge them.
+
+    `previous` holds the current `df` and `heatmap`. It is returned as is when
+    none of the sheets changed (new validators of unchanged sheets are
+    committed right away), and updated incrementally when only the archive
+    sheet changed. Otherwise both tables are rebuilt. The new sheet states are
+    returned under `sheets` and committed with `commit_sheet_states` once the
+    result has been stored.
+    """
+    with _sheets_lock:
+        for name in ARCHIVE_SHEET_URLS:
+            if name not in _sheets:
+                _sheets[name] = _load_sheet_state(name)
+        previous_states = dict(_sheets)
+
+    with tracer.span("archive.fetch"), ThreadPoolExecutor(max_workers=len(ARCHIVE_SHEET_URLS)) as executor:
+        futures = {
+            name: executor.submit(fetch_sheet, name, url, previous_states[name])
+            for name, url in ARCHIVE_SHEET_URLS.items()
+        }
+        sheets = {name: future.result() for name, future in futures.items()}
+
+    changed = {name for name, (_, sheet_changed) in sheets.items() if sheet_changed}
+    if previous is not None and not changed:
+        # Same content, possibly under new validators: keep those for the next request
+        commit_sheet_states({
+            name: state for name, (state, _) in sheets.items()
+            if state is not previous_states[name]
+        })
+        return previous
+
+    frames = {name: state["frame"] for name, (state, _) in sheets.items()}
+    frames["counts"] = overlay_standard_counts(frames["counts"])
+    result = None
+    with tracer.span("archive.merge", changed=sorted(changed)):
+        # The incremental merge needs the previous archive sheet (it may not have been persisted)
+        if previous is not None and changed == {"archive"} and "frame" in previous_states["archive"]:
+            result = merge_archive_incremental(
+                previous, previous_states["archive"]["frame"],
+                frames["archive"], frames["industries"], frames["counts"],
+            )
+        if result is None:
+            df = merge_archive(frames["archive"], frames["industries"], frames["counts"])
+            result = {"df": df, "heatmap": melt_heatmap(df)}
+
+    result["sheets"] = {
+        name: state for name, (state, _) in sheets.items()
+        if state is not previous_states[name]
+    }
+    return result
+
+
+def commit_sheet_states(states: dict) -> None:
+    """ Make the given sheet states the baseline of the next conditional download """
+    with _sheets_lock:
+        for name, state in states.items():
+            _sheets[name] = state
+            _save_sheet_state(name, state)
+
+
+def _write_archive_snapshot(df: pd.DataFrame) -> bool:
+    """
+    Persist the last good archive as Parquet (written to a temp file, then
+    swapped in). Best effort: False if it could not be written.
+    """
+    tmp_path = ARCHIVE_SNAPSHOT_PATH + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(ARCHIVE_SNAPSHOT_PATH), exist_ok=True)
+        # Keep the index: its labels identify the rows of the heatmap table
+        df.to_parquet(tmp_path, index=True)
+        os.replace(tmp_path, ARCHIVE_SNAPSHOT_PATH)
+        return True
+    except Exception as e:
+        print(f"Could not write archive snapshot: {e}")
+        return False
+
+
+def to_arrow_table(df: pd.DataFrame) -> pa.Table:
+    """ `df` as an Arrow table without its index; object columns of mixed types become strings """
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        mixed = [
+            column for column in df.columns
+            if df[column].dtype == object and pd.api.types.infer_dtype(df[column], skipna=True).startswith("mixed")
+        ]
+        return pa.Table.from_pandas(df.astype({column: str for column in mixed}), preserve_index=False)
+
+
+def arrow_ipc_bytes(table: pa.Table) -> bytes:
+    """ `table` in the Arrow IPC stream format, as Streamlit sends data to the browser """
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+class FilterIndex:
+    """
+    Sorted options and row bitmaps for the filters of the app over one Arrow
+    table of the filterable reports, built once per archive version.
+
+    `table` is the only copy of the rows: the report list is a view of it and
+    `rows` turns positions into a DataFrame. `labels` are the index labels of
+    the rows in the archive `df`. Countries and sectors get one boolean row
+    bitmap per value. Companies have about one value per row, so they are
+    matched through their category codes instead of n bitmaps of n rows.
+    """
+
+    BITMAP_COLUMNS = ["country", "sector"]
+
+    def __init__(self, df: pd.DataFrame):
+        df = df.dropna(subset=["company", "isin", "country", "sector", "industry"])
+        self.labels = df.index.to_numpy()
+        self.table = to_arrow_table(df.reset_index(drop=True))
+
+        categories = {column: pd.Categorical(df[column]) for column in ["company", *self.BITMAP_COLUMNS]}
+        self.options = {column: sorted(values.categories) for column, values in categories.items()}
+        self.bitmaps = {}
+        for column in self.BITMAP_COLUMNS:
+            codes = categories[column].codes
+            self.bitmaps[column] = {
+                value: codes == code
+                for code, value in enumerate(categories[column].categories)
+            }
+        self.company_categories = categories["company"].categories
+        self.company_codes = categories["company"].codes
+        # Lower-cased search keys per row
+        self.company_lower = df["company"].str.lower().to_numpy(dtype=str)
+        self.isin_lower = df["isin"].str.lower().to_numpy(dtype=str)
+        # Row positions in case-insensitive company order
+        self.order = np.argsort(self.company_lower, kind="stable")
+
+    def __len__(self) -> int:
+        return self.table.num_rows
+
+    def rows(self, positions: np.ndarray) -> pd.DataFrame:
+        """ The rows at `positions` as a DataFrame """
+        return self.table.take(pa.array(positions, type=pa.int64())).to_pandas()
+
+    def find_isins(self, isins) -> np.ndarray:
+        """ Positions of the rows with any of `isins`, in case-insensitive company order """
+        mask = pc.is_in(self.table["isin"], value_set=pa.array(list(isins), type=pa.string()))
+        mask = mask.to_numpy(zero_copy_only=False)
+        return self.order[mask[self.order]]
+
+    @tracer.traced("filters")
+    def filter(self, countries: list = None, sectors: list = None, companies: list = None) -> np.ndarray:
+        """
+        Return the positions of the rows matching all filters, in case-insensitive
+        company order. `None` leaves a filter open, a list keeps the rows
+        matching any of its values.
+        """
+        mask = np.ones(len(self), dtype=bool)
+
+        for column, values in (("country", countries), ("sector", sectors)):
+            if values is None:
+                continue
+            column_mask = np.zeros(len(self), dtype=bool)
+            for value in values:
+                if value in self.bitmaps[column]:
+                    column_mask |= self.bitmaps[column][value]
+            mask &= column_mask
+
+        if companies is not None:
+            selected = np.zeros(len(self.options["company"]) + 1, dtype=bool)
+            selected[self.company_categories.get_indexer(companies)] = True
+            selected[-1] = False  # get_indexer marks unknown companies as -1
+            mask &= selected[self.company_codes]
+
+        return self.order[mask[self.order]]
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """ Divide each row by its maximum (ignoring NaN); rows whose maximum is 0 become 0 """
+    row_max = np.where(np.isnan(matrix), -np.inf, matrix).max(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(row_max > 0, matrix / row_max, 0.0)
+
+
+def build_heatmap_table(filters: FilterIndex, heatmap: pd.DataFrame) -> pd.DataFrame:
+    """
+    Prebuilt plotting table of the heatmap for one archive version.
+
+    One row per report and standard (sorted by sector) with categorical
+    `standard`/`standard2`, the raw and IG-3 scaled hits and their
+    normalization by the report's maximum. `row` is the position of the
+    report in `filters.table`, so a filter result selects its cells directly.
+    """
+    mapper = define_standard_info_mapper()
+    rows = pd.Index(filters.labels).get_indexer(heatmap["row"])
+    table = heatmap.loc[rows >= 0].drop(columns=["isin"]).assign(row=rows[rows >= 0])
+
+    # Scale and normalize on a (reports x standards) matrix instead of per company groups
+    codes = pd.Categorical(table["standard"], categories=mapper["standard"]).codes
+    reports, report_rows = np.unique(table["row"].to_numpy(), return_inverse=True)
+    hits = np.full((len(reports), len(mapper)), np.nan)
+    hits[report_rows, codes] = table["hits"].to_numpy()
+    hits_scaled = hits / mapper["ig3_dp"].to_numpy()
+
+    cells = (report_rows, codes)
+    return (
+        table
+        .assign(
+            standard=pd.Categorical.from_codes(codes, categories=mapper["standard"].str.upper()),
+            standard2=pd.Categorical.from_codes(codes, categories=mapper["standard2"]),
+            hits_scaled=hits_scaled[cells],
+            norm_hits=_normalize_rows(hits)[cells],
+            norm_hits_scaled=_normalize_rows(hits_scaled)[cells],
+            )
+        .reset_index(drop=True)
+    )
+
+
+@tracer.traced("heatmap.select")
+def select_heatmap(heatmap_table: pd.DataFrame, rows: np.ndarray, scale_by_dp: bool = False) -> pd.DataFrame:
+    """ Cells of the heatmap for the filtered report positions `rows`, ready for `plot_heatmap` """
+    selected = np.zeros(heatmap_table["row"].max() + 1 if len(heatmap_table) else 0, dtype=bool)
+    selected[rows[rows < len(selected)]] = True
+    cells = heatmap_table.take(np.flatnonzero(selected[heatmap_table["row"].to_numpy()]))
+    if scale_by_dp:
+        return cells.assign(hits=cells["hits_scaled"], norm_hits=cells["norm_hits_scaled"])
+    return cells
+
+
+REPORT_TABLE_COLUMNS = ["company", "isin", "link", "country", "sector", "industry", "publication date", "pages PDF", "auditor"]
+
+
+def build_report_table(filters: FilterIndex) -> pa.Table:
+    """ The report list: a zero-copy view of the columns of `filters.table` shown in the app """
+    return filters.table.select(REPORT_TABLE_COLUMNS)
+
+
+def select_reports(archive: dict, rows: np.ndarray) -> pa.Table:
+    """ Rows of the shared report table at the filtered positions `rows`, for st.dataframe """
+    return archive["reports"].take(pa.array(rows, type=pa.int64()))
+
+
+REPORT_PAGE_SIZES = (25, 50, 100)
+
+
+def search_reports(filters: FilterIndex, rows: np.ndarray, query: str) -> np.ndarray:
+    """ The positions in `rows` whose company name or ISIN contains `query` (case-insensitive) """
+    query = (query or "").strip().lower()
+    if not query:
+        return rows
+    mask = (np.char.find(filters.company_lower[rows], query) >= 0) | (np.char.find(filters.isin_lower[rows], query) >= 0)
+    return rows[mask]
+
+
+def page_reports(archive: dict, rows: np.ndarray, selected_isins: set, columns: list) -> pd.DataFrame:
+    """
+    One page of the report list (`rows` are its positions) with only `isin`
+    and `columns`, plus a leading `selected` column from the ISINs in
+    `selected_isins`, for st.data_editor.
+    """
+    page = select_reports(archive, rows).select(["isin", *columns]).to_pandas()
+    page.insert(0, "selected", page["isin"].isin(selected_isins))
+    return page
+
+
+def _freeze(*arrays) -> None:
+    for array in arrays:
+        array.flags.writeable = False
+
+
+def _publish_archive(df: pd.DataFrame, heatmap: pd.DataFrame) -> None:
+    """
+    Build the derived structures of a new archive version and swap it in.
+
+    A version is built once per process and shared by all sessions, which only
+    keep row positions into it; its arrays are made read-only.
+    """
+    current = _archive["current"]
+    with tracer.span("archive.publish"):
+        filters = FilterIndex(df)
+        _freeze(filters.order, filters.company_codes, filters.company_lower, filters.isin_lower, *(
+            bitmap for bitmaps in filters.bitmaps.values() for bitmap in bitmaps.values()
+        ))
+        archive = {
+            "version": current["version"] + 1 if current is not None else 1,
+            "df": df,
+            "heatmap": heatmap,
+            "filters": filters,
+            "heatmap_table": build_heatmap_table(filters, heatmap),
+            "reports": build_report_table(filters),
+        }
+    with _archive_lock:
+        _archive["current"] = archive
+
+
+def _load_archive_snapshot() -> None:
+    """ Publish the Parquet snapshot of the last run, if there is one """
+    with _archive_refresh_lock:
+        if _archive["current"] is not None or not os.path.exists(ARCHIVE_SNAPSHOT_PATH):
+            return
+
+        try:
+            df = pd.read_parquet(ARCHIVE_SNAPSHOT_PATH)
+            _publish_archive(df, melt_heatmap(df))
+            _archive["fetched_at"] = os.path.getmtime(ARCHIVE_SNAPSHOT_PATH)
+        except Exception as e:
+            print(f"Could not read archive snapshot: {e}")
+            return
+        _refresh_standard_counts()
+
+
+def _refresh_standard_counts() -> None:
+    """
+    Apply the locally stored counts that the current version does not have
+    yet, e.g. from an `ingest_reports` run in another process. The caller
+    holds `_archive_refresh_lock`.
+    """
+    try:
+        if _splice_standard_counts(load_standard_counts()):
+            _write_archive_snapshot(_archive["current"]["df"])
+    except Exception as e:
+        print(f"Could not apply standard counts: {e}")
+
+
+def _refresh_archive(force: bool = True) -> None:
+    """ Fetch the archive from the Google Sheets and swap it in; keep the old one on failure """
+    with _archive_refresh_lock:
+        previous = _archive["current"]
+        if not force and previous is not None:
+            return
+
+        try:
+            result = fetch_data(previous)
+            if result is not previous:
+                written = True
+                if previous is None or result["df"] is not previous["df"]:
+                    _publish_archive(result["df"], result["heatmap"])
+                    written = _write_archive_snapshot(result["df"])
+                # Only once the snapshot is written, so the sheets never run ahead of it
+                if written:
+                    commit_sheet_states(result["sheets"])
+            fetched = True
+        except Exception as e:
+            print(f"Archive refresh failed: {e}")
+            fetched = False
+        _refresh_standard_counts()
+
+        with _archive_lock:
+            if fetched:
+                _archive["fetched_at"] = time.time()
+            _archive["refreshing"] = False
+
+
+@tracer.traced("read_archive")
+def read_archive(ttl: float = ARCHIVE_TTL_SECONDS) -> dict:
+    """
+    Return the current archive version without waiting on the network.
+
+    The result holds the archive DataFrame (`df`), its long-format counts
+    (`heatmap`), the `FilterIndex` (`filters`), the prebuilt plotting table of
+    the heatmap (`heatmap_table`), the Arrow table of the report list
+    (`reports`) and a `version` counter. It is shared by all sessions,
+    replaced as a whole when the archive changes and must not be modified.
+
+    The last good archive is kept in memory and as a Parquet snapshot on disk.
+    Once it is older than `ttl` seconds, a background thread refreshes it
+    (including the standard counts stored locally since the last version)
+    while callers keep getting the current one. Only the very first start (no
+    snapshot on disk yet) has to wait for the download.
+    """
+    if _archive["current"] is None:
+        _load_archive_snapshot()
+
+    with _archive_lock:
+        archive = _archive["current"]
+        if archive is not None and time.time() - _archive["fetched_at"] > ttl and not _archive["refreshing"]:
+            _archive["refreshing"] = True
+            tracer.count("archive.refreshes")
+            threading.Thread(target=_refresh_archive, name="archive-refresh", daemon=True).start()
+
+    if archive is not None:
+        return archive
+
+    # Cold start without a snapshot: block once, concurrent sessions wait on the same fetch
+    _refresh_archive(force=False)
+    if _archive["current"] is None:
+        raise RuntimeError("The archive could not be loaded and no snapshot is available.")
+    return _archive["current"]
+
+
+def read_data(ttl: float = ARCHIVE_TTL_SECONDS) -> pd.DataFrame:
+    """ Return the archive DataFrame without waiting on the network (see `read_archive`) """
+    return read_archive(ttl)["df"]
+
+
 def define_standard_info_mapper():
     return pd.DataFrame(
         {
@@ -70,6 +984,80 @@ def define_standard_info_mapper():
         }
     )
 
+def debug_panel_enabled() -> bool:
+    """ The performance panel shows only with `?debug=<DEBUG_TOKEN>` and a DEBUG_TOKEN secret """
+    try:
+        token = st.secrets.get("DEBUG_TOKEN")
+    except Exception:
+        return False
+    return bool(token) and st.query_params.get("debug") == token
+
+
+def plot_debug_panel() -> None:
+    """ Waterfalls of the recent traces, counters, memory and the exports of the tracer """
+    with st.expander("Performance", expanded=True):
+        traces = list(tracer.history)[::-1]
+        if not traces:
+            st.caption("No traces yet.")
+            return
+
+        trace = st.selectbox(
+            "Run",
+            traces,
+            format_func=lambda t: f"{time.strftime('%H:%M:%S', time.localtime(t['started_at']))} · {t['name']} · {t['seconds'] * 1000:.0f} ms",
+        )
+        spans = (
+            pd.DataFrame(trace["spans"])
+            .assign(
+                start_ms=lambda x: x["offset"] * 1000,
+                end_ms=lambda x: (x["offset"] + x["seconds"]) * 1000,
+                duration_ms=lambda x: x["seconds"] * 1000,
+                label=lambda x: [f"{'  ' * depth}{name}" for depth, name in zip(x["depth"], x["name"])],
+                )
+            .sort_values("start_ms", kind="stable")
+            .reset_index(drop=True)
+            .reset_index(names="order")
+        )
+        waterfall = (
+            alt.Chart(spans)
+            .mark_bar()
+            .encode(
+                x=alt.X("start_ms:Q", title="ms"),
+                x2="end_ms:Q",
+                y=alt.Y("order:O", title=None, axis=alt.Axis(labels=False, ticks=False)),
+                color=alt.Color("depth:O", legend=None),
+                tooltip=["name", "thread", alt.Tooltip("duration_ms:Q", format=".1f"), "error"],
+                )
+            .properties(height=max(len(spans) * 18, 60))
+        )
+        text = waterfall.mark_text(align="left", dx=3).encode(text="label", color=alt.value("black"))
+        st.altair_chart(waterfall + text, use_container_width=True)
+
+        memory_before, memory_after = trace["memory_before"], trace.get("memory_after", {})
+        st.caption(f"RSS {memory_before['rss_bytes'] / 1024 ** 2:.0f} MB → {memory_after.get('rss_bytes', 0) / 1024 ** 2:.0f} MB")
+        for error in trace["errors"]:
+            st.code(error)
+
+        st.dataframe(
+            pd.DataFrame({
+                "calls": pd.Series(tracer.span_calls, dtype=float),
+                "seconds": pd.Series(tracer.span_seconds, dtype=float),
+                })
+            .assign(mean_ms=lambda x: x["seconds"] / x["calls"] * 1000)
+            .sort_values("seconds", ascending=False),
+            use_container_width=True,
+        )
+        st.dataframe(pd.Series(tracer.counters, name="value", dtype=float), use_container_width=True)
+
+        col_jsonl, col_prometheus = st.columns(2)
+        with col_jsonl:
+            if st.button("Export traces (JSONL)"):
+                st.caption(f"Written to {tracer.export_jsonl()}")
+        with col_prometheus:
+            if st.button("Export metrics (Prometheus)"):
+                st.caption(f"Written to {tracer.export_prometheus()}")
+
+
 def plot_ui(which: str, df: pd.DataFrame) -> None:
 
     if which == "bubble-counter":
@@ -114,24 +1102,157 @@ def plot_ui(which: str, df: pd.DataFrame) -> None:
                 Want to make an addition? Feel free to do so [using this Google Sheet](https://docs.google.com/spreadsheets/d/1Nlyf8Yz_9Fst8rEmQc2IMc-DWLF1fpmBTB7n4FlZwxs/edit?gid=1695573594#gid=1695573594) and [follow us on LinkedIn](https://www.linkedin.com/company/sustainability-reporting-navigator/).
                 """)
 
-@st.cache_data
+PDF_CACHE_DIR = os.path.join("data", "pdf-cache")
+PDF_CACHE_MAX_BYTES = 2 * 1024 ** 3
+PDF_CHUNK_SIZE = 1024 ** 2
+
+
+class PDFCache:
+    """
+    Content-addressed on-disk cache of downloaded PDFs.
+
+    Downloads stream in chunks straight to a temporary file while being hashed
+    and are then renamed to `<sha256>.pdf`, so identical files behind several
+    URLs are stored once. `index.json` maps each URL to its blob, least recently
+    used first; blobs are evicted once they exceed `max_bytes`. Concurrent
+    requests for the same URL share one download.
+    """
+
+    def __init__(self, directory: str = PDF_CACHE_DIR, max_bytes: int = PDF_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, "index.json")
+        self.urls = collections.OrderedDict()  # url -> (digest, size)
+        self._lock = threading.Lock()
+        self._downloads = {}  # url -> Future of the running download
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.directory, f"{digest}.pdf")
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        for url, digest, size in entries:
+            if os.path.exists(self._blob_path(digest)):
+                self.urls[url] = (digest, size)
+
+    def _save_index(self):
+        temporary = self.index_path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump([[url, digest, size] for url, (digest, size) in self.urls.items()], f)
+        os.replace(temporary, self.index_path)
+
+    @property
+    def size(self) -> int:
+        """ Bytes on disk (each blob counted once) """
+        return sum(dict(self.urls.values()).values())
+
+    def _evict(self):
+        """ Drop least recently used URLs until the blobs fit the budget """
+        while len(self.urls) > 1 and self.size > self.max_bytes:
+            _, (digest, _) = self.urls.popitem(last=False)
+            if all(d != digest for d, _ in self.urls.values()):
+                try:
+                    os.remove(self._blob_path(digest))
+                except OSError:
+                    pass
+
+    def _download(self, url: str, timeout: float) -> str:
+        digest = hashlib.sha256()
+        size = 0
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        download_span = tracer.begin("pdf.download", url=url)
+        try:
+            with os.fdopen(fd, "wb") as f, get_http_session().get(url, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=PDF_CHUNK_SIZE):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            path = self._blob_path(digest.hexdigest())
+            os.replace(temporary, path)
+        except BaseException as e:
+            tracer.end(download_span, error=e)
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        tracer.end(download_span)
+        tracer.count("pdf.download_bytes", size)
+
+        with self._lock:
+            self.urls[url] = (digest.hexdigest(), size)
+            self._evict()
+            self._save_index()
+        return path
+
+    def get(self, url: str, timeout: float = 60) -> str:
+        """ Path of the cached PDF behind `url`, downloading it at most once at a time """
+        with self._lock:
+            if url in self.urls:
+                digest, _ = self.urls[url]
+                if os.path.exists(self._blob_path(digest)):
+                    self.urls.move_to_end(url)
+                    return self._blob_path(digest)
+                del self.urls[url]
+            download = self._downloads.get(url)
+            leader = download is None
+            if leader:
+                download = self._downloads[url] = Future()
+
+        if not leader:
+            return download.result()
+        try:
+            path = self._download(url, timeout)
+            download.set_result(path)
+            return path
+        except BaseException as e:
+            download.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._downloads[url]
+
+    def open(self, url: str, timeout: float = 60) -> mmap.mmap:
+        """ Read-only memory map of the PDF behind `url` """
+        with open(self.get(url, timeout), "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+@st.cache_resource
+def get_pdf_cache() -> PDFCache:
+    return PDFCache()
+
+
+def fetch_pdf(url: str, timeout: float = 60) -> pathlib.Path:
+    """ Local path of the PDF behind a URL, via the disk cache (no Streamlit calls, safe in threads) """
+    return pathlib.Path(get_pdf_cache().get(url, timeout=timeout))
+
+
 def download_pdf(url):
-    """Fetch the PDF from a URL and return it as bytes."""
+    """Fetch the PDF from a URL and return the path of its cached copy."""
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.content
+        return fetch_pdf(url)
     except requests.exceptions.RequestException as e:
         st.error(f"Failed to load PDF: {e}")
         return None
 
 
-def plot_heatmap(filtered_melted_df, split_view):
+HEATMAP_MAX_COMPANIES = 250
+HEATMAP_SPEC_CACHE_SIZE = 64
+HEATMAP_SPLIT_COLUMNS = {"by sector": "sector", "by country": "country", "by auditor": "auditor"}
 
-    filtered_melted_df["norm_hits"] = (
-                    filtered_melted_df.groupby("company")["hits"]
-                    .transform(lambda x: x / x.max() if x.max() != 0 else 0)
-                )
+# Serialized heatmap specs by (archive version, filters, split view, scaling), least recently used first
+_heatmap_specs = collections.OrderedDict()
+_heatmap_specs_lock = threading.Lock()
+
+
+def build_heatmap_chart(filtered_melted_df, split_view) -> alt.Chart:
+    """ Heatmap of the cells selected by `select_heatmap`, which already carry `norm_hits` """
     color_field = "norm_hits:Q"
     color_scale = alt.Scale(
         domain=[0, 0.5, 1],
@@ -185,7 +1306,7 @@ def plot_heatmap(filtered_melted_df, split_view):
             )
         )
         
-        return st.altair_chart(heatmap_faceted)
+        return heatmap_faceted
 
     else:
 
@@ -218,40 +1339,263 @@ def plot_heatmap(filtered_melted_df, split_view):
             .properties(width = 400)
         )
         
-        return st.altair_chart(heatmap)
+        return heatmap
 
-@st.cache_data
-def get_all_reports() -> pd.DataFrame:
-    """ Get all available reports from the Sunhat API """
-    all_reports = []
-    currentPage = 1
-    pageSize = 50
 
-    print("Fetching reports from Sunhat API...")
+def build_aggregated_heatmap_chart(filtered_melted_df, split_view) -> alt.Chart:
+    """
+    Heatmap of the mean (normalized) counts per sector, country or auditor and
+    standard, for selections too large to draw one row per company.
+    """
+    group = HEATMAP_SPLIT_COLUMNS.get(split_view, "sector")
+    aggregated = (
+        filtered_melted_df
+        .groupby([group, "standard", "standard2"], observed=True)
+        .agg(
+            hits=("hits", "mean"),
+            norm_hits=("norm_hits", "mean"),
+            companies=("row", "nunique"),
+            )
+        .reset_index()
+    )
+    color_scale = alt.Scale(
+        domain=[0, 0.5, 1],
+        range=['#ffffff', '#a0a0ff', '#4200ff']
+    )
 
-    while True:
-        response = requests.get(
-            "https://sunhat-api.onrender.com/sustainability-reports/reports",
-            headers={"Content-Type": "application/json"},
-            params={"pageSize": pageSize, "page": currentPage},
-        ).json()
+    return (
+        alt.Chart(aggregated)
+        .mark_rect(stroke="lightgray", filled=True)
+        .encode(
+            x=alt.X(
+                "standard",
+                title=None,
+                axis=alt.Axis(orient="top", labelAngle=0),
+                sort=[
+                    'E1', 'E2', 'E3', 'E4', 'E5',
+                    'S1', 'S2', 'S3', 'S4',
+                    'G1'
+                ]
+            ),
+            y=alt.Y(group, title=None),
+            color=alt.condition(
+                alt.datum.norm_hits == 0,
+                alt.value('#ffffc5'),
+                alt.Color('norm_hits:Q', scale=color_scale, legend=None)
+                ),
+            tooltip=[
+                alt.Tooltip(group, title=group.capitalize()),
+                alt.Tooltip("standard2", title="ESRS topic"),
+                alt.Tooltip("hits", title="Referenced (mean)", format=".1f"),
+                alt.Tooltip("companies", title="Companies", format="d"),
+            ]
+        )
+        .properties(width = 400)
+    )
 
-        all_reports.extend(response.get("data"))
-        
-        pagination = response.get("pagination")
-        if pagination.get("nextPage") is None:
-            break
 
-        currentPage += 1 
+def plot_heatmap(filtered_melted_df, split_view, cache_key=None):
+    """
+    Plot the heatmap of the selected cells.
 
-    return (
-        pd.DataFrame(all_reports)
-        .assign(
-            companyName=lambda x: x["company"].apply(lambda y: y["name"]),
-            isin=lambda x: x["company"].apply(lambda y: y["isin"])
+    Selections of more than `HEATMAP_MAX_COMPANIES` companies are collapsed to
+    means per sector/country/auditor. The serialized Vega-Lite spec (data
+    included) is cached under `cache_key`, e.g. (archive version, filters,
+    split view, scaling), so an unchanged view is not built again.
+    """
+    with _heatmap_specs_lock:
+        cached = _heatmap_specs.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            _heatmap_specs.move_to_end(cache_key)
+
+    tracer.count("heatmap.spec_cache_misses" if cached is None else "heatmap.spec_cache_hits")
+    if cached is None:
+        heatmap_span = tracer.begin("heatmap.spec", cells=len(filtered_melted_df))
+        aggregated = filtered_melted_df["row"].nunique() > HEATMAP_MAX_COMPANIES
+        if aggregated:
+            chart = build_aggregated_heatmap_chart(filtered_melted_df, split_view)
+        else:
+            chart = build_heatmap_chart(filtered_melted_df, split_view)
+
+        with alt.data_transformers.enable("default", max_rows=None):
+            spec = chart.to_dict()
+        # Serialize the data the way st.vega_lite_chart would, but only once
+        spec["datasets"] = {
+            name: arrow_ipc_bytes(to_arrow_table(pd.DataFrame(values)))
+            for name, values in spec.get("datasets", {}).items()
+        }
+        cached = {"spec": spec, "aggregated": aggregated}
+        tracer.end(heatmap_span)
+
+        if cache_key is not None:
+            with _heatmap_specs_lock:
+                _heatmap_specs[cache_key] = cached
+                while len(_heatmap_specs) > HEATMAP_SPEC_CACHE_SIZE:
+                    _heatmap_specs.popitem(last=False)
+
+    if cached["aggregated"]:
+        st.caption(f":gray[More than {HEATMAP_MAX_COMPANIES} companies selected, showing the mean per {HEATMAP_SPLIT_COLUMNS.get(split_view, 'sector')}. Narrow the filters to see single companies.]")
+
+    # st.vega_lite_chart moves the datasets out of the spec, so hand it a copy
+    with tracer.span("heatmap.render"):
+        return st.vega_lite_chart(dict(cached["spec"]))
+
+
+SUNHAT_REPORTS_URL = "https://sunhat-api.onrender.com/sustainability-reports/reports"
+SUNHAT_PAGE_SIZE = 50
+SUNHAT_CONCURRENCY = 8
+SUNHAT_RETRIES = 3
+SUNHAT_TIMEOUT_SECONDS = 20
+REPORTS_STORE_PATH = os.path.join("data", "reports.parquet")
+REPORTS_COLUMNS = ['id', 'companyName', 'isin', 'link']
+
+
+def fetch_reports_page(page: int, page_size: int = SUNHAT_PAGE_SIZE, etag: str = None) -> dict:
+    """
+    One page of the Sunhat reports endpoint over the shared session, retried
+    with exponential backoff on network errors, 429 and 5xx. Returns
+    `{"status", "etag", "body"}`; `body` is None when the server answers 304
+    to the ETag of the last sync.
+    """
+    headers = {"Content-Type": "application/json"}
+    if etag:
+        headers["If-None-Match"] = etag
+    for attempt in range(SUNHAT_RETRIES + 1):
+        try:
+            response = get_http_session().get(
+                SUNHAT_REPORTS_URL,
+                headers=headers,
+                params={"pageSize": page_size, "page": page},
+                timeout=SUNHAT_TIMEOUT_SECONDS,
             )
-        .loc[:, ['id', 'companyName', 'isin', 'link']]
-        )
+            if response.status_code == 429 or response.status_code >= 500:
+                response.raise_for_status()
+            if response.status_code == 304:
+                return {"status": 304, "etag": etag, "body": None}
+            response.raise_for_status()
+            return {"status": response.status_code, "etag": response.headers.get("ETag"), "body": response.json()}
+        except requests.exceptions.RequestException:
+            if attempt == SUNHAT_RETRIES:
+                raise
+            time.sleep(0.5 * 2 ** attempt)
+
+
+def flatten_reports(records: list, page: int) -> pd.DataFrame:
+    """ Report records with their nested company flattened, tagged with their page and a content hash """
+    if not records:
+        return pd.DataFrame(columns=[*REPORTS_COLUMNS, "page", "etag", "hash"])
+    df = (
+        pd.json_normalize(records)
+        .rename(columns={"company.name": "companyName", "company.isin": "isin"})
+        .reindex(columns=REPORTS_COLUMNS)
+    )
+    return df.assign(page=page, hash=pd.util.hash_pandas_object(df, index=False).to_numpy())
+
+
+def _total_pages(pagination: dict, page_size: int) -> int:
+    """ Number of pages from the pagination block of page 1, or None if it does not say """
+    for key in ("totalPages", "lastPage", "pageCount"):
+        if pagination.get(key) is not None:
+            return int(pagination[key])
+    for key in ("total", "totalItems", "totalCount", "count"):
+        if pagination.get(key) is not None:
+            return max(1, -(-int(pagination[key]) // page_size))
+    return None
+
+
+def load_reports_store() -> pd.DataFrame:
+    try:
+        return pd.read_parquet(REPORTS_STORE_PATH)
+    except (OSError, ValueError):
+        return pd.DataFrame(columns=[*REPORTS_COLUMNS, "page", "etag", "hash"])
+
+
+def sync_reports(page_size: int = SUNHAT_PAGE_SIZE) -> dict:
+    """
+    Sync the local store of Sunhat reports with the API.
+
+    Page 1 gives the pagination; the remaining pages are fetched concurrently
+    with the ETags of the last sync, so unchanged pages come back as 304 and
+    are taken from the store. A page that still fails after retries also
+    keeps its stored rows, and removals are only applied when every page
+    arrived. Returns the synced `df` and the `added`, `changed` and `removed`
+    report ids.
+    """
+    store = load_reports_store()
+    stored_pages = {page: rows for page, rows in store.groupby("page")}
+    page_etags = {page: rows["etag"].iloc[0] for page, rows in stored_pages.items()}
+
+    last_stored_page = max(stored_pages, default=None)
+
+    def fetch(page: int) -> dict:
+        # The last page is always read in full, it tells whether more pages follow
+        return fetch_reports_page(page, page_size, etag=page_etags.get(page) if page != last_stored_page else None)
+
+    results = {1: fetch(1)}
+    first = results[1]["body"]
+    total_pages = _total_pages(first.get("pagination", {}), page_size) if first is not None else None
+    if total_pages is None:
+        # Without a page count, the pages known from the last sync; nextPage covers the rest
+        total_pages = max(stored_pages, default=1)
+    if total_pages > 1:
+        with ThreadPoolExecutor(max_workers=SUNHAT_CONCURRENCY) as executor:
+            futures = {page: executor.submit(fetch, page) for page in range(2, total_pages + 1)}
+            for page, future in futures.items():
+                try:
+                    results[page] = future.result()
+                except requests.exceptions.RequestException as e:
+                    print(f"Could not fetch page {page} of the Sunhat reports: {e}")
+                    results[page] = None
+
+    # Pages added since page 1 was read
+    page = max(results)
+    while results[page] is not None and results[page]["body"] is not None \
+            and results[page]["body"].get("pagination", {}).get("nextPage") is not None:
+        page += 1
+        results[page] = fetch(page)
+
+    complete = all(result is not None for result in results.values())
+    frames = []
+    for page, result in sorted(results.items()):
+        if result is None or result["body"] is None:
+            frames.append(stored_pages.get(page, store.iloc[:0]))
+        else:
+            frames.append(flatten_reports(result["body"].get("data") or [], page).assign(etag=result["etag"]))
+    if not complete:
+        frames.extend(rows for page, rows in stored_pages.items() if page not in results)
+    df = (
+        pd.concat(frames, ignore_index=True)
+        .drop_duplicates(subset=["id"])
+        .astype({"page": "int64", "hash": "uint64"})
+        .reset_index(drop=True)
+    )
+
+    old_hashes = dict(zip(store["id"], store["hash"]))
+    new_hashes = dict(zip(df["id"], df["hash"]))
+    added = [report_id for report_id in new_hashes if report_id not in old_hashes]
+    changed = [report_id for report_id in new_hashes if report_id in old_hashes and old_hashes[report_id] != new_hashes[report_id]]
+    removed = [report_id for report_id in old_hashes if report_id not in new_hashes] if complete else []
+
+    if added or changed or removed or not df["etag"].equals(store["etag"]):
+        os.makedirs(os.path.dirname(REPORTS_STORE_PATH), exist_ok=True)
+        df.to_parquet(REPORTS_STORE_PATH + ".tmp", index=False)
+        os.replace(REPORTS_STORE_PATH + ".tmp", REPORTS_STORE_PATH)
+    print(f"Synced Sunhat reports: {len(added)} added, {len(changed)} changed, {len(removed)} removed")
+    return {"df": df, "added": added, "changed": changed, "removed": removed}
+
+
+@st.cache_data(ttl=ARCHIVE_TTL_SECONDS)
+def get_all_reports() -> pd.DataFrame:
+    """
+    Get all available reports from the Sunhat API (the local store if the API
+    is unreachable), synced again on the schedule of the archive refresh
+    """
+    try:
+        df = sync_reports()["df"]
+    except requests.exceptions.RequestException as e:
+        print(f"Could not sync reports from the Sunhat API: {e}")
+        df = load_reports_store()
+    return df.loc[:, REPORTS_COLUMNS].reset_index(drop=True)
 
 
 def define_popover_title(query_companies_df) -> str:
@@ -259,14 +1603,16 @@ def define_popover_title(query_companies_df) -> str:
     """ Define the title for the popover """
     if len(query_companies_names) == 0:
         return "Select a company from the table by selecting the box to the left of the name"
-    elif len(query_companies_names) > 1:
-        return f"You can only select one company currently ({len(query_companies_names)} selected)"
+    elif len(query_companies_names) > MAX_QUERY_REPORTS:
+        return f"You can select up to {MAX_QUERY_REPORTS} companies ({len(query_companies_names)} selected)"
     elif len(query_companies_names) == 1:
         return f"Search in the report of {query_companies_names[0]}"
-    # elif len(query_companies_names) == 2:
-    #     return f"Search in the report of {query_companies_names[0]} and {query_companies_names[1]}"
-    # elif len(query_companies_names) > 1:
-    #     return f"Search in the reports of {', '.join(query_companies_names[:-1])}, and {query_companies_names[-1]}"
+    elif len(query_companies_names) == 2:
+        return f"Search in the reports of {query_companies_names[0]} and {query_companies_names[1]}"
+    elif len(query_companies_names) > 3:
+        return f"Search in the reports of {', '.join(query_companies_names[:2])}, and {len(query_companies_names) - 2} more"
+    elif len(query_companies_names) > 1:
+        return f"Search in the reports of {', '.join(query_companies_names[:-1])}, and {query_companies_names[-1]}"
 
 
 def query_single_report(reportId, prompt, numberOfReturnedChunks=5):
@@ -302,11 +1648,607 @@ def summarize_text_bygpt(client, queryText, relevantChunkTexts):
         )
 
 
-def display_annotated_pdf(query_report_link, pages_to_render):
+ANSWER_CACHE_SIZE = 512
+ANSWER_CACHE_TTL_SECONDS = 24 * 60 * 60
+ANSWER_SIMILARITY_THRESHOLD = 0.95
+
+
+def pages_fingerprint(pages: list) -> str:
+    """ Digest of the ids and contents of retrieved pages; changes when the pages change """
+    digest = hashlib.sha256()
+    for page in pages:
+        digest.update(f"{page.get('id', page.get('page'))}\0{page.get('content', '')}\0".encode())
+    return digest.hexdigest()
+
+
+class AnswerCache:
+    """
+    GPT answers by (document_id, retrieved pages), matched on the prompt.
+
+    A prompt hits when its normalized text equals a cached one or when its
+    embedding has a cosine similarity of at least `threshold` with the cached
+    prompt's, so paraphrases reuse the answer. Entries expire after `ttl`
+    seconds and the least recently used are evicted beyond `size`.
+    """
+
+    def __init__(self, size: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL_SECONDS,
+                 threshold: float = ANSWER_SIMILARITY_THRESHOLD):
+        self.size, self.ttl, self.threshold = size, ttl, threshold
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, document_id: str, pages_key: str, prompt: str, prompt_embedding=None) -> str:
+        text = EmbeddingService.normalize(prompt).casefold()
+        query = None
+        if prompt_embedding is not None:
+            query = normalize_embeddings(np.asarray(prompt_embedding, dtype=np.float32)[None, :])[0]
+
+        with self._lock:
+            now = time.time()
+            for key, entry in list(self._entries.items()):
+                if now - entry["created_at"] > self.ttl:
+                    del self._entries[key]
+                    continue
+                if key[:2] != (document_id, pages_key):
+                    continue
+                if entry["text"] == text or (
+                    query is not None and entry["embedding"] is not None
+                    and float(entry["embedding"] @ query) >= self.threshold
+                ):
+                    self._entries.move_to_end(key)
+                    return entry["answer"]
+        return None
+
+    def put(self, document_id: str, pages_key: str, prompt: str, answer: str, prompt_embedding=None) -> None:
+        text = EmbeddingService.normalize(prompt).casefold()
+        embedding = None
+        if prompt_embedding is not None:
+            embedding = normalize_embeddings(np.asarray(prompt_embedding, dtype=np.float32)[None, :])[0]
+
+        with self._lock:
+            self._entries[(document_id, pages_key, text)] = {
+                "text": text, "embedding": embedding, "answer": answer, "created_at": time.time(),
+            }
+            self._entries.move_to_end((document_id, pages_key, text))
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, document_id: str) -> None:
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == document_id]:
+                del self._entries[key]
+
+
+@st.cache_resource
+def get_answer_cache() -> AnswerCache:
+    return AnswerCache()
+
+
+def invalidate_document(document_id: str) -> None:
+    """
+    Forget everything cached in memory for a document whose pages changed. The
+    stored embeddings are replaced by `get_embedding_index` once it sees pages
+    that no longer match them.
+    """
+    get_answer_cache().invalidate(document_id)
+    with _embedding_indexes_lock:
+        _embedding_indexes.pop(document_id, None)
+    with _bm25_indexes_lock:
+        _bm25_indexes.pop(document_id, None)
+
+
+def replay_answer(answer: str):
+    """ Stream a cached answer word by word, like a live response, for st.write_stream """
+    for word in re.findall(r"\S+\s*|\s+", answer):
+        yield word
+
+
+def summarize_text_cached(client, document_id: str, prompt: str, pages: list, prompt_embedding=None):
+    """
+    Stream the answer to `prompt` from the retrieved `pages` for st.write_stream.
+
+    Replays the cached answer of the same or a paraphrased question about the
+    same pages of the document; otherwise streams `summarize_text_bygpt` and
+    caches the answer once it is complete. Empty answers and answers that did
+    not finish (cut off, or the stream closed early) are not cached.
+    """
+    cache = get_answer_cache()
+    pages_key = pages_fingerprint(pages)
+    answer = cache.get(document_id, pages_key, prompt, prompt_embedding)
+    tracer.count("answer_cache.hits" if answer is not None else "answer_cache.misses")
+    if answer is not None:
+        return replay_answer(answer)
+
+    # The request is sent here, in the caller's trace; the answer then streams
+    # in whichever thread reads it, which may open its own spans between chunks
+    started = time.perf_counter()
+    with tracer.span("gpt", document_id=document_id):
+        chunks = summarize_text_bygpt(client, prompt, "\n".join(page["content"] for page in pages))
+
+    def stream():
+        parts = []
+        finish_reason = None
+        try:
+            for chunk in chunks:
+                if not chunk.choices:
+                    continue
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if not parts:
+                        tracer.count("gpt.first_token_seconds", time.perf_counter() - started)
+                        tracer.count("gpt.answers")
+                    parts.append(delta)
+                    yield delta
+        finally:
+            tracer.record("gpt.stream", time.perf_counter() - started)
+        if parts and finish_reason == "stop":
+            cache.put(document_id, pages_key, prompt, "".join(parts), prompt_embedding)
+
+    return stream()
+
+
+MAX_QUERY_REPORTS = 50
+QUERY_CONCURRENCY = 8
+REPORT_PDF_URL = "https://gbixxtefgqebkaviusss.supabase.co/storage/v1/object/public/document-pdfs/{document_id}.pdf"
+
+
+def fetch_document_pages(supabase, document_id: str) -> list:
+    """
+    All pages of a document from Supabase.
+
+    When the embeddings of the document are stored locally, only the page
+    texts (`PAGE_TEXT_COLUMNS`) are fetched and compared with the stored pages.
+    The full pages, with their embeddings, are only fetched when nothing is
+    stored or the stored pages are out of date.
+    """
+    def select(columns):
+        return (
+            supabase.table("pages")
+            .select(columns)
+            .eq("document_id", document_id)
+            .execute()
+        ).data
+
+    index = get_embedding_index(document_id)
+    if index is not None:
+        pages = select(PAGE_TEXT_COLUMNS)
+        if not pages or document_fingerprint(pages) == index.fingerprint:
+            return pages
+    return select("*")
+
+
+def translate_if_needed(client, prompt: str) -> str:
+    """
+    The prompt for the LLM: non-English prompts are translated (keeping the
+    original), and the original is used as is if the translation fails.
+    """
+    try:
+        if langdetect.detect(prompt) == "en":
+            return prompt
+        return translate_prompt(client, prompt) + f" (original prompt: {prompt})"
+    except Exception as e:
+        print(f"Could not translate prompt: {e}")
+        return prompt
+
+
+@st.cache_resource
+def get_query_executor() -> ThreadPoolExecutor:
+    """ Thread pool of the page fetches of the pre-retrieval stage, shared by all sessions """
+    return ThreadPoolExecutor(max_workers=4 * QUERY_CONCURRENCY, thread_name_prefix="query")
+
+
+@st.cache_resource
+def get_prompt_executor() -> ThreadPoolExecutor:
+    """
+    Thread pool of the prompt embedding and translation, shared by all
+    sessions, so that they never queue behind the page fetches
+    """
+    return ThreadPoolExecutor(max_workers=QUERY_CONCURRENCY, thread_name_prefix="prompt")
+
+
+def prepare_query(supabase, openai_client, prompt: str, document_ids: list) -> dict:
+    """
+    Start the pre-retrieval stage of a query and return its futures.
+
+    Everything that does not depend on anything else starts at once: the page
+    fetch of every document (`pages`), the embedding of the original prompt
+    (`embedding`) and the language detection and translation of the prompt
+    for the LLM (`prompt`). The log entries are only queued. Retrieval only joins
+    the pages and the embedding, which the multilingual embedding model does
+    not need translated; only the summarization waits for the translation.
+    The prompt work runs on its own executor, so that it is not held up by
+    the page fetches of up to `MAX_QUERY_REPORTS` documents.
+    """
+    for document_id in document_ids:
+        log_query_to_supabase(supabase, document_id, prompt)
+
+    prompt_executor = get_prompt_executor()
+    embedding_service = get_embedding_service()
+    embedding = prompt_executor.submit(embedding_service.embed, prompt)
+    translation = prompt_executor.submit(translate_if_needed, openai_client, prompt)
+
+    executor = get_query_executor()
+    return {
+        "pages": {
+            document_id: executor.submit(fetch_document_pages, supabase, document_id)
+            for document_id in document_ids
+        },
+        "embedding": embedding,
+        "prompt": translation,
+        "original_prompt": prompt,
+    }
+
+
+@tracer.traced("answer_report")
+def answer_report(openai_client, document: dict, query: dict, top_pages: int = 5, stream: bool = False) -> dict:
+    """
+    Retrieve the relevant pages of one report, answer the prompt from them and
+    prepare the PDF slice of the first three (`pages_to_render`), joining the
+    futures of `prepare_query` where needed. Must not call Streamlit elements,
+    as it usually runs in a worker thread; the caller renders the result.
+
+    With `stream`, the answer is returned unread as the stream of
+    `summarize_text_cached`, so the caller can show it token by token, and
+    the slice is left to `display_annotated_pdf`. If the PDF cannot be
+    sliced, the answer is kept and there are no `pages_to_render`.
+    """
+    document_id = document["document_id"]
+    pages = query["pages"][document_id].result()
+    try:
+        prompt_embedding = query["embedding"].result()
+    except Exception as e:
+        # get_most_similar_pages embeds the prompt again itself
+        print(f"Could not embed prompt: {e}")
+        prompt_embedding = None
+
+    result = {"document": document, "pages": [], "answer": None, "pages_to_render": []}
+    result["pages"] = get_most_similar_pages(
+        query["original_prompt"], pages, top_pages=top_pages,
+        document_id=document_id, prompt_embedding=prompt_embedding,
+    )
+    if not result["pages"]:
+        return result
+
+    answer = summarize_text_cached(
+        openai_client, document_id, query["prompt"].result(), result["pages"],
+        prompt_embedding=prompt_embedding,
+    )
+    result["answer"] = answer if stream else "".join(answer)
+
+    start_page = int(literal_eval(document["pages"])[0])
+    result["pages_to_render"] = [int(page["page"]) - start_page + 1 for page in result["pages"]][:3]
+    if not stream:
+        try:
+            get_pdf_slice(REPORT_PDF_URL.format(document_id=document_id), result["pages_to_render"])
+        except Exception as e:
+            print(f"Could not slice the PDF of {document_id}: {e}")
+            tracer.record_error(e)
+            result["pages_to_render"] = []
+    return result
+
+
+def run_concurrently(function, items: list, max_workers: int = QUERY_CONCURRENCY):
+    """
+    Call `function(item)` for all items on a bounded thread pool and yield
+    `(item, result, error)` in the order the calls finish. Closing the
+    generator early (e.g. when a rerun interrupts the script) cancels the
+    calls that have not started instead of waiting for them.
+    """
+    if not items:
+        return
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(items)))
+    try:
+        function = tracer.bind(function)
+        futures = {executor.submit(function, item): item for item in items}
+        for future in as_completed(futures):
+            error = future.exception()
+            yield futures[future], None if error else future.result(), error
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def answer_reports(openai_client, documents: list, query: dict):
+    """
+    `answer_report` for all documents, yielding `(document, result, error)` in
+    the order they finish (see `run_concurrently`), with the answers as
+    streams for st.write_stream. A single report is answered in the calling
+    thread and its answer streams live from GPT; the answers of several
+    reports are complete when yielded and replayed.
+    """
+    if len(documents) == 1:
+        try:
+            result = answer_report(openai_client, documents[0], query, stream=True)
+        except Exception as e:
+            yield documents[0], None, e
+        else:
+            yield documents[0], result, None
+        return
+
+    for document, result, error in run_concurrently(
+        lambda document: answer_report(openai_client, document, query), documents,
+    ):
+        if result is not None and result["answer"] is not None:
+            result["answer"] = replay_answer(result["answer"])
+        yield document, result, error
+
+
+PDF_RANGE_BLOCK_SIZE = 256 * 1024
+PDF_RANGE_CACHE_BYTES = 256 * 1024 ** 2
+# Beyond this share of the file, ranged reads give way to one full download
+PDF_RANGE_MAX_FRACTION = 0.25
+CONTENT_RANGE_PATTERN = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+# Fetched blocks of remote PDFs by (url, validator, block number), least recently used first
+_range_blocks = collections.OrderedDict()
+_range_blocks_lock = threading.Lock()
+_range_blocks_size = 0
+
+
+class RangesNotSupported(Exception):
+    pass
+
+
+class RangeBudgetExceeded(Exception):
+    pass
+
+
+class HTTPRangeFile(io.RawIOBase):
+    """
+    Read-only, seekable file over a remote file, fetched with HTTP Range
+    requests in blocks of `block_size` (adjacent missing blocks in one request).
+    Blocks are shared by all readers through a byte-budgeted LRU, so pypdf only
+    ever downloads the trailer, the xref and the objects it actually resolves.
+    Later requests carry the first response's validator in `If-Range`, so a
+    file replaced in the meantime is answered in full instead of in pieces.
+    Raises RangesNotSupported if the server answers a range request with the
+    whole file, and RangeBudgetExceeded once a read would take the bytes
+    fetched by this file beyond `max_fraction` of the file.
+    """
+
+    def __init__(self, url: str, timeout: float = 30, block_size: int = PDF_RANGE_BLOCK_SIZE,
+                 max_fraction: float = PDF_RANGE_MAX_FRACTION):
+        super().__init__()
+        self.url = url
+        self.timeout = timeout
+        self.block_size = block_size
+        self.position = 0
+        self.requests = 0
+        self.fetched = 0
+        self.if_range = None
+
+        with self._get(0, block_size - 1) as response:
+            content_range = CONTENT_RANGE_PATTERN.fullmatch(response.headers.get("Content-Range", ""))
+            if response.status_code != 206 or content_range is None:
+                raise RangesNotSupported(url)
+            self.size = int(content_range.group(3))
+            self.max_bytes = max(int(self.size * max_fraction), 4 * block_size)
+            self.validator = response.headers.get("ETag") or response.headers.get("Last-Modified") or str(self.size)
+            # If-Range only takes a strong ETag or a date
+            etag = response.headers.get("ETag")
+            self.if_range = etag if etag and not etag.startswith("W/") else response.headers.get("Last-Modified")
+            self._store_blocks(0, response.content)
+
+    def _get(self, start: int, end: int) -> requests.Response:
+        if self.requests and self.fetched + end - start + 1 > self.max_bytes:
+            raise RangeBudgetExceeded(self.url)
+        self.requests += 1
+        self.fetched += end - start + 1
+        tracer.count("pdf.range_requests")
+        tracer.count("pdf.range_bytes", end - start + 1)
+        headers = {"Range": f"bytes={start}-{end}"}
+        if self.if_range:
+            headers["If-Range"] = self.if_range
+        response = get_http_session().get(self.url, headers=headers, stream=True, timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    def _store_blocks(self, first: int, content: bytes):
+        global _range_blocks_size
+        with _range_blocks_lock:
+            for offset in range(0, len(content), self.block_size):
+                key = (self.url, self.validator, first + offset // self.block_size)
+                block = content[offset:offset + self.block_size]
+                _range_blocks_size += len(block) - len(_range_blocks.get(key, b""))
+                _range_blocks[key] = block
+            while _range_blocks_size > PDF_RANGE_CACHE_BYTES:
+                _, evicted = _range_blocks.popitem(last=False)
+                _range_blocks_size -= len(evicted)
+
+    def _blocks(self, first: int, last: int) -> list:
+        with _range_blocks_lock:
+            blocks = []
+            for number in range(first, last + 1):
+                key = (self.url, self.validator, number)
+                if key in _range_blocks:
+                    _range_blocks.move_to_end(key)
+                blocks.append(_range_blocks.get(key))
+
+        # Fetch each run of missing blocks with one request
+        number = first
+        while number <= last:
+            if blocks[number - first] is not None:
+                number += 1
+                continue
+            run_end = number
+            while run_end + 1 <= last and blocks[run_end + 1 - first] is None:
+                run_end += 1
+            start = number * self.block_size
+            with self._get(start, min((run_end + 1) * self.block_size, self.size) - 1) as response:
+                content_range = CONTENT_RANGE_PATTERN.fullmatch(response.headers.get("Content-Range", ""))
+                if response.status_code != 206 or content_range is None or int(content_range.group(3)) != self.size:
+                    raise RangesNotSupported(self.url)
+                content = response.content
+            self._store_blocks(number, content)
+            for offset in range(run_end - number + 1):
+                blocks[number + offset - first] = content[offset * self.block_size:(offset + 1) * self.block_size]
+            number = run_end + 1
+        return blocks
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        self.position = max(base + offset, 0)
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        end = min(self.position + len(buffer), self.size)
+        if end <= self.position:
+            return 0
+        first, last = self.position // self.block_size, (end - 1) // self.block_size
+        data = b"".join(self._blocks(first, last))
+        start = self.position - first * self.block_size
+        n = end - self.position
+        buffer[:n] = data[start:start + n]
+        self.position = end
+        return n
+
+
+def open_remote_pdf(url: str, timeout: float = 30):
+    """
+    Seekable source of the PDF behind `url`: the disk-cached copy if there is
+    one, ranged reads if the server supports them, else a full download.
+    """
+    pdf_cache = get_pdf_cache()
+    if url not in pdf_cache.urls:
+        try:
+            return HTTPRangeFile(url, timeout=timeout)
+        except RangesNotSupported:
+            pass
+    return pdf_cache.open(url, timeout=timeout)
+
+
+PDF_SLICE_CACHE_SIZE = 128
+
+# Extracted page slices by (url, page set), least recently used first
+_pdf_slices = collections.OrderedDict()
+_pdf_slices_lock = threading.Lock()
+
+
+PAGE_INHERITABLE_KEYS = ("/Resources", "/MediaBox", "/CropBox", "/Rotate")
+
+
+def _read_page(reader: PdfReader, index: int) -> PageObject:
+    """
+    Page `index` found by descending the page tree by its /Count entries.
+    Unlike `reader.pages`, this only resolves the tree nodes on the way, not
+    every page of the document. A node with as many kids as pages (e.g. the
+    flat /Kids array most writers produce) is indexed directly once the kids
+    on the shorter side of the page are checked to be pages too (an empty
+    /Pages kid could make up for a multi-page one), so pages near either end
+    resolve few kids.
+    """
+    node = reader.trailer["/Root"]["/Pages"].get_object()
+    inherited = {}
+    while node.get("/Type") == "/Pages":
+        inherited.update({key: node[key] for key in PAGE_INHERITABLE_KEYS if key in node})
+        kids = node["/Kids"]
+        if int(node["/Count"]) == len(kids) and index < len(kids):
+            side = range(index + 1) if index < len(kids) - index else range(index, len(kids))
+            if all(kids[i].get_object().get("/Type") != "/Pages" for i in side):
+                node, reference = kids[index].get_object(), kids[index]
+                break
+        for kid in kids:
+            child = kid.get_object()
+            count = int(child["/Count"]) if child.get("/Type") == "/Pages" else 1
+            if index < count:
+                node, reference = child, kid
+                break
+            index -= count
+        else:
+            raise IndexError("page index out of range")
+
+    page = PageObject(reader, reference)
+    page.update(node)
+    for key, value in inherited.items():
+        page.setdefault(NameObject(key), value)
+    return page
+
+
+def slice_pdf(pdf, pages: list) -> tuple:
+    """
+    A small PDF holding only `pages` (1-based, in document order) of `pdf` (a
+    path, bytes or a seekable binary file), and the mapping from its page
+    numbers to the original ones.
+    """
+    with contextlib.ExitStack() as stack:
+        if isinstance(pdf, bytes):
+            source = io.BytesIO(pdf)
+        elif hasattr(pdf, "read"):
+            source = pdf
+        else:
+            f = stack.enter_context(open(pdf, "rb"))
+            source = stack.enter_context(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        # Lenient parsing validates every xref entry, i.e. would touch every
+        # object of a ranged file; get_pdf_slice downloads PDFs that need it
+        reader = PdfReader(source, strict=isinstance(source, HTTPRangeFile))
+        page_count = int(reader.trailer["/Root"]["/Pages"]["/Count"])
+        kept = sorted({page for page in pages if 1 <= page <= page_count})
+
+        writer = PdfWriter()
+        for page in kept:
+            writer.add_page(_read_page(reader, page - 1))
+        sliced = io.BytesIO()
+        writer.write(sliced)
+
+    return sliced.getvalue(), {i + 1: page for i, page in enumerate(kept)}
+
+
+def get_pdf_slice(url: str, pages: list, pdf=None) -> tuple:
+    """
+    `slice_pdf` of the PDF behind `url` (or the already fetched `pdf`), cached
+    by page set. A PDF read with ranged requests is downloaded in full instead
+    when it only parses leniently, the ranged reads exceed their budget or the
+    server stops answering them with ranges (e.g. the file was replaced).
+    """
+    key = (url, tuple(sorted(set(pages))))
+    with _pdf_slices_lock:
+        if key in _pdf_slices:
+            _pdf_slices.move_to_end(key)
+            return _pdf_slices[key]
+
+    with tracer.span("pdf.slice", pages=list(key[1])):
+        if pdf is not None:
+            pdf_slice = slice_pdf(pdf, pages)
+        else:
+            source = open_remote_pdf(url)
+            try:
+                with source:
+                    pdf_slice = slice_pdf(source, pages)
+            except (RangeBudgetExceeded, RangesNotSupported, PdfReadError):
+                if not isinstance(source, HTTPRangeFile):
+                    raise
+                tracer.count("pdf.range_fallbacks")
+                with get_pdf_cache().open(url) as source:
+                    pdf_slice = slice_pdf(source, pages)
+    with _pdf_slices_lock:
+        _pdf_slices[key] = pdf_slice
+        while len(_pdf_slices) > PDF_SLICE_CACHE_SIZE:
+            _pdf_slices.popitem(last=False)
+    return pdf_slice
+
+
+def display_annotated_pdf(query_report_link, pages_to_render, pdf=None):
+    """ Render only `pages_to_render` of the report, sliced out server-side """
+    try:
+        pdf_slice, page_numbers = get_pdf_slice(query_report_link, pages_to_render, pdf=pdf)
+    except Exception as e:
+        st.error(f"Failed to load PDF: {e}")
+        tracer.record_error(e)
+        return None
+
+    st.caption(f"Page(s) {', '.join(str(page) for page in page_numbers.values())} of the report")
     return pdf_viewer(
-        input=download_pdf(query_report_link), 
+        input=pdf_slice, 
         height=800, 
-        pages_to_render=pages_to_render, 
         resolution_boost=2
         )
 
@@ -371,27 +2313,1025 @@ def read_supabase_documents(supabase):
     )
 
 
-def get_most_similar_pages(prompt: str, pages: list, top_pages=3):
-    """ Embed prompt with Mistral, compare with all supplied pages and return topk """
-    client = Mistral(api_key=st.secrets["MISTRAL_API_KEY"])
-    embeddings_response = client.embeddings.create(
-        model="mistral-embed",
-        inputs=prompt
+MIN_PAGE_CHARACTERS = 500
+EMBEDDING_INDEX_CACHE_SIZE = 32
+EMBEDDINGS_DIR = os.path.join("data", "embeddings")
+PAGE_TEXT_COLUMNS = "id, page, content"
+
+# EmbeddingIndex by document, least recently used first
+_embedding_indexes = collections.OrderedDict()
+_embedding_indexes_lock = threading.Lock()
+# Stored entries are written and read as a whole under this lock
+_embedding_files_lock = threading.Lock()
+
+
+def parse_embedding(embedding) -> np.ndarray:
+    """ Embedding as float32 vector; Supabase returns pgvector columns as "[0.1, ...]" text """
+    if isinstance(embedding, str):
+        embedding = json.loads(embedding)
+    return np.asarray(embedding, dtype=np.float32)
+
+
+def normalize_embeddings(matrix: np.ndarray) -> np.ndarray:
+    """ Contiguous float32 copy of `matrix` with unit-length rows (zero rows stay zero) """
+    matrix = np.array(matrix, dtype=np.float32, order="C")
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms > 0, norms, 1)
+    return matrix
+
+
+def document_fingerprint(pages: list) -> str:
+    """ Digest of the page numbers and contents of all pages of a document, in page order """
+    digest = hashlib.sha256()
+    for page in sorted(pages, key=lambda page: int(page["page"])):
+        digest.update(f"{int(page['page'])}\0{page['content']}\0".encode())
+    return digest.hexdigest()
+
+
+def _top_pages(pages: list, scores: np.ndarray, top_k: int) -> list:
+    """ Copies of the `top_k` highest scoring pages, best first, without sorting all scores """
+    k = min(top_k, len(scores))
+    if k <= 0:
+        return []
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind="stable")]
+    return [{**pages[i], "score": float(scores[i])} for i in top]
+
+
+class EmbeddingIndex:
+    """
+    Pages of one document with their embeddings as one contiguous float32
+    matrix of unit-length rows, so that scoring a query is a single
+    matrix-vector product. Pages shorter than `MIN_PAGE_CHARACTERS` are masked
+    out and score 0. `fingerprint` is the `document_fingerprint` of the pages
+    when the index belongs to a document.
+    """
+
+    fingerprint = None
+
+    def __init__(self, pages: list, matrix: np.ndarray = None):
+        self.pages = pages
+        if matrix is None:
+            matrix = np.vstack([parse_embedding(page["embedding"]) for page in pages]) if pages else np.zeros((0, 0))
+        self.matrix = normalize_embeddings(matrix)
+        self.mask = np.array([len(page["content"].strip()) >= MIN_PAGE_CHARACTERS for page in pages], dtype=bool)
+
+    def scores(self, query_embedding, rows: np.ndarray = None) -> np.ndarray:
+        """ Cosine similarity of the query with all pages, or only with the pages at `rows` """
+        query = normalize_embeddings(np.asarray(query_embedding, dtype=np.float32)[None, :])[0]
+        if rows is None:
+            return np.where(self.mask, self.matrix @ query, 0.0)
+        return np.where(self.mask[rows], self.matrix[rows] @ query, 0.0)
+
+    def search(self, query_embedding, top_k: int = 3) -> list:
+        """ Return copies of the `top_k` best pages, best first, with their `score` """
+        if not self.pages:
+            return []
+        return _top_pages(self.pages, self.scores(query_embedding), top_k)
+
+
+def quantize_embeddings(matrix: np.ndarray, dtype: str = "int8") -> tuple:
+    """
+    Compact copy of the unit-normalized `matrix` for storage.
+
+    Returns `(codes, scales)`: float16 codes without scales, or int8 codes with
+    one float32 scale per row (row ~= codes * scale).
+    """
+    matrix = normalize_embeddings(matrix)
+    if dtype == "float16":
+        return matrix.astype(np.float16), None
+    if dtype != "int8":
+        raise ValueError(f"Unsupported embedding dtype: {dtype}")
+
+    scales = np.abs(matrix).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.round(matrix / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+class QuantizedEmbeddingIndex(EmbeddingIndex):
+    """
+    EmbeddingIndex over float16 or int8 codes (with per-row scales), usually
+    memory-mapped from disk. Scores are computed on the codes block by block,
+    so a full float32 copy of the matrix never exists.
+    """
+
+    BLOCK_ROWS = 4096
+
+    def __init__(self, pages: list, codes: np.ndarray, scales: np.ndarray = None):
+        self.pages = pages
+        self.matrix = codes
+        self.scales = scales
+        self.mask = np.array([len(page["content"].strip()) >= MIN_PAGE_CHARACTERS for page in pages], dtype=bool)
+
+    def scores(self, query_embedding, rows: np.ndarray = None) -> np.ndarray:
+        query = normalize_embeddings(np.asarray(query_embedding, dtype=np.float32)[None, :])[0]
+        if rows is None:
+            rows = np.arange(len(self.matrix))
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), self.BLOCK_ROWS):
+            block = self.matrix[rows[start:start + self.BLOCK_ROWS]]
+            scores[start:start + len(block)] = block.astype(np.float32) @ query
+        if self.scales is not None:
+            scores *= self.scales[rows]
+        return np.where(self.mask[rows], scores, 0.0)
+
+
+def _embedding_paths(document_id: str, directory: str) -> dict:
+    return {
+        "codes": os.path.join(directory, f"{document_id}.npy"),
+        "scales": os.path.join(directory, f"{document_id}.scales.npy"),
+        "pages": os.path.join(directory, f"{document_id}.pages.parquet"),
+        "meta": os.path.join(directory, f"{document_id}.json"),
+    }
+
+
+def replace_file(path: str, write) -> None:
+    """
+    Write a file through `write(f)` (a binary file object) into a temporary
+    file next to `path` and swap it in. Readers of the old file, including
+    memory maps of it, keep seeing the old contents.
+    """
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(temporary, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temporary)
+        raise
+
+
+def save_document_embeddings(document_id: str, pages: list, matrix: np.ndarray = None,
+                             dtype: str = "int8", directory: str = EMBEDDINGS_DIR) -> None:
+    """
+    Store the page embeddings of a document as quantized `.npy` codes (plus
+    scales for int8), the remaining page fields as Parquet and the
+    `document_fingerprint` of the pages as JSON.
+
+    Every file is swapped in whole (see `replace_file`), so an index still
+    memory-mapping the previous codes keeps working.
+    """
+    if matrix is None:
+        matrix = np.vstack([parse_embedding(page["embedding"]) for page in pages])
+    codes, scales = quantize_embeddings(matrix, dtype=dtype)
+    paths = _embedding_paths(document_id, directory)
+    frame = pd.DataFrame([{k: v for k, v in page.items() if k != "embedding"} for page in pages])
+    meta = json.dumps({"fingerprint": document_fingerprint(pages)}).encode()
+
+    os.makedirs(directory, exist_ok=True)
+    with _embedding_files_lock:
+        replace_file(paths["pages"], lambda f: frame.to_parquet(f, index=False))
+        if scales is not None:
+            replace_file(paths["scales"], lambda f: np.save(f, scales))
+        elif os.path.exists(paths["scales"]):
+            os.remove(paths["scales"])
+        replace_file(paths["codes"], lambda f: np.save(f, codes))
+        # Meta last: its fingerprint only vouches for a complete entry
+        replace_file(paths["meta"], lambda f: f.write(meta))
+
+
+def load_document_embeddings(document_id: str, directory: str = EMBEDDINGS_DIR) -> QuantizedEmbeddingIndex:
+    """
+    Memory-mapped QuantizedEmbeddingIndex of a stored document, or None (also
+    when its files do not belong together, e.g. while another process stores it)
+    """
+    paths = _embedding_paths(document_id, directory)
+    with _embedding_files_lock:
+        if not os.path.exists(paths["codes"]):
+            return None
+
+        codes = np.load(paths["codes"], mmap_mode="r")
+        scales = np.load(paths["scales"]) if os.path.exists(paths["scales"]) else None
+        pages = pd.read_parquet(paths["pages"]).to_dict("records")
+        try:
+            with open(paths["meta"]) as f:
+                fingerprint = json.load(f)["fingerprint"]
+        except (OSError, ValueError, KeyError):
+            # Stored before fingerprints were: treated as out of date
+            fingerprint = None
+
+    if len(codes) != len(pages) or (scales is not None and len(scales) != len(codes)):
+        print(f"Stored embeddings of {document_id} are incomplete")
+        return None
+    index = QuantizedEmbeddingIndex(pages, codes, scales)
+    index.fingerprint = fingerprint
+    return index
+
+
+def embedding_recall(matrix: np.ndarray, queries: np.ndarray, top_k: int = 10, dtype: str = "int8") -> dict:
+    """
+    Compare quantized against exact scoring: mean recall@k of the quantized
+    top-k over `queries`, and the bytes per stored embedding of both.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    pages = [{"content": "x" * MIN_PAGE_CHARACTERS}] * len(matrix)
+    exact = EmbeddingIndex(pages, matrix)
+    codes, scales = quantize_embeddings(matrix, dtype=dtype)
+    quantized = QuantizedEmbeddingIndex(pages, codes, scales)
+
+    k = min(top_k, len(matrix))
+    recalls = []
+    for query in np.atleast_2d(queries):
+        expected = np.argpartition(-exact.scores(query), k - 1)[:k]
+        found = np.argpartition(-quantized.scores(query), k - 1)[:k]
+        recalls.append(len(np.intersect1d(expected, found)) / k)
+
+    return {
+        "recall": float(np.mean(recalls)),
+        "bytes_exact": matrix.shape[1] * 4,
+        "bytes_quantized": codes.shape[1] * codes.itemsize + (4 if scales is not None else 0),
+    }
+
+
+def get_embedding_index(document_id: str, pages: list = None) -> EmbeddingIndex:
+    """
+    EmbeddingIndex of a document, kept in a small LRU.
+
+    Uses the stored quantized embeddings of the document when there are any.
+    Otherwise, or when `pages` come with embeddings and no longer match the
+    stored pages, builds the index from the embeddings in `pages` and stores
+    them quantized for the next time. Pages without embeddings are the page
+    texts `fetch_document_pages` already checked against the stored pages.
+    """
+    with _embedding_indexes_lock:
+        cached = document_id in _embedding_indexes
+        if cached:
+            _embedding_indexes.move_to_end(document_id)
+            index = _embedding_indexes[document_id]
+    if not cached:
+        index = load_document_embeddings(document_id)
+
+    if index is not None and pages and "embedding" in pages[0] and index.fingerprint != document_fingerprint(pages):
+        # The pages changed since they were stored
+        invalidate_document(document_id)
+        index = None
+    elif cached:
+        return index
+
+    if index is None:
+        if pages is None:
+            return None
+        index = EmbeddingIndex(pages)
+        index.fingerprint = document_fingerprint(pages) if pages else None
+        if pages:
+            try:
+                save_document_embeddings(document_id, pages, index.matrix)
+            except Exception as e:
+                print(f"Could not store embeddings of {document_id}: {e}")
+
+    with _embedding_indexes_lock:
+        _embedding_indexes[document_id] = index
+        while len(_embedding_indexes) > EMBEDDING_INDEX_CACHE_SIZE:
+            _embedding_indexes.popitem(last=False)
+    return index
+
+
+EMBEDDING_MODEL = "mistral-embed"
+EMBEDDING_CACHE_DIR = os.path.join("data", "embedding-cache")
+EMBEDDING_CACHE_SIZE = 1024
+EMBEDDING_BATCH_WINDOW_SECONDS = 0.02
+EMBEDDING_TIMEOUT_SECONDS = 60
+
+
+class EmbeddingService:
+    """
+    Embeds prompts through one shared Mistral client.
+
+    Embeddings are cached in memory (LRU) and on disk, keyed on the model and
+    the normalized prompt (case and whitespace folded). Prompts that miss the
+    cache while other callers are still looking up theirs, e.g. from parallel
+    multi-report queries, are sent as one batched `embeddings.create` request.
+    """
+
+    def __init__(self, client, model: str = EMBEDDING_MODEL, cache_dir: str = EMBEDDING_CACHE_DIR,
+                 cache_size: int = EMBEDDING_CACHE_SIZE, batch_window: float = EMBEDDING_BATCH_WINDOW_SECONDS,
+                 timeout: float = EMBEDDING_TIMEOUT_SECONDS):
+        self.client = client
+        self.model = model
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.batch_window = batch_window
+        self.timeout = timeout
+        self.requests = 0
+        self._cache = collections.OrderedDict()
+        self._pending = {}
+        self._futures = {}
+        self._flushing = False
+        self._arriving = 0
+        self._lock = threading.Lock()
+        self._arrived = threading.Condition(self._lock)
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.split())
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\n{self.normalize(text).casefold()}".encode()).hexdigest()
+
+    def _lookup(self, key: str) -> np.ndarray:
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        path = os.path.join(self.cache_dir, f"{key}.npy")
+        if os.path.exists(path):
+            embedding = np.load(path)
+            self._remember(key, embedding)
+            return embedding
+        return None
+
+    def _remember(self, key: str, embedding: np.ndarray) -> None:
+        with self._lock:
+            self._cache[key] = embedding
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _store(self, key: str, embedding: np.ndarray) -> None:
+        self._remember(key, embedding)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.save(os.path.join(self.cache_dir, f"{key}.npy"), embedding)
+        except OSError as e:
+            print(f"Could not cache embedding: {e}")
+
+    def _request(self, texts: list) -> list:
+        """ One batched embeddings request """
+        with self._lock:
+            self.requests += 1
+        with tracer.span("embedding.request", texts=len(texts)):
+            response = self.client.embeddings.create(model=self.model, inputs=texts)
+        if len(response.data) != len(texts):
+            raise RuntimeError(f"Embedding request returned {len(response.data)} embeddings for {len(texts)} prompts")
+        return [np.asarray(item.embedding, dtype=np.float32) for item in response.data]
+
+    def embed_many(self, texts: list) -> list:
+        """ Embeddings of all `texts`, fetching the uncached ones in one request """
+        keys = [self._key(text) for text in texts]
+        embeddings = {key: self._lookup(key) for key in keys}
+        missing = {}
+        for key, text in zip(keys, texts):
+            if embeddings[key] is None:
+                missing.setdefault(key, self.normalize(text))
+
+        if missing:
+            for key, embedding in zip(missing, self._request(list(missing.values()))):
+                self._store(key, embedding)
+                embeddings[key] = embedding
+
+        return [embeddings[key] for key in keys]
+
+    def embed(self, text: str) -> np.ndarray:
+        """
+        Embedding of one prompt. On a cache miss, the first caller waits (at
+        most `batch_window` seconds) for the callers still looking up their
+        prompt, then requests all missing prompts in one batch; the other
+        callers wait for that batch. A lone caller does not wait.
+        """
+        key = self._key(text)
+        with self._lock:
+            self._arriving += 1
+        try:
+            embedding = self._lookup(key)
+            if embedding is not None:
+                return embedding
+
+            with self._lock:
+                if key in self._cache:
+                    return self._cache[key]
+                # Callers of a prompt already pending or in flight share its future
+                future = self._futures.get(key)
+                leader = False
+                if future is None:
+                    future = self._futures[key] = Future()
+                    self._pending[key] = self.normalize(text)
+                    leader = not self._flushing
+                    self._flushing = True
+        finally:
+            with self._arrived:
+                self._arriving -= 1
+                self._arrived.notify_all()
+
+        if leader:
+            with self._arrived:
+                self._arrived.wait_for(lambda: not self._arriving, timeout=self.batch_window)
+                batch, self._pending, self._flushing = self._pending, {}, False
+            embeddings = None
+            error = RuntimeError("Embedding request did not complete")
+            try:
+                embeddings = self._request(list(batch.values()))
+            except Exception as e:
+                error = e
+            finally:
+                # Every waiting caller gets a result, even if the request was cut short
+                complete = embeddings is not None
+                if complete:
+                    for batch_key, batch_embedding in zip(batch, embeddings):
+                        self._store(batch_key, batch_embedding)
+                with self._lock:
+                    futures = [self._futures.pop(batch_key) for batch_key in batch]
+                for i, batch_future in enumerate(futures):
+                    if complete:
+                        batch_future.set_result(embeddings[i])
+                    else:
+                        batch_future.set_exception(error)
+
+        return future.result(timeout=self.timeout)
+
+
+@st.cache_resource
+def get_embedding_service() -> EmbeddingService:
+    """ Process-wide EmbeddingService; MISTRAL_SERVER_URL can point it at another endpoint """
+    return EmbeddingService(
+        Mistral(api_key=st.secrets["MISTRAL_API_KEY"], server_url=st.secrets.get("MISTRAL_SERVER_URL"))
     )
-    prompt_emb = embeddings_response.data[0].embedding
 
-    for page in pages:
-        if len(page["content"].strip()) < 500:
-            page["score"] = 0
+
+HYBRID_CANDIDATES = 50
+RRF_K = 60
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-.][a-z0-9]+)*")
+SCOPE_PATTERN = re.compile(r"\bscope\s*([123])\b")
+# ESRS standards and disclosure requirements (E1, ESRS 2, E1-6, S1-14, IRO-1, ...) and GHG scopes
+EXACT_QUERY_PATTERN = re.compile(
+    r"\b(?:[ESG][1-5]-\d{1,2}|(?:ESRS\s*)?(?:E[1-5]|S[1-4]|G1)|ESRS\s*[12]|(?:GOV|SBM|IRO|MDR-[PAMT])-\d)\b|\bscope\s*[123]\b",
+    re.IGNORECASE,
+)
+
+# BM25Index by document, least recently used first
+_bm25_indexes = collections.OrderedDict()
+_bm25_indexes_lock = threading.Lock()
+
+
+def tokenize(text: str) -> list:
+    """
+    Lowercase word tokens for BM25. Hyphenated codes are kept whole and split
+    ("e1-6", "e1", "6"), and "Scope 1" also becomes "scope1".
+    """
+    text = text.lower()
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text):
+        tokens.append(token)
+        if "-" in token:
+            tokens.extend(token.split("-"))
+    tokens.extend(f"scope{scope}" for scope in SCOPE_PATTERN.findall(text))
+    return tokens
+
+
+class BM25Index:
+    """ Inverted index with Okapi BM25 scoring over a list of texts (e.g. page contents) """
+
+    def __init__(self, texts: list, k1: float = 1.5, b: float = 0.75):
+        self.k1, self.b = k1, b
+        postings = collections.defaultdict(lambda: ([], []))
+        self.lengths = np.zeros(len(texts), dtype=np.float32)
+        for i, text in enumerate(texts):
+            counts = collections.Counter(tokenize(text or ""))
+            self.lengths[i] = sum(counts.values())
+            for term, tf in counts.items():
+                postings[term][0].append(i)
+                postings[term][1].append(tf)
+
+        self.postings = {
+            term: (np.array(ids, dtype=np.int32), np.array(tfs, dtype=np.float32))
+            for term, (ids, tfs) in postings.items()
+        }
+        self.average_length = max(self.lengths.mean(), 1.0) if len(texts) else 1.0
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.lengths), dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            ids, tfs = self.postings[term]
+            idf = np.log(1 + (len(self.lengths) - len(ids) + 0.5) / (len(ids) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[ids] / self.average_length)
+            scores[ids] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+        return scores
+
+
+def get_bm25_index(document_id: str, pages: list) -> BM25Index:
+    """ BM25Index over the page contents of a document, kept in a small LRU """
+    with _bm25_indexes_lock:
+        if document_id in _bm25_indexes:
+            _bm25_indexes.move_to_end(document_id)
+            return _bm25_indexes[document_id]
+
+    index = BM25Index([page["content"] for page in pages])
+    with _bm25_indexes_lock:
+        _bm25_indexes[document_id] = index
+        while len(_bm25_indexes) > EMBEDDING_INDEX_CACHE_SIZE:
+            _bm25_indexes.popitem(last=False)
+    return index
+
+
+def build_archive_bm25_index(document_ids: list) -> tuple:
+    """
+    BM25Index over the stored pages (see `save_document_embeddings`) of all
+    `document_ids`, and a DataFrame mapping its rows to (document_id, page).
+    """
+    pages = pd.concat(
+        [
+            pd.read_parquet(_embedding_paths(document_id, EMBEDDINGS_DIR)["pages"]).assign(document_id=document_id)
+            for document_id in document_ids
+            if os.path.exists(_embedding_paths(document_id, EMBEDDINGS_DIR)["pages"])
+        ],
+        ignore_index=True,
+    )
+    return BM25Index(pages["content"].tolist()), pages.loc[:, ["document_id", "page"]]
+
+
+def is_exact_query(prompt: str) -> bool:
+    """ True for prompts naming an ESRS standard, disclosure requirement or GHG scope """
+    return EXACT_QUERY_PATTERN.search(prompt) is not None
+
+
+def reciprocal_rank_fusion(*scores: np.ndarray, k: int = RRF_K, mask: np.ndarray = None) -> np.ndarray:
+    """
+    Sum of 1 / (k + rank) over several score arrays of the same candidates.
+    Tied scores share the best rank of the tie, so a list that cannot tell
+    candidates apart (e.g. no lexical match at all) does not reorder them.
+    Candidates outside `mask` are left out of the ranking and get 0.
+    """
+    fused = np.zeros(len(scores[0]), dtype=np.float32)
+    if mask is None:
+        mask = np.ones(len(fused), dtype=bool)
+    for score in scores:
+        ranked = np.sort(-score[mask])
+        ranks = np.searchsorted(ranked, -score[mask], side="left") + 1
+        fused[mask] += 1 / (k + ranks)
+    return fused
+
+
+@tracer.traced("retrieval")
+def get_most_similar_pages(prompt: str, pages: list, top_pages=3, document_id: str = None, prompt_embedding=None):
+    """
+    Return the top pages for the prompt by hybrid BM25 + embedding retrieval.
+
+    Prompts naming an ESRS identifier or GHG scope that match lexically are
+    answered from BM25 alone, without embedding the prompt. Otherwise the best
+    `HYBRID_CANDIDATES` pages by BM25 are scored with the Mistral embedding
+    (all pages if too few match lexically) and both rankings are fused by
+    reciprocal rank fusion. A precomputed `prompt_embedding` saves the
+    embedding request. Pages too short to be scored come last with a score of 0.
+    """
+    if document_id is None:
+        index = EmbeddingIndex(pages)
+    else:
+        index = get_embedding_index(document_id, pages)
+    if not index.pages:
+        return []
+
+    if document_id is None:
+        lexical_index = BM25Index([page["content"] for page in index.pages])
+    else:
+        lexical_index = get_bm25_index(document_id, index.pages)
+    lexical = np.where(index.mask, lexical_index.scores(prompt), 0.0)
+
+    if is_exact_query(prompt) and lexical.max() > 0:
+        return _top_pages(index.pages, lexical, top_pages)
+
+    prompt_emb = prompt_embedding if prompt_embedding is not None else get_embedding_service().embed(prompt)
+
+    if np.count_nonzero(lexical) >= HYBRID_CANDIDATES:
+        candidates = np.argpartition(-lexical, HYBRID_CANDIDATES - 1)[:HYBRID_CANDIDATES]
+    else:
+        candidates = np.arange(len(index.pages))
+
+    fused = reciprocal_rank_fusion(
+        lexical[candidates], index.scores(prompt_emb, rows=candidates), mask=index.mask[candidates],
+    )
+    return _top_pages([index.pages[i] for i in candidates], fused, top_pages)
+
+
+ANN_INDEX_DIR = os.path.join("data", "ann-index")
+
+
+class PageANNIndex:
+    """
+    Approximate nearest neighbour index (IVF) over the page embeddings of the
+    whole archive.
+
+    Spherical k-means centroids partition the unit-normalized page vectors
+    (stored as float16). A query only scores the pages of the `nprobe`
+    partitions closest to it. Filters on document_id/country/sector go
+    through the precomputed row positions of each value and are applied
+    inside those partitions; when a filter leaves only a few pages, they are
+    scored exactly instead. Documents can be added or removed without
+    retraining, and the index is persisted as `.npy` files plus Parquet
+    metadata.
+    """
+
+    EXACT_SEARCH_ROWS = 20_000
+    META_COLUMNS = ["document_id", "page", "country", "sector"]
+
+    def __init__(self, centroids: np.ndarray):
+        self.centroids = normalize_embeddings(centroids)
+        self.vectors = np.zeros((0, self.centroids.shape[1]), dtype=np.float16)
+        self.lists = np.zeros(0, dtype=np.int32)
+        self.alive = np.zeros(0, dtype=bool)
+        self.meta = pd.DataFrame(columns=self.META_COLUMNS)
+        self._pending = []
+        self._postings = None
+        self._value_rows = None
+
+    @classmethod
+    def train(cls, sample: np.ndarray, n_lists: int = None, iterations: int = 10, seed: int = 0) -> "PageANNIndex":
+        """ New empty index with centroids learned from a sample of page vectors """
+        sample = normalize_embeddings(sample)
+        n_lists = n_lists or max(1, int(np.sqrt(len(sample))))
+        rng = np.random.default_rng(seed)
+        centroids = sample[rng.choice(len(sample), size=min(n_lists, len(sample)), replace=False)]
+
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            order = np.argsort(assignment, kind="stable")
+            members, starts = np.unique(assignment[order], return_index=True)
+            sums = np.zeros_like(centroids)
+            sums[members] = np.add.reduceat(sample[order], starts, axis=0)
+            empty = ~np.isin(np.arange(len(centroids)), members)
+            sums[empty] = sample[rng.choice(len(sample), size=empty.sum())]
+            centroids = normalize_embeddings(sums)
+
+        return cls(centroids)
+
+    def add(self, document_id: str, matrix: np.ndarray, pages: list, country: str = None, sector: str = None) -> None:
+        """ Add (or replace) the pages of a document """
+        self.remove(document_id)
+        vectors = normalize_embeddings(np.reshape(matrix, (-1, self.centroids.shape[1])))
+        self._pending.append((
+            document_id,
+            vectors.astype(np.float16),
+            np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32),
+            pd.DataFrame({
+                "document_id": document_id,
+                "page": [page.get("page") for page in pages],
+                "country": country,
+                "sector": sector,
+                }),
+        ))
+        self._postings = None
+
+    def remove(self, document_id: str) -> None:
+        """ Drop the pages of a document (they stay on disk until `compact`) """
+        self._pending = [batch for batch in self._pending if batch[0] != document_id]
+        if len(self.meta):
+            self.alive &= (self.meta["document_id"] != document_id).to_numpy()
+
+    def compact(self) -> None:
+        """ Merge pending additions and physically drop removed pages """
+        if self._pending:
+            _, vectors, lists, meta = zip(*self._pending)
+            self.vectors = np.concatenate([self.vectors, *vectors])
+            self.lists = np.concatenate([self.lists, *lists])
+            self.alive = np.concatenate([self.alive, np.ones(sum(len(v) for v in vectors), dtype=bool)])
+            self.meta = pd.concat([self.meta, *meta] if len(self.meta) else meta, ignore_index=True)
+            self._pending = []
+            self._postings = None
+
+        if not self.alive.all():
+            keep = np.flatnonzero(self.alive)
+            self.vectors = self.vectors[keep]
+            self.lists = self.lists[keep]
+            self.meta = self.meta.iloc[keep].reset_index(drop=True)
+            self.alive = np.ones(len(keep), dtype=bool)
+            self._postings = None
+
+    def _posting_lists(self) -> tuple:
+        """ Rows grouped by partition: (rows sorted by partition, start offset of each partition) """
+        self.compact()
+        if self._postings is None:
+            rows = np.argsort(self.lists, kind="stable")
+            offsets = np.searchsorted(self.lists[rows], np.arange(len(self.centroids) + 1))
+            self._postings = (rows, offsets)
+            self._value_rows = {
+                column: {value: np.asarray(positions) for value, positions in self.meta.groupby(column, sort=False).indices.items()}
+                for column in ["document_id", "country", "sector"]
+            }
+        return self._postings
+
+    def _filter_rows(self, filters: dict) -> np.ndarray:
+        """ Sorted positions of the live rows matching all `filters` (column -> values), None if unfiltered """
+        matched = None
+        for column, values in filters.items():
+            if values is None:
+                continue
+            value_rows = self._value_rows[column]
+            column_rows = [value_rows[value] for value in set(values) if value in value_rows]
+            column_rows = np.unique(np.concatenate(column_rows)) if column_rows else np.zeros(0, dtype=np.int64)
+            matched = column_rows if matched is None else np.intersect1d(matched, column_rows, assume_unique=True)
+        if matched is None:
+            return None
+        return matched[self.alive[matched]]
+
+    def search(self, query_embedding, top_k: int = 10, nprobe: int = 8,
+               document_ids: list = None, countries: list = None, sectors: list = None) -> pd.DataFrame:
+        """
+        Best `top_k` pages for a query, as rows of the metadata with a `score`.
+        `None` leaves a filter open, a list keeps the pages matching any value.
+        """
+        rows, offsets = self._posting_lists()
+        query = normalize_embeddings(np.asarray(query_embedding, dtype=np.float32)[None, :])[0]
+
+        matched = self._filter_rows({"document_id": document_ids, "country": countries, "sector": sectors})
+        if matched is not None and len(matched) <= self.EXACT_SEARCH_ROWS:
+            candidates = matched
+        elif matched is None and len(self.alive) <= self.EXACT_SEARCH_ROWS:
+            candidates = np.flatnonzero(self.alive)
         else:
-            distance = cosine_similarity([literal_eval(page["embedding"])], [prompt_emb])
-            page["score"] = distance[0][0]
+            if matched is None:
+                allowed = self.alive
+            else:
+                allowed = np.zeros(len(self.alive), dtype=bool)
+                allowed[matched] = True
+            probe = np.argsort(-(self.centroids @ query))[:nprobe]
+            candidates = np.concatenate([rows[offsets[i]:offsets[i + 1]] for i in probe])
+            candidates = candidates[allowed[candidates]]
+
+        scores = self.vectors[candidates].astype(np.float32) @ query
+        k = min(top_k, len(candidates))
+        if k == 0:
+            return self.meta.iloc[:0].assign(score=[])
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return self.meta.iloc[candidates[top]].assign(score=scores[top]).reset_index(drop=True)
+
+    def save(self, directory: str = ANN_INDEX_DIR) -> None:
+        """
+        Persist the index. Files are swapped in whole (see `replace_file`), so
+        saving an index loaded from `directory` never writes its memory-mapped
+        vectors over themselves.
+        """
+        self.compact()
+        os.makedirs(directory, exist_ok=True)
+        replace_file(os.path.join(directory, "centroids.npy"), lambda f: np.save(f, self.centroids))
+        replace_file(os.path.join(directory, "lists.npy"), lambda f: np.save(f, self.lists))
+        replace_file(os.path.join(directory, "meta.parquet"), lambda f: self.meta.to_parquet(f, index=False))
+        # Vectors last: their presence marks a complete index
+        replace_file(os.path.join(directory, "vectors.npy"), lambda f: np.save(f, self.vectors))
+
+    @classmethod
+    def load(cls, directory: str = ANN_INDEX_DIR) -> "PageANNIndex":
+        """ Index persisted with `save` (vectors memory-mapped), or None """
+        if not os.path.exists(os.path.join(directory, "vectors.npy")):
+            return None
+        index = cls(np.load(os.path.join(directory, "centroids.npy")))
+        index.vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        index.lists = np.load(os.path.join(directory, "lists.npy"))
+        index.meta = pd.read_parquet(os.path.join(directory, "meta.parquet"))
+        index.alive = np.ones(len(index.lists), dtype=bool)
+        return index
+
+
+def build_page_ann_index(documents: pd.DataFrame, index: PageANNIndex = None, sample_size: int = 100_000) -> PageANNIndex:
+    """
+    Add the stored embeddings (see `save_document_embeddings`) of the
+    `documents` (columns document_id, country, sector) to `index`, training a
+    new index on a sample of them if none is given. Documents without stored
+    embeddings are skipped; without any, there is nothing to train on and the
+    given `index` (or None) is returned.
+    """
+    stored = {}
+    for document in documents.itertuples(index=False):
+        document_index = load_document_embeddings(document.document_id)
+        if document_index is not None:
+            stored[document.document_id] = (document, document_index)
+
+    def dequantize(document_index):
+        codes = np.asarray(document_index.matrix, dtype=np.float32)
+        return codes * document_index.scales[:, None] if document_index.scales is not None else codes
+
+    if index is None:
+        sample = [dequantize(document_index) for _, document_index in stored.values()]
+        sample = np.vstack(sample) if sample else np.zeros((0, 0), dtype=np.float32)
+        if not len(sample):
+            return None
+        rng = np.random.default_rng(0)
+        if len(sample) > sample_size:
+            sample = sample[rng.choice(len(sample), size=sample_size, replace=False)]
+        index = PageANNIndex.train(sample)
+
+    for document_id, (document, document_index) in stored.items():
+        index.add(document_id, dequantize(document_index), document_index.pages, document.country, document.sector)
+
+    index.compact()
+    return index
+
+
+@st.cache_resource
+def get_page_ann_index() -> PageANNIndex:
+    """ The persisted archive-wide page index, loaded once per process (None if not built yet) """
+    return PageANNIndex.load()
+
+
+INGEST_DIR = os.path.join("data", "ingest")
+INGEST_PAGES_PER_TASK = 16
+INGEST_CHUNK_CHARACTERS = 4000
+INGEST_EMBEDDING_BATCH_SIZE = 64
+INGEST_EMBEDDING_CONCURRENCY = 4
+
+
+class MistralEmbedder:
+    """ Default embedder of the ingestion pipeline: one `embeddings.create` request per batch """
+
+    def __init__(self, client, model: str = EMBEDDING_MODEL):
+        self.client = client
+        self.name = model
 
+    def __call__(self, texts: list) -> np.ndarray:
+        response = self.client.embeddings.create(model=self.name, inputs=texts)
+        return np.vstack([np.asarray(item.embedding, dtype=np.float32) for item in response.data])
 
-    pages = sorted(pages, key=lambda x: x["score"], reverse=True)
-    pages = pages[:top_pages]
-    
-    return pages
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(PDF_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _count_pages(path: str) -> int:
+    """ Process pool task: number of pages of a PDF, read from the root of its page tree """
+    return int(PdfReader(path).trailer["/Root"]["/Pages"]["/Count"])
+
+
+def _extract_page_texts(task: tuple) -> list:
+    """ Process pool task: `(page number, text)` of a range of pages of a PDF """
+    path, start, stop = task
+    reader = PdfReader(path)
+    return [(number + 1, reader.pages[number].extract_text() or "") for number in range(start, stop)]
+
+
+def chunk_text(text: str, max_characters: int = INGEST_CHUNK_CHARACTERS) -> list:
+    """ Split a page into chunks of at most `max_characters`, preferably between paragraphs """
+    chunks, current = [], ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        while len(paragraph) > max_characters:
+            chunks.append(paragraph[:max_characters])
+            paragraph = paragraph[max_characters:]
+        if current and len(current) + len(paragraph) + 2 > max_characters:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current.strip():
+        chunks.append(current)
+    return chunks
+
+
+class _StageTimer:
+    """ Pages and seconds per pipeline stage; a stage can add pages it only learns while running """
+
+    def __init__(self):
+        self.stats = {}
+
+    @contextlib.contextmanager
+    def __call__(self, stage: str, pages: int = 0):
+        stage_stats = self.stats.setdefault(stage, {"pages": 0, "seconds": 0.0})
+        stage_stats["pages"] += pages
+        start = time.perf_counter()
+        yield stage_stats
+        stage_stats["seconds"] += time.perf_counter() - start
+
+    def report(self) -> dict:
+        for stage, stage_stats in self.stats.items():
+            stage_stats["pages_per_second"] = stage_stats["pages"] / stage_stats["seconds"] if stage_stats["seconds"] else float("inf")
+            print(f"{stage}: {stage_stats['pages']} pages in {stage_stats['seconds']:.1f}s ({stage_stats['pages_per_second']:.0f} pages/s)")
+        return self.stats
+
+
+def ingest_reports(reports: list, embedder=None, directory: str = INGEST_DIR, max_workers: int = None,
+                   batch_size: int = INGEST_EMBEDDING_BATCH_SIZE, update_counts: bool = True) -> dict:
+    """
+    Batch ingestion of report PDFs into stored page embeddings.
+
+    `reports` are dicts with `document_id`, `source` (a local path or URL) and
+    optionally `isin`. The stages are:
+
+    - fetch: download the PDFs into the disk PDF cache and count their pages
+    - extract: page texts, `INGEST_PAGES_PER_TASK` pages per process pool
+      task; the tasks of all reports are queued at once
+    - embed: pages are chunked and the chunks sent to `embedder` (a callable
+      from a list of texts to an (n, d) array, `MistralEmbedder` by default) in
+      batches of `batch_size`; a page's embedding is the mean of its chunks'
+    - store: `save_document_embeddings` and, for reports with an ISIN,
+      `update_standard_counts`
+
+    Extracted texts are cached by PDF hash and embeddings by chunk hash, and a
+    manifest records the PDF hash each document was stored from. Re-runs skip
+    unchanged reports and interrupted runs resume where they stopped. Returns
+    pages, seconds and pages/s per stage.
+    """
+    if embedder is None:
+        embedder = MistralEmbedder(get_embedding_service().client)
+    timer = _StageTimer()
+    pages_dir = os.path.join(directory, "pages")
+    embeddings_dir = os.path.join(directory, "embeddings", getattr(embedder, "name", type(embedder).__name__))
+    manifest_path = os.path.join(directory, "manifest.json")
+    os.makedirs(pages_dir, exist_ok=True)
+    os.makedirs(embeddings_dir, exist_ok=True)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        # Fetch
+        with timer("fetch") as fetch_stats, ThreadPoolExecutor(max_workers=QUERY_CONCURRENCY) as executor:
+            paths = list(executor.map(
+                lambda report: str(fetch_pdf(report["source"])) if re.match(r"https?://", report["source"]) else report["source"],
+                reports,
+            ))
+            pdf_hashes = list(executor.map(hash_file, paths))
+            page_counts = dict(zip(paths, pool.map(_count_pages, paths)))
+            fetch_stats["pages"] += sum(page_counts[path] for path in paths)
+        todo = [
+            (report, path, pdf_hash)
+            for report, path, pdf_hash in zip(reports, paths, pdf_hashes)
+            if manifest.get(report["document_id"]) != pdf_hash
+            or not os.path.exists(_embedding_paths(report["document_id"], EMBEDDINGS_DIR)["codes"])
+        ]
+
+        # Extract
+        texts = {}
+        missing = []
+        for _, path, pdf_hash in todo:
+            cached = os.path.join(pages_dir, f"{pdf_hash}.parquet")
+            if pdf_hash in texts:
+                continue
+            if os.path.exists(cached):
+                texts[pdf_hash] = pd.read_parquet(cached)
+            else:
+                missing.append((path, pdf_hash))
+                texts[pdf_hash] = None
+        with timer("extract", sum(page_counts[path] for path, _ in missing)):
+            # Queue the tasks of all reports before collecting any, so the pool works on all of them
+            futures = {
+                pool.submit(_extract_page_texts, (path, start, min(start + INGEST_PAGES_PER_TASK, page_counts[path]))): pdf_hash
+                for path, pdf_hash in missing
+                for start in range(0, page_counts[path], INGEST_PAGES_PER_TASK)
+            }
+            extracted = collections.defaultdict(list)
+            for future in as_completed(futures):
+                extracted[futures[future]].extend(future.result())
+            for _, pdf_hash in missing:
+                texts[pdf_hash] = pd.DataFrame(sorted(extracted[pdf_hash]), columns=["page", "content"])
+                texts[pdf_hash].to_parquet(os.path.join(pages_dir, f"{pdf_hash}.parquet"), index=False)
+
+    # Embed: chunks of all reports, only the ones not cached yet
+    page_chunks = {
+        pdf_hash: [chunk_text(content) for content in frame["content"]]
+        for pdf_hash, frame in texts.items()
+    }
+    chunk_keys = {
+        hashlib.sha256(chunk.encode("utf-8")).hexdigest(): chunk
+        for chunks in page_chunks.values() for page in chunks for chunk in page
+    }
+    uncached = [key for key in chunk_keys if not os.path.exists(os.path.join(embeddings_dir, f"{key}.npy"))]
+
+    def embed_batch(keys):
+        for key, embedding in zip(keys, embedder([chunk_keys[key] for key in keys])):
+            np.save(os.path.join(embeddings_dir, f"{key}.npy"), np.asarray(embedding, dtype=np.float32))
+
+    embed_pages = sum(len(frame) for frame in texts.values())
+    with timer("embed", embed_pages), ThreadPoolExecutor(max_workers=INGEST_EMBEDDING_CONCURRENCY) as executor:
+        list(executor.map(embed_batch, [uncached[i:i + batch_size] for i in range(0, len(uncached), batch_size)]))
+
+    # Store
+    counts = {}
+    with timer("store", embed_pages):
+        for report, _, pdf_hash in todo:
+            frame = texts[pdf_hash]
+            chunk_embeddings = [
+                [np.load(os.path.join(embeddings_dir, f"{hashlib.sha256(chunk.encode('utf-8')).hexdigest()}.npy")) for chunk in chunks]
+                for chunks in page_chunks[pdf_hash]
+            ]
+            dimension = next((len(page[0]) for page in chunk_embeddings if page), 0)
+            matrix = np.vstack([
+                np.mean(page, axis=0) if page else np.zeros(dimension, dtype=np.float32)
+                for page in chunk_embeddings
+            ]) if len(frame) else np.zeros((0, dimension), dtype=np.float32)
+            pages = [
+                {"document_id": report["document_id"], "page": int(page), "content": content}
+                for page, content in zip(frame["page"], frame["content"])
+            ]
+            save_document_embeddings(report["document_id"], pages, normalize_embeddings(matrix))
+            invalidate_document(report["document_id"])
+            if report.get("isin"):
+                counts[report["isin"]] = list(frame["content"])
+
+            manifest[report["document_id"]] = pdf_hash
+            with open(manifest_path + ".tmp", "w") as f:
+                json.dump(manifest, f)
+            os.replace(manifest_path + ".tmp", manifest_path)
+
+        if update_counts and counts:
+            update_standard_counts(counts, max_workers=max_workers)
+
+    return timer.report()
 
 
 def read_supabase_pages(supabase):
@@ -408,31 +3348,203 @@ def read_supabase_pages(supabase):
     )
 
 
-def log_query_to_supabase(supabase, document_id: str, query: str):
-    (
-        supabase
-        .table("log_queries")
-        .insert(
-            {
-                "document_id": document_id,
-                "content": query
-            }
+LOG_TABLE = "log_queries"
+LOG_QUEUE_SIZE = 10_000
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_SECONDS = 2.0
+LOG_SPOOL_PATH = os.path.join("data", "log-spool.jsonl")
+
+
+class QueryLogger:
+    """
+    Buffered, asynchronous logger for `log_queries`.
+
+    `log` only puts the event on a bounded queue (dropping it if the queue is
+    full), so it never blocks a rerun. A daemon thread inserts the events in
+    batches once `batch_size` are queued or `flush_seconds` have passed. Batches
+    the backend rejects are appended to a local spool file, which is replayed
+    after the next successful insert, along with any replay a crash left
+    behind. Spool lines that cannot be parsed (e.g. torn by a crash) are
+    moved to a `.bad` file next to it. `flushed`,
+    `spooled` and `dropped` count events. Any object with Supabase's `table(...).insert(...).execute()`
+    interface works as `client`.
+    """
+
+    def __init__(self, client, table: str = LOG_TABLE, max_queue: int = LOG_QUEUE_SIZE,
+                 batch_size: int = LOG_BATCH_SIZE, flush_seconds: float = LOG_FLUSH_SECONDS,
+                 spool_path: str = LOG_SPOOL_PATH):
+        self.client = client
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.spool_path = spool_path
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.flushed = 0
+        self.spooled = 0
+        self.dropped = 0
+        self._flush_requested = threading.Event()
+        self._worker = threading.Thread(target=self._run, name="query-logger", daemon=True)
+        self._worker.start()
+
+    def log(self, event: dict) -> bool:
+        """ Queue an event without blocking; False if it had to be dropped """
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def flush(self, timeout: float = None):
+        """ Write out everything queued so far (blocks until done) """
+        self._flush_requested.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.queue.all_tasks_done.wait(remaining)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size and not self._flush_requested.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=min(remaining, 0.1)))
+                except queue.Empty:
+                    pass
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if self.queue.empty():
+                self._flush_requested.clear()
+
+            try:
+                self._write(batch)
+            except Exception as e:
+                # Never let the worker die: later events would pile up unwritten
+                print(f"Could not write log events: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _insert(self, batch: list):
+        self.client.table(self.table).insert(batch).execute()
+
+    def _write(self, batch: list):
+        try:
+            self._insert(batch)
+        except Exception as e:
+            print(f"Could not write {len(batch)} log event(s), spooling them: {e}")
+            self._spool(batch)
+            return
+        self.flushed += len(batch)
+        try:
+            self._replay_spool()
+        except Exception as e:
+            print(f"Could not replay spooled log events: {e}")
+
+    def _append(self, path: str, lines: list):
+        """ Append lines, starting on a new line if the file ends in a torn one """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "a+b") as f:
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+            f.writelines(line.encode("utf-8") + b"\n" for line in lines)
+
+    def _spool(self, batch: list):
+        try:
+            self._append(self.spool_path, [json.dumps(event) for event in batch])
+            self.spooled += len(batch)
+        except OSError as e:
+            print(f"Could not spool log events: {e}")
+            self.dropped += len(batch)
+
+    def _replay_files(self) -> list:
+        """ Replays in progress or left behind by a crash, oldest first """
+        directory, name = os.path.split(self.spool_path)
+        try:
+            names = os.listdir(directory or ".")
+        except FileNotFoundError:
+            return []
+        return sorted(
+            os.path.join(directory, file_name) for file_name in names
+            if file_name.startswith(name + ".") and file_name.endswith(".replay")
         )
-        .execute()
+
+    def _replay_spool(self):
+        """
+        Insert spooled events once the backend is reachable again. The spool
+        is first moved to a uniquely named `.replay` file, so a replay never
+        overwrites one a crash left behind; those are replayed as well.
+        """
+        if os.path.exists(self.spool_path):
+            os.replace(self.spool_path, f"{self.spool_path}.{os.getpid()}-{time.time_ns()}.replay")
+        for replaying in self._replay_files():
+            if not self._replay_file(replaying):
+                break
+
+    def _replay_file(self, replaying: str) -> bool:
+        """ Insert the events of one replay file and remove it; False if the backend failed """
+        events, bad = [], []
+        with open(replaying, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    bad.append(line.rstrip("\n"))
+        if bad:
+            print(f"Moving {len(bad)} unreadable spooled log line(s) to {self.spool_path}.bad")
+            self._append(self.spool_path + ".bad", bad)
+        replayed = True
+        for start in range(0, len(events), self.batch_size):
+            batch = events[start:start + self.batch_size]
+            try:
+                self._insert(batch)
+            except Exception as e:
+                print(f"Could not replay spooled log events: {e}")
+                self._spool(events[start:])
+                replayed = False
+                break
+            self.flushed += len(batch)
+            # Spooled by an earlier process if it goes below 0
+            self.spooled = max(0, self.spooled - len(batch))
+        os.remove(replaying)
+        return replayed
+
+
+@st.cache_resource
+def get_query_logger(_supabase) -> QueryLogger:
+    """ The process-wide query logger """
+    return QueryLogger(_supabase)
+
+
+def log_query_to_supabase(supabase, document_id: str, query: str):
+    get_query_logger(supabase).log(
+        {
+            "document_id": document_id,
+            "content": query
+        }
     )
 
 @st.cache_data
 def log_user_to_supabase(_supabase):
-    (
-        _supabase
-        .table("log_queries")
-        .insert(
-            {
-                "document_id": None,
-                "content": "access"
-            }
-        )
-        .execute()
+    get_query_logger(_supabase).log(
+        {
+            "document_id": None,
+            "content": "access"
+        }
     )
 
 
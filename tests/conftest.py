@@ -0,0 +1,59 @@
+import http.server
+import io
+import os
+import sys
+import threading
+
+import pytest
+from pypdf import PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_pdf(page_count: int, padding: int = 20_000, title: str = "Page") -> bytes:
+    """
+    A PDF of `page_count` pages reading "<title> <number>", with ~`padding`
+    byte content streams, in a flat page tree with shared resources
+    """
+    writer = PdfWriter()
+    for i in range(page_count):
+        page = writer.add_blank_page(612, 792)
+        del page["/Resources"]
+        content = DecodedStreamObject()
+        content.set_data(f"BT /F1 24 Tf 72 700 Td ({title} {i + 1}) Tj ET".encode() + b" " * padding)
+        page[NameObject("/Contents")] = writer._add_object(content)
+    font = DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica"),
+    })
+    resources = DictionaryObject({NameObject("/Font"): DictionaryObject({NameObject("/F1"): writer._add_object(font)})})
+    writer._root_object["/Pages"][NameObject("/Resources")] = resources
+    pdf = io.BytesIO()
+    writer.write(pdf)
+    return pdf.getvalue()
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """ Run in an empty directory, so that everything under data/ starts empty """
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def serve():
+    """ Start a local HTTP server for a handler class and return its base URL """
+    servers = []
+
+    def start(handler) -> str:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+
+import helpers
+
+
+DIMENSION = 16
+
+
+def make_index(documents: dict, n_lists: int = 4) -> helpers.PageANNIndex:
+    """ Index over `documents` (document_id -> (vectors, country, sector)) """
+    rng = np.random.default_rng(0)
+    index = helpers.PageANNIndex.train(rng.normal(size=(200, DIMENSION)), n_lists=n_lists)
+    for document_id, (vectors, country, sector) in documents.items():
+        index.add(document_id, vectors, [{"page": i + 1} for i in range(len(vectors))], country, sector)
+    return index
+
+
+def random_documents(count: int = 6, pages: int = 20) -> dict:
+    rng = np.random.default_rng(1)
+    return {
+        f"doc{i}": (rng.normal(size=(pages, DIMENSION)), ["FR", "DE"][i % 2], ["Energy", "Banks", "Food"][i % 3])
+        for i in range(count)
+    }
+
+
+def brute_force(documents: dict, query: np.ndarray, keep) -> list:
+    query = query / np.linalg.norm(query)
+    scored = [
+        (float(helpers.normalize_embeddings(vectors)[i] @ query), document_id, i + 1)
+        for document_id, (vectors, country, sector) in documents.items() if keep(document_id, country, sector)
+        for i in range(len(vectors))
+    ]
+    return [(document_id, page) for _, document_id, page in sorted(scored, reverse=True)]
+
+
+def test_filtered_search_matches_brute_force():
+    documents = random_documents()
+    index = make_index(documents)
+    query = np.random.default_rng(2).normal(size=DIMENSION)
+
+    result = index.search(query, top_k=5, countries=["FR"], sectors=["Energy", "Food"])
+    expected = brute_force(documents, query, lambda _, country, sector: country == "FR" and sector in ("Energy", "Food"))
+    assert list(zip(result["document_id"], result["page"])) == expected[:5]
+
+    result = index.search(query, top_k=3, document_ids=["doc1", "missing"])
+    assert list(zip(result["document_id"], result["page"])) == brute_force(documents, query, lambda d, *_: d == "doc1")[:3]
+
+    assert index.search(query, countries=["IT"]).empty
+
+
+def test_filtered_search_through_partitions(monkeypatch):
+    monkeypatch.setattr(helpers.PageANNIndex, "EXACT_SEARCH_ROWS", 0)
+    documents = random_documents()
+    index = make_index(documents)
+    query = np.random.default_rng(3).normal(size=DIMENSION)
+
+    # Probing every partition finds the exact filtered top pages
+    result = index.search(query, top_k=4, nprobe=4, sectors=["Banks"])
+    assert list(zip(result["document_id"], result["page"])) == brute_force(documents, query, lambda _, __, s: s == "Banks")[:4]
+
+
+def test_add_remove_compact_and_reload(tmp_path):
+    documents = random_documents()
+    index = make_index(documents)
+    index.compact()
+    index.remove("doc0")
+    index.add("doc1", documents["doc1"][0][:5], [{"page": i + 1} for i in range(5)], "FR", "Energy")
+    index.add("empty", np.zeros((0, DIMENSION)), [], "FR", "Energy")
+    index.remove("empty")
+    index.add("pending", documents["doc2"][0], [{"page": 1}] * len(documents["doc2"][0]))
+    index.remove("pending")
+    query = np.random.default_rng(4).normal(size=DIMENSION)
+    before = index.search(query, top_k=10)
+    assert "doc0" not in set(before["document_id"])
+    assert len(index.search(query, top_k=100, document_ids=["doc1"])) == 5
+
+    index.save(str(tmp_path))
+    loaded = helpers.PageANNIndex.load(str(tmp_path))
+    assert isinstance(loaded.vectors, np.memmap)
+    assert len(loaded.meta) == 4 * 20 + 5
+    pd.testing.assert_frame_equal(loaded.search(query, top_k=10), before)
+
+    # Saving an index over the files it memory-maps keeps it readable
+    loaded.save(str(tmp_path))
+    pd.testing.assert_frame_equal(loaded.search(query, top_k=10), before)
+    pd.testing.assert_frame_equal(helpers.PageANNIndex.load(str(tmp_path)).search(query, top_k=10), before)
+
+
+def test_build_without_stored_embeddings(workdir):
+    documents = pd.DataFrame({"document_id": ["a", "b"], "country": ["FR", "DE"], "sector": ["Energy", "Banks"]})
+    assert helpers.build_page_ann_index(documents) is None
+    index = make_index({})
+    assert helpers.build_page_ann_index(documents, index) is index
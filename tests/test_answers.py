@@ -0,0 +1,165 @@
+import threading
+import time
+import types
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+
+import helpers
+
+
+def chunk(content: str = None, finish_reason: str = None):
+    delta = types.SimpleNamespace(content=content)
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta, finish_reason=finish_reason)])
+
+
+class FakeOpenAI:
+    """
+    Streams `words` as chat completion chunks, each waiting for `release`,
+    then a last chunk with `finish_reason`
+    """
+
+    def __init__(self, words: list, finish_reason: str = "stop"):
+        self.words = words
+        self.finish_reason = finish_reason
+        self.sent = 0
+        self.release = threading.Semaphore(0)
+        self.chat = types.SimpleNamespace(completions=self)
+
+    def create(self, **kwargs):
+        for word in self.words:
+            assert self.release.acquire(timeout=5)
+            self.sent += 1
+            yield chunk(word)
+        yield chunk(finish_reason=self.finish_reason)
+
+
+def done(value) -> Future:
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def make_query(document_ids: list) -> dict:
+    rng = np.random.default_rng(0)
+    pages = {
+        document_id: [
+            {"id": i, "page": 10 + i, "content": f"page {i} " * 100, "embedding": rng.normal(size=8).tolist()}
+            for i in range(4)
+        ]
+        for document_id in document_ids
+    }
+    return {
+        "pages": {document_id: done(document_pages) for document_id, document_pages in pages.items()},
+        "embedding": done(rng.normal(size=8).tolist()),
+        "prompt": done("prompt"),
+        "original_prompt": "prompt",
+    }
+
+
+@pytest.fixture(autouse=True)
+def empty_caches(workdir, monkeypatch):
+    monkeypatch.setattr(helpers, "_embedding_indexes", helpers.collections.OrderedDict())
+    monkeypatch.setattr(helpers, "_bm25_indexes", helpers.collections.OrderedDict())
+    monkeypatch.setattr(helpers, "get_answer_cache", lambda cache=helpers.AnswerCache(): cache)
+
+
+def test_single_report_streams_before_the_answer_is_complete(monkeypatch):
+    monkeypatch.setattr(helpers, "get_pdf_slice", lambda *args, **kwargs: pytest.fail("sliced before streaming"))
+    client = FakeOpenAI(["The ", "answer."])
+    documents = [{"document_id": "d1", "pages": "[10, 13]"}]
+
+    [(document, result, error)] = list(helpers.answer_reports(client, documents, make_query(["d1"])))
+    client.release.release()
+    first = next(result["answer"])
+
+    assert error is None
+    assert (first, client.sent) == ("The ", 1)
+    client.release.release()
+    assert list(result["answer"]) == ["answer."]
+    assert result["pages_to_render"] == [int(page["page"]) - 9 for page in result["pages"]][:3]
+
+
+def test_answer_survives_a_failing_pdf_slice(monkeypatch):
+    def fail(*args, **kwargs):
+        raise helpers.PdfReadError("broken PDF")
+
+    monkeypatch.setattr(helpers, "get_pdf_slice", fail)
+    client = FakeOpenAI(["Still ", "answered."])
+    for _ in client.words:
+        client.release.release()
+
+    result = helpers.answer_report(client, {"document_id": "d1", "pages": "[10, 13]"}, make_query(["d1"]))
+
+    assert result["answer"] == "Still answered."
+    assert result["pages_to_render"] == []
+
+
+def test_several_reports_are_answered_in_parallel_and_replayed(monkeypatch):
+    monkeypatch.setattr(helpers, "get_pdf_slice", lambda *args, **kwargs: None)
+    client = FakeOpenAI(["Answer."])
+    client.release = threading.Semaphore(100)
+    documents = [{"document_id": f"d{i}", "pages": "[10, 13]"} for i in range(3)]
+
+    answers = {
+        document["document_id"]: "".join(result["answer"])
+        for document, result, error in helpers.answer_reports(client, documents, make_query(["d0", "d1", "d2"]))
+    }
+
+    assert answers == {"d0": "Answer.", "d1": "Answer.", "d2": "Answer."}
+
+
+def test_only_complete_answers_are_cached():
+    pages = make_query(["d1"])["pages"]["d1"].result()
+
+    def answer(client, prompt="prompt"):
+        client.release = threading.Semaphore(100)
+        return "".join(helpers.summarize_text_cached(client, "d1", prompt, pages))
+
+    assert answer(FakeOpenAI([])) == ""
+    assert answer(FakeOpenAI(["Cut "], finish_reason="length")) == "Cut "
+    client = FakeOpenAI(["Closed ", "early."])
+    client.release = threading.Semaphore(100)
+    stream = helpers.summarize_text_cached(client, "d1", "prompt", pages)
+    assert next(stream) == "Closed "
+    stream.close()
+    assert answer(FakeOpenAI(["Complete."])) == "Complete."
+    assert answer(FakeOpenAI(["Not asked."])) == "Complete."
+
+
+def test_prompt_work_does_not_queue_behind_page_fetches(monkeypatch):
+    fetched = threading.Event()
+    monkeypatch.setattr(helpers, "log_query_to_supabase", lambda *args: None)
+    monkeypatch.setattr(helpers, "fetch_document_pages", lambda supabase, document_id: fetched.wait(5))
+    monkeypatch.setattr(helpers, "get_embedding_service", lambda: types.SimpleNamespace(embed=lambda prompt: [1.0]))
+    monkeypatch.setattr(helpers, "translate_if_needed", lambda client, prompt: prompt.upper())
+    executor = helpers.ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(helpers, "get_query_executor", lambda: executor)
+
+    try:
+        query = helpers.prepare_query(None, None, "prompt", [f"d{i}" for i in range(10)])
+        assert query["embedding"].result(timeout=1) == [1.0]
+        assert query["prompt"].result(timeout=1) == "PROMPT"
+        assert not any(future.done() for future in query["pages"].values())
+    finally:
+        fetched.set()
+        executor.shutdown()
+
+
+def test_closing_run_concurrently_cancels_queued_calls():
+    calls = []
+
+    def slow(item):
+        calls.append(item)
+        time.sleep(0.2)
+        return item
+
+    results = helpers.run_concurrently(slow, list(range(20)), max_workers=2)
+    next(results)
+    started = time.perf_counter()
+    results.close()
+
+    assert time.perf_counter() - started < 0.2
+    time.sleep(0.5)
+    assert len(calls) <= 4
@@ -0,0 +1,147 @@
+import collections
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import helpers
+
+
+def make_archive_df(n: int = 5000, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "company": [f"Company {i:05d}" for i in range(n)],
+        "isin": [f"DE{i:010d}" for i in range(n)],
+        "link": [f"https://example.com/{i}.pdf" for i in range(n)],
+        "country": rng.choice(["DE", "FR", "IT", "ES"], size=n),
+        "sector": rng.choice(["Energy", "Financials", "Health Care"], size=n),
+        "industry": "Industry",
+        "publication date": "2025-01-01",
+        "pages PDF": rng.integers(50, 400, size=n),
+        "auditor": rng.choice(["EY", "KPMG", "PwC"], size=n),
+        **{standard: rng.integers(0, 100, size=n).astype(float) for standard in helpers.STANDARDS},
+    })
+    return df.sort_values("publication date", kind="stable")
+
+
+@pytest.fixture
+def archive(monkeypatch):
+    monkeypatch.setattr(helpers, "_archive", {"current": None, "fetched_at": 0.0, "refreshing": False})
+    monkeypatch.setattr(helpers.tracer, "history", collections.deque(maxlen=0))
+    df = make_archive_df()
+    helpers._publish_archive(df, helpers.melt_heatmap(df))
+    return helpers._archive["current"]
+
+
+def test_filtered_sessions_only_hold_row_positions(archive):
+    filters = archive["filters"]
+
+    def session():
+        return helpers.search_reports(filters, filters.filter(countries=["FR"], sectors=["Energy"]), "company")
+
+    tracemalloc.start()
+    try:
+        # Warm up lazy imports and caches before measuring
+        session()
+        before = tracemalloc.take_snapshot()
+        sessions = [session() for _ in range(100)]
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    per_session = sum(stat.size_diff for stat in after.compare_to(before, "filename")) / len(sessions)
+    rows = sessions[0]
+    assert 0 < len(rows) < len(filters)
+    assert per_session < rows.nbytes + 2048
+    assert per_session < archive["reports"].nbytes / 50
+
+
+def test_report_list_is_a_view_of_the_filter_table(archive):
+    filters = archive["filters"]
+
+    assert not hasattr(filters, "df")
+    for column in helpers.REPORT_TABLE_COLUMNS:
+        shared = archive["reports"].column(column).chunk(0).buffers()
+        own = filters.table.column(column).chunk(0).buffers()
+        assert [buffer.address for buffer in shared if buffer] == [buffer.address for buffer in own if buffer]
+
+
+def test_rows_and_isins_follow_company_order(archive):
+    filters = archive["filters"]
+
+    positions = filters.find_isins({"DE0000000042", "DE0000000007", "XX"})
+    rows = filters.rows(positions)
+
+    assert rows["isin"].tolist() == ["DE0000000007", "DE0000000042"]
+    assert rows["company"].tolist() == ["Company 00007", "Company 00042"]
+
+
+def test_shared_arrays_are_read_only(archive):
+    with pytest.raises(ValueError):
+        archive["filters"].order[0] = 1
+
+
+def counts_for(df: pd.DataFrame, isins: list, value: float) -> pd.DataFrame:
+    return pd.DataFrame({"isin": isins, "content_hash": "h", **{standard: value for standard in helpers.STANDARDS}})
+
+
+def sorted_cells(table: pd.DataFrame) -> pd.DataFrame:
+    return table.sort_values(["row", "standard"]).reset_index(drop=True)
+
+
+def test_new_counts_only_replace_the_changed_reports(archive, workdir):
+    df = archive["df"]
+    unchanged = df.iloc[2]
+    counted = pd.concat([
+        counts_for(df, list(df["isin"].iloc[:2]) + ["XX0000000000"], 7.0),
+        pd.DataFrame([{"isin": unchanged["isin"], "content_hash": "h", **unchanged[helpers.STANDARDS].to_dict()}]),
+    ], ignore_index=True)
+
+    helpers._apply_standard_counts(counted)
+    current = helpers._archive["current"]
+
+    expected = df.copy()
+    expected.loc[df.index[:2], helpers.STANDARDS] = 7.0
+    pd.testing.assert_frame_equal(current["df"], expected)
+    assert current["version"] == archive["version"] + 1
+    assert current["heatmap"]["sector"].is_monotonic_increasing
+    pd.testing.assert_frame_equal(
+        current["heatmap"].sort_values(["row", "standard"]).reset_index(drop=True),
+        helpers.melt_heatmap(expected).sort_values(["row", "standard"]).reset_index(drop=True),
+    )
+    # The filters are shared, only the count columns of their table change
+    filters = current["filters"]
+    assert filters.order is archive["filters"].order and filters.bitmaps is archive["filters"].bitmaps
+    assert filters.rows(filters.find_isins(df["isin"].iloc[:2]))["e1"].tolist() == [7.0, 7.0]
+    pd.testing.assert_frame_equal(
+        sorted_cells(current["heatmap_table"]),
+        sorted_cells(helpers.build_heatmap_table(filters, helpers.melt_heatmap(expected))),
+    )
+
+    # Applying the same counts again publishes nothing
+    helpers._apply_standard_counts(counted)
+    assert helpers._archive["current"] is current
+
+
+def test_refresh_applies_counts_stored_by_another_process(archive, workdir, monkeypatch):
+    monkeypatch.setattr(helpers, "fetch_data", lambda previous: previous)
+    isin = archive["df"]["isin"].iloc[0]
+    helpers.os.makedirs(helpers.os.path.dirname(helpers.STANDARD_COUNTS_PATH))
+    counts_for(archive["df"], [isin], 3.0).to_parquet(helpers.STANDARD_COUNTS_PATH, index=False)
+
+    helpers._refresh_archive()
+
+    current = helpers._archive["current"]
+    assert current["df"].set_index("isin").loc[isin, "e1"] == 3.0
+    assert pd.read_parquet(helpers.ARCHIVE_SNAPSHOT_PATH).set_index("isin").loc[isin, "e1"] == 3.0
+
+
+def test_arrow_conversion_without_streamlit_internals():
+    df = pd.DataFrame({"pages PDF": [120, "n/a", None], "e1": [1.0, 2.0, np.nan]}, index=[7, 3, 5])
+
+    table = helpers.to_arrow_table(df)
+
+    assert table.column_names == ["pages PDF", "e1"]
+    assert table["pages PDF"].to_pylist() == ["120", "n/a", None]
+    assert helpers.pa.ipc.open_stream(helpers.arrow_ipc_bytes(table)).read_all().equals(table)
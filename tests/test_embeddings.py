@@ -0,0 +1,207 @@
+import http.server
+import json
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import helpers
+
+
+class FakeSupabase:
+    """ Answers `table("pages").select(columns).eq("document_id", id).execute()` from `rows` """
+
+    def __init__(self, rows: list):
+        self.rows = rows
+        self.selects = []
+
+    def table(self, name):
+        return self
+
+    def select(self, columns):
+        self.selects.append(columns)
+        self._columns = columns
+        return self
+
+    def eq(self, column, value):
+        self._document_id = value
+        return self
+
+    def execute(self):
+        rows = [row for row in self.rows if row["document_id"] == self._document_id]
+        if self._columns != "*":
+            columns = [column.strip() for column in self._columns.split(",")]
+            rows = [{column: row[column] for column in columns} for row in rows]
+        return types.SimpleNamespace(data=rows)
+
+
+def make_pages(document_id: str, contents: list, seed: int = 0) -> list:
+    rng = np.random.default_rng(seed)
+    return [
+        {
+            "id": i, "document_id": document_id, "page": i + 1, "content": content,
+            "embedding": str(rng.normal(size=8).round(4).tolist()),
+        }
+        for i, content in enumerate(contents)
+    ]
+
+
+@pytest.fixture(autouse=True)
+def empty_caches(workdir, monkeypatch):
+    monkeypatch.setattr(helpers, "_embedding_indexes", helpers.collections.OrderedDict())
+    monkeypatch.setattr(helpers, "_bm25_indexes", helpers.collections.OrderedDict())
+    monkeypatch.setattr(helpers, "get_answer_cache", lambda cache=helpers.AnswerCache(): cache)
+
+
+def fetch_index(supabase, document_id):
+    return helpers.get_embedding_index(document_id, helpers.fetch_document_pages(supabase, document_id))
+
+
+def test_stored_document_only_fetches_page_texts(monkeypatch):
+    supabase = FakeSupabase(make_pages("d1", ["a" * 600, "b" * 600]))
+    fetch_index(supabase, "d1")
+    monkeypatch.setattr(helpers, "_embedding_indexes", helpers.collections.OrderedDict())
+
+    index = fetch_index(supabase, "d1")
+
+    assert supabase.selects == ["*", helpers.PAGE_TEXT_COLUMNS]
+    assert isinstance(index, helpers.QuantizedEmbeddingIndex)
+    assert [page["content"][0] for page in index.pages] == ["a", "b"]
+
+
+def test_changed_pages_replace_stored_embeddings():
+    supabase = FakeSupabase(make_pages("d1", ["a" * 600, "b" * 600]))
+    stale = fetch_index(supabase, "d1")
+    helpers.get_answer_cache().put("d1", "key", "prompt", "stale answer")
+
+    supabase.rows = make_pages("d1", ["a" * 600, "c" * 600], seed=1)
+    index = fetch_index(supabase, "d1")
+
+    assert supabase.selects == ["*", helpers.PAGE_TEXT_COLUMNS, "*"]
+    assert index is not stale
+    assert [page["content"][0] for page in index.pages] == ["a", "c"]
+    assert helpers.get_answer_cache().get("d1", "key", "prompt") is None
+
+    # Stored again: the next process reuses the new entry
+    stored = helpers.load_document_embeddings("d1")
+    assert stored.fingerprint == index.fingerprint
+    assert [page["content"][0] for page in stored.pages] == ["a", "c"]
+
+
+def test_entries_without_fingerprint_are_rebuilt(monkeypatch):
+    supabase = FakeSupabase(make_pages("d1", ["a" * 600]))
+    fetch_index(supabase, "d1")
+    (helpers.pathlib.Path(helpers.EMBEDDINGS_DIR) / "d1.json").unlink()
+    monkeypatch.setattr(helpers, "_embedding_indexes", helpers.collections.OrderedDict())
+
+    index = fetch_index(supabase, "d1")
+
+    assert supabase.selects == ["*", helpers.PAGE_TEXT_COLUMNS, "*"]
+    assert index.fingerprint == helpers.document_fingerprint(supabase.rows)
+
+
+def test_resaving_leaves_memory_mapped_indexes_intact():
+    rng = np.random.default_rng(0)
+    matrix = rng.normal(size=(4000, 64)).astype(np.float32)
+    pages = [{"page": i + 1, "content": "x" * 600} for i in range(4000)]
+    helpers.save_document_embeddings("d1", pages, matrix)
+    old = helpers.load_document_embeddings("d1")
+    expected = old.scores(matrix[3999])
+
+    helpers.save_document_embeddings("d1", pages[:2], matrix[:2])
+
+    assert np.array_equal(old.scores(matrix[3999]), expected)
+    assert np.argmax(expected) == 3999
+    new = helpers.load_document_embeddings("d1")
+    assert (len(new.pages), len(new.matrix)) == (2, 2)
+    assert not [path for path in helpers.os.listdir(helpers.EMBEDDINGS_DIR) if path.endswith(".tmp")]
+
+
+def test_mismatched_stored_files_are_not_loaded():
+    rng = np.random.default_rng(0)
+    pages = [{"page": i + 1, "content": "x" * 600} for i in range(3)]
+    helpers.save_document_embeddings("d1", pages, rng.normal(size=(3, 8)))
+    helpers.pd.DataFrame(pages[:2]).to_parquet(helpers._embedding_paths("d1", helpers.EMBEDDINGS_DIR)["pages"])
+
+    assert helpers.load_document_embeddings("d1") is None
+
+
+class FakeMistral(http.server.BaseHTTPRequestHandler):
+    """ Mistral embeddings endpoint recording the inputs of each request; `short` drops the last embedding """
+
+    batches = []
+    short = False
+
+    def do_POST(self):
+        inputs = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["input"]
+        type(self).batches.append(inputs)
+        data = [{"object": "embedding", "index": i, "embedding": [float(len(text)), 1.0]} for i, text in enumerate(inputs)]
+        body = json.dumps({
+            "id": "1", "object": "list", "model": "mistral-embed", "data": data[:-1] if self.short else data,
+            "usage": {"prompt_tokens": 1, "total_tokens": 1},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def mistral(serve, monkeypatch):
+    monkeypatch.setattr(FakeMistral, "batches", [])
+    monkeypatch.setattr(FakeMistral, "short", False)
+    url = serve(FakeMistral)
+    return lambda **kwargs: helpers.EmbeddingService(helpers.Mistral(api_key="test", server_url=url), **kwargs)
+
+
+def test_embedding_service_batches_dedups_and_caches(mistral):
+    service = mistral()
+    first = service.embed_many(["Scope  3", "scope 3", "Water"])
+    assert FakeMistral.batches == [["Scope 3", "Water"]]
+    assert first[0] is first[1] and first[2].tolist() == [5.0, 1.0]
+
+    assert service.embed(" water ") is first[2]
+    # Embeddings stored on disk are shared with a new service
+    assert mistral().embed("SCOPE 3").tolist() == first[0].tolist()
+    assert len(FakeMistral.batches) == 1 and service.requests == 1
+
+
+def test_embedding_service_shares_concurrent_requests(mistral):
+    service = mistral(batch_window=5)
+    start = threading.Barrier(8)
+
+    def embed(text):
+        start.wait()
+        return service.embed(text)
+
+    with ThreadPoolExecutor(8) as executor:
+        embeddings = list(executor.map(embed, ["Energy", "energy ", "Banks"] * 2 + ["Food", "FOOD"]))
+
+    sent = [text for batch in FakeMistral.batches for text in batch]
+    assert sorted(text.casefold() for text in sent) == ["banks", "energy", "food"]
+    assert [embedding[0] for embedding in embeddings] == [6, 6, 5, 6, 6, 5, 4, 4]
+
+    # A lone caller does not wait for the batch window
+    started = time.perf_counter()
+    service.embed("Transport")
+    assert time.perf_counter() - started < 1
+
+
+def test_embedding_service_fails_callers_on_short_response(mistral, monkeypatch):
+    monkeypatch.setattr(FakeMistral, "short", True)
+    service = mistral(timeout=5)
+    with pytest.raises(RuntimeError, match="1 embeddings for 2 prompts"):
+        service.embed_many(["Alpha", "Beta"])
+    with pytest.raises(RuntimeError, match="0 embeddings for 1 prompts"):
+        service.embed("Alpha")
+
+    # Nothing is left pending: the next call requests the prompt again
+    monkeypatch.setattr(FakeMistral, "short", False)
+    assert service.embed("Alpha").tolist() == [5.0, 1.0]
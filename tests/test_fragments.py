@@ -0,0 +1,100 @@
+import dataclasses
+import os
+import statistics
+
+import pytest
+import streamlit as st
+from streamlit.runtime.scriptrunner_utils.script_requests import ScriptRequestType
+from streamlit.testing.v1 import AppTest, app_test
+
+import helpers
+from test_archive import make_archive_df
+
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+INTERACTIONS = 6
+
+
+class FragmentRunner(app_test.LocalScriptRunner):
+    """
+    AppTest always reruns the whole script; with `fragment_id` set, this runner
+    reruns only that fragment, as a served session does after an interaction
+    inside it
+    """
+
+    fragment_id = None
+
+    def request_rerun(self, rerun_data):
+        if self.fragment_id is not None:
+            # Replace the full run the runner starts with, rather than coalescing into it
+            self._requests._state = ScriptRequestType.CONTINUE
+            rerun_data = dataclasses.replace(rerun_data, fragment_id_queue=[self.fragment_id], is_fragment_scoped_rerun=True)
+        return super().request_rerun(rerun_data)
+
+
+@pytest.fixture
+def app(workdir, monkeypatch):
+    """ app.py run once over a snapshot of a synthetic archive; yields (AppTest, runner class) """
+    os.makedirs("data")
+    make_archive_df(5000).to_parquet(helpers.ARCHIVE_SNAPSHOT_PATH, index=True)
+    st.cache_data.clear()
+    st.cache_resource.clear()
+    runner = type("Runner", (FragmentRunner,), {})
+    monkeypatch.setattr(app_test, "LocalScriptRunner", runner)
+    at = AppTest.from_file(APP_PATH, default_timeout=60)
+    at.secrets["OPENAI_API_KEY"] = "test"
+    at.run()
+    assert not at.exception
+    yield at, runner
+    st.cache_data.clear()
+    st.cache_resource.clear()
+
+
+def fragment_id(at, name: str) -> str:
+    """ The id the last run registered the fragment function `name` under """
+    for fragment_id, wrapped in at._fragment_storage._fragments.items():
+        if any(getattr(cell.cell_contents, "__name__", None) == name for cell in wrapped.__closure__ or ()):
+            return fragment_id
+    raise KeyError(name)
+
+
+def interact(app, action, i: int, fragment: str = None) -> dict:
+    """ Apply interaction `i` and rerun the page, or only `fragment`; returns the run's trace """
+    at, runner = app
+    runner.fragment_id = fragment_id(at, fragment) if fragment else None
+    action(at, i)
+    at.run()
+    assert not at.exception
+    return helpers.tracer.history[-1]
+
+
+def toggle_scaling(at, i: int):
+    at.checkbox(key="scale_by_dp").set_value(i % 2 == 0)
+
+
+def search_reports(at, i: int):
+    # ISINs of 1000 reports each
+    at.text_input(key="table_search").input(f"DE000000{i % 5}")
+
+
+@pytest.mark.parametrize("fragment, trace_name, action", [
+    ("heatmap", "heatmap", toggle_scaling),
+    ("report_table", "table", search_reports),
+])
+def test_fragment_interactions_skip_the_rest_of_the_page(app, fragment, trace_name, action):
+    # Warm the caches both ways of the interaction
+    for i in range(2):
+        interact(app, action, i)
+
+    # Before: the interaction reruns the whole script
+    before = [interact(app, action, i) for i in range(INTERACTIONS)]
+    # After: it reruns only its fragment
+    after = [interact(app, action, i, fragment) for i in range(INTERACTIONS)]
+
+    assert {trace["name"] for trace in before} == {"app"}
+    assert {"read_archive", "filters", trace_name} <= {span["name"] for span in before[-1]["spans"]}
+    assert {trace["name"] for trace in after} == {trace_name}
+    assert not {"read_archive", "filters"} & {span["name"] for trace in after for span in trace["spans"]}
+    if fragment == "report_table":
+        assert app[0].caption[0].value.startswith("1000 report(s)")
+    assert statistics.median(t["seconds"] for t in after) < statistics.median(t["seconds"] for t in before)
@@ -0,0 +1,74 @@
+import hashlib
+import threading
+
+import numpy as np
+import pytest
+
+import helpers
+from conftest import make_pdf
+
+
+class FakeEmbedder:
+    """ Deterministic embeddings from the text hash; counts the texts it was asked for """
+
+    name = "fake"
+
+    def __init__(self):
+        self.texts = []
+
+    def __call__(self, texts: list) -> np.ndarray:
+        self.texts.extend(texts)
+        return np.vstack([
+            np.frombuffer(hashlib.sha256(text.encode()).digest(), dtype=np.uint8)[:8].astype(np.float32)
+            for text in texts
+        ])
+
+
+@pytest.fixture
+def reports(workdir, monkeypatch):
+    monkeypatch.setattr(helpers, "_embedding_indexes", helpers.collections.OrderedDict())
+    monkeypatch.setattr(helpers, "_bm25_indexes", helpers.collections.OrderedDict())
+    monkeypatch.setattr(helpers, "get_answer_cache", lambda cache=helpers.AnswerCache(): cache)
+    reports = []
+    for i, page_count in enumerate([3, 20, 5]):
+        path = workdir / f"report{i}.pdf"
+        path.write_bytes(make_pdf(page_count, padding=0, title=f"Report{i} page"))
+        reports.append({"document_id": f"d{i}", "source": str(path)})
+    return reports
+
+
+def test_ingest_stores_pages_and_reruns_skip_everything(reports):
+    embedder = FakeEmbedder()
+
+    stats = helpers.ingest_reports(reports, embedder=embedder, max_workers=2, update_counts=False)
+
+    assert stats["fetch"]["pages"] == stats["extract"]["pages"] == 28
+    assert stats["fetch"]["pages_per_second"] > 0
+    stored = helpers.load_document_embeddings("d1")
+    assert [page["page"] for page in stored.pages] == list(range(1, 21))
+    assert stored.pages[-1]["content"] == "Report1 page 20"
+    assert len(embedder.texts) == 28
+
+    embedder.texts.clear()
+    stats = helpers.ingest_reports(reports, embedder=embedder, max_workers=2, update_counts=False)
+
+    assert embedder.texts == []
+    assert stats["extract"]["pages"] == 0
+
+
+def test_extraction_tasks_of_all_reports_run_together(reports, monkeypatch):
+    # A barrier only one task per report can reach: passes only if the reports are extracted concurrently
+    barrier = threading.Barrier(len(reports), timeout=10)
+    extract = helpers._extract_page_texts
+
+    def extract_together(task):
+        if task[1] == 0:
+            barrier.wait()
+        return extract(task)
+
+    monkeypatch.setattr(helpers, "ProcessPoolExecutor", helpers.ThreadPoolExecutor)
+    monkeypatch.setattr(helpers, "_extract_page_texts", extract_together)
+
+    stats = helpers.ingest_reports(reports, embedder=FakeEmbedder(), max_workers=8, update_counts=False)
+
+    assert stats["extract"]["pages"] == 28
@@ -0,0 +1,127 @@
+import json
+import threading
+
+import pytest
+
+import helpers
+
+
+class FakeClient:
+    """ `table(...).insert(rows).execute()` into `rows`; raises while `failing` """
+
+    def __init__(self):
+        self.rows = []
+        self.failing = False
+        self._lock = threading.Lock()
+
+    def table(self, name):
+        return self
+
+    def insert(self, rows):
+        self._pending = list(rows)
+        return self
+
+    def execute(self):
+        with self._lock:
+            if self.failing:
+                raise ConnectionError("backend down")
+            self.rows.extend(self._pending)
+
+
+@pytest.fixture
+def spool_path(workdir):
+    return str(workdir / "data" / "log-spool.jsonl")
+
+
+def make_logger(client, spool_path):
+    return helpers.QueryLogger(client, batch_size=10, flush_seconds=0.05, spool_path=spool_path)
+
+
+def test_failed_batches_are_spooled_and_replayed(spool_path):
+    client = FakeClient()
+    client.failing = True
+    logger = make_logger(client, spool_path)
+
+    for i in range(5):
+        logger.log({"content": f"q{i}"})
+    logger.flush(timeout=5)
+    assert (logger.spooled, client.rows) == (5, [])
+
+    client.failing = False
+    logger.log({"content": "q5"})
+    logger.flush(timeout=5)
+
+    assert sorted(row["content"] for row in client.rows) == [f"q{i}" for i in range(6)]
+    assert (logger.flushed, logger.spooled) == (6, 0)
+    assert not helpers.os.path.exists(spool_path)
+
+
+def test_torn_spool_line_does_not_stop_the_logger(spool_path):
+    helpers.os.makedirs(helpers.os.path.dirname(spool_path))
+    with open(spool_path, "w") as f:
+        f.write(json.dumps({"content": "spooled"}) + "\n" + '{"content": "tor')
+    client = FakeClient()
+    logger = make_logger(client, spool_path)
+
+    logger.log({"content": "first"})
+    logger.flush(timeout=5)
+    logger.log({"content": "second"})
+    logger.flush(timeout=5)
+
+    assert logger._worker.is_alive()
+    assert sorted(row["content"] for row in client.rows) == ["first", "second", "spooled"]
+    with open(spool_path + ".bad") as f:
+        assert f.read() == '{"content": "tor\n'
+    assert not helpers.os.path.exists(spool_path + ".replay")
+
+
+def test_spooling_after_a_torn_line_starts_a_new_line(spool_path):
+    helpers.os.makedirs(helpers.os.path.dirname(spool_path))
+    with open(spool_path, "w") as f:
+        f.write('{"content": "tor')
+    client = FakeClient()
+    client.failing = True
+    logger = make_logger(client, spool_path)
+
+    logger.log({"content": "kept"})
+    logger.flush(timeout=5)
+    client.failing = False
+    logger.log({"content": "next"})
+    logger.flush(timeout=5)
+
+    assert sorted(row["content"] for row in client.rows) == ["kept", "next"]
+
+
+def test_stranded_replay_file_is_recovered_on_startup(spool_path):
+    helpers.os.makedirs(helpers.os.path.dirname(spool_path))
+    with open(spool_path + ".replay", "w") as f:
+        f.write(json.dumps({"content": "stranded"}) + "\n")
+    with open(spool_path, "w") as f:
+        f.write(json.dumps({"content": "spooled"}) + "\n")
+    client = FakeClient()
+    logger = make_logger(client, spool_path)
+
+    logger.log({"content": "new"})
+    logger.flush(timeout=5)
+
+    assert sorted(row["content"] for row in client.rows) == ["new", "spooled", "stranded"]
+    assert not helpers.os.path.exists(spool_path + ".replay")
+
+
+def test_stranded_replay_file_is_not_overwritten_by_a_later_replay(spool_path):
+    client = FakeClient()
+    logger = make_logger(client, spool_path)
+    logger.log({"content": "first"})
+    logger.flush(timeout=5)
+
+    # Left behind while running, e.g. by a replay interrupted by an error
+    helpers.os.makedirs(helpers.os.path.dirname(spool_path))
+    with open(spool_path + ".replay", "w") as f:
+        f.write(json.dumps({"content": "stranded"}) + "\n")
+    with open(spool_path, "w") as f:
+        f.write(json.dumps({"content": "spooled"}) + "\n")
+    logger.log({"content": "second"})
+    logger.flush(timeout=5)
+
+    assert sorted(row["content"] for row in client.rows) == ["first", "second", "spooled", "stranded"]
+    assert logger._replay_files() == []
@@ -0,0 +1,164 @@
+import http.server
+import io
+import re
+
+import pytest
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import ArrayObject, DictionaryObject, NameObject, NumberObject
+
+import helpers
+from conftest import make_pdf
+
+
+PAGE_COUNT = 200
+
+
+class PDFHandler(http.server.BaseHTTPRequestHandler):
+    """ Serves `body` at any path, answering Range requests if `ranges`, and logs the bytes sent """
+
+    body = b""
+    ranges = True
+    sent = []
+    replacement = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        handler = type(self)
+        body, etag = handler.body, '"v1"'
+        if handler.replacement is not None and handler.sent:
+            # Replaced after the first request
+            body, etag = handler.replacement, '"v2"'
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if self.headers.get("If-Range", etag) != etag:
+            match = None
+        if match and type(self).ranges:
+            start, end = int(match.group(1)), min(int(match.group(2)), len(body) - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+            body = body[start:end + 1]
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        type(self).sent.append(len(body))
+
+
+@pytest.fixture(scope="module")
+def pdf():
+    return make_pdf(PAGE_COUNT)
+
+
+@pytest.fixture
+def serve_pdf(workdir, serve, monkeypatch):
+    cache = helpers.PDFCache(str(workdir / "pdf-cache"))
+    monkeypatch.setattr(helpers, "get_pdf_cache", lambda: cache)
+    monkeypatch.setattr(helpers, "_pdf_slices", helpers.collections.OrderedDict())
+    monkeypatch.setattr(helpers, "_range_blocks", helpers.collections.OrderedDict())
+    monkeypatch.setattr(helpers, "_range_blocks_size", 0)
+
+    def start(body: bytes, ranges: bool = True, replacement: bytes = None):
+        handler = type("Handler", (PDFHandler,), {"body": body, "ranges": ranges, "sent": [], "replacement": replacement})
+        return f"{serve(handler)}/report.pdf", handler
+
+    return start
+
+
+def page_texts(pdf_slice: bytes) -> list:
+    return [page.extract_text() for page in PdfReader(io.BytesIO(pdf_slice)).pages]
+
+
+def test_ranged_slice_reads_a_small_part_of_the_file(pdf, serve_pdf):
+    url, handler = serve_pdf(pdf)
+
+    # Pages near either end of the flat page tree only resolve a few kids
+    pdf_slice, page_numbers = helpers.get_pdf_slice(url, [PAGE_COUNT - 2, 3])
+
+    assert page_numbers == {1: 3, 2: PAGE_COUNT - 2}
+    assert page_texts(pdf_slice) == ["Page 3", f"Page {PAGE_COUNT - 2}"]
+    assert len(handler.sent) <= 4
+    assert sum(handler.sent) <= 4 * helpers.PDF_RANGE_BLOCK_SIZE < len(pdf) / 3
+
+
+def test_ranged_reads_do_not_grow_with_the_page_number(pdf, serve_pdf):
+    url, handler = serve_pdf(pdf)
+    helpers.get_pdf_slice(url, [1])
+    first = sum(handler.sent)
+    handler.sent.clear()
+    helpers._range_blocks.clear()
+
+    helpers.get_pdf_slice(url, [PAGE_COUNT])
+
+    assert sum(handler.sent) <= first + helpers.PDF_RANGE_BLOCK_SIZE
+
+
+def test_server_without_ranges_downloads_the_file(pdf, serve_pdf):
+    url, handler = serve_pdf(pdf, ranges=False)
+
+    pdf_slice, _ = helpers.get_pdf_slice(url, [3, 100])
+
+    assert page_texts(pdf_slice) == ["Page 3", "Page 100"]
+    assert helpers.get_pdf_cache().urls.keys() == {url}
+
+
+def test_pdf_needing_lenient_parsing_is_downloaded(pdf, serve_pdf):
+    # A wrong startxref offset only parses leniently
+    broken = re.sub(rb"startxref\s+(\d+)", lambda m: b"startxref\n" + str(int(m.group(1)) + 7).encode(), pdf)
+    url, handler = serve_pdf(broken)
+
+    pdf_slice, _ = helpers.get_pdf_slice(url, [3, 100])
+
+    assert page_texts(pdf_slice) == ["Page 3", "Page 100"]
+    assert helpers.get_pdf_cache().urls.keys() == {url}
+
+
+def test_ranged_reads_beyond_the_budget_fall_back_to_a_download(pdf, serve_pdf):
+    url, handler = serve_pdf(pdf)
+    spread = list(range(1, PAGE_COUNT + 1, 4))
+
+    pdf_slice, _ = helpers.get_pdf_slice(url, spread)
+
+    assert page_texts(pdf_slice) == [f"Page {page}" for page in spread]
+    assert helpers.get_pdf_cache().urls.keys() == {url}
+    assert sum(handler.sent) <= len(pdf) * (1 + helpers.PDF_RANGE_MAX_FRACTION) + helpers.PDF_RANGE_BLOCK_SIZE
+
+
+def test_file_replaced_during_ranged_reads_is_not_stitched(pdf, serve_pdf):
+    # Same layout, so that blocks of both files would parse together
+    url, handler = serve_pdf(pdf, replacement=make_pdf(PAGE_COUNT, title="Pags"))
+
+    pdf_slice, _ = helpers.get_pdf_slice(url, [3, PAGE_COUNT - 2])
+
+    assert page_texts(pdf_slice) == ["Pags 3", f"Pags {PAGE_COUNT - 2}"]
+
+
+def nested_pdf() -> bytes:
+    """ Pages 1-3 under /Kids [empty /Pages, page 1, /Pages [page 2, page 3]] """
+    writer = PdfWriter(clone_from=io.BytesIO(make_pdf(3, padding=0)))
+    root = writer._root_object["/Pages"]
+    pages = list(root["/Kids"])
+
+    def pages_node(kids):
+        node = writer._add_object(DictionaryObject({
+            NameObject("/Type"): NameObject("/Pages"),
+            NameObject("/Kids"): ArrayObject(kids),
+            NameObject("/Count"): NumberObject(len(kids)),
+            NameObject("/Parent"): root.indirect_reference,
+        }))
+        for kid in kids:
+            kid.get_object()[NameObject("/Parent")] = node
+        return node
+
+    root[NameObject("/Kids")] = ArrayObject([pages_node([]), pages[0], pages_node(pages[1:])])
+    pdf = io.BytesIO()
+    writer.write(pdf)
+    return pdf.getvalue()
+
+
+def test_page_tree_with_an_empty_pages_node():
+    reader = PdfReader(io.BytesIO(nested_pdf()))
+
+    assert [helpers._read_page(reader, i).extract_text() for i in range(3)] == ["Page 1", "Page 2", "Page 3"]
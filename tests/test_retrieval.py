@@ -0,0 +1,57 @@
+import numpy as np
+
+import helpers
+
+
+def make_pages(n: int = 300, dimension: int = 64, seed: int = 0) -> tuple:
+    rng = np.random.default_rng(seed)
+    embeddings = rng.normal(size=(n, dimension)).astype(np.float32)
+    pages = [
+        {"page": i, "content": "lorem ipsum dolor sit amet " * 25 + f"page{i}", "embedding": embeddings[i].tolist()}
+        for i in range(n)
+    ]
+    return pages, embeddings, rng
+
+
+def test_dense_match_wins_without_lexical_match():
+    pages, embeddings, rng = make_pages()
+    prompt_embedding = embeddings[250] + 0.01 * rng.normal(size=embeddings.shape[1])
+    dense = [page["page"] for page in helpers.EmbeddingIndex(pages).search(prompt_embedding, top_k=3)]
+
+    found = helpers.get_most_similar_pages(
+        "Wie geht das Unternehmen mit Wohlbefinden um?", pages, top_pages=3, prompt_embedding=prompt_embedding,
+    )
+
+    assert dense[0] == 250
+    assert [page["page"] for page in found] == dense
+
+
+def test_short_pages_are_left_out_of_fusion():
+    pages, embeddings, rng = make_pages()
+    for page in pages[:5]:
+        page["content"] = "short"
+    prompt_embedding = embeddings[0] + 0.01 * rng.normal(size=embeddings.shape[1])
+
+    found = helpers.get_most_similar_pages("nothing matches this", pages, top_pages=3, prompt_embedding=prompt_embedding)
+
+    assert all(page["page"] >= 5 for page in found)
+    assert all(page["score"] > 0 for page in found)
+
+
+def test_tied_scores_share_a_rank():
+    fused = helpers.reciprocal_rank_fusion(np.zeros(4), np.array([0.1, 0.4, 0.3, 0.2]))
+
+    assert list(np.argsort(-fused)) == [1, 2, 3, 0]
+    assert np.allclose(
+        helpers.reciprocal_rank_fusion(np.array([2.0, 1.0, 1.0, 0.0])),
+        1 / (helpers.RRF_K + np.array([1, 2, 2, 4])),
+    )
+
+
+def test_masked_candidates_get_no_score():
+    fused = helpers.reciprocal_rank_fusion(
+        np.array([0.0, 3.0, 1.0]), np.array([0.1, 0.9, 0.5]), mask=np.array([True, False, True]),
+    )
+
+    assert fused[1] == 0
+    assert fused[2] > fused[0] > 0
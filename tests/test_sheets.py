@@ -0,0 +1,154 @@
+import hashlib
+import http.server
+import threading
+import time
+
+import pytest
+
+import helpers
+
+
+SHEETS = {
+    "archive": (
+        "title\n\n"
+        'company,isin,link,country,"SASB industry \n(SICS® Industries)",publication date,pages PDF,auditor,verified\n'
+        "A,I1,l1,DE,Banks,2024-01-02,10,KPMG,yes\n"
+        "B,I2,l2,FR,Oil,2024-01-01,20,EY,yes\n"
+        "C,I3,l3,FR,Oil,2024-01-01,20,EY,no\n"
+    ),
+    "industries": "SICS® Industries,SICS® Sector\nBanks,Financials\nOil,Energy\n",
+    "counts": "company,isin,pages,year,type,e1,e2,e3,e4,e5,s1,s2,s3,s4,g1\nA, I1,1,2024,SR,1,2,3,4,5,6,7,8,9,10\n",
+}
+DELAY_SECONDS = 0.3
+
+
+class SheetHandler(http.server.BaseHTTPRequestHandler):
+    """ Serves SHEETS with ETags; `honor_etag = False` ignores If-None-Match """
+
+    honor_etag = True
+    requests = []
+    active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        time.sleep(DELAY_SECONDS)
+        with cls.lock:
+            cls.active -= 1
+            cls.requests.append((self.path, self.headers.get("If-None-Match")))
+
+        body = SHEETS[self.path.strip("/")].encode()
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if cls.honor_etag and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def sheets(workdir, serve, monkeypatch):
+    handler = type("Handler", (SheetHandler,), {"requests": [], "active": 0, "max_active": 0, "lock": threading.Lock()})
+    base = serve(handler)
+    monkeypatch.setattr(helpers, "ARCHIVE_SHEET_URLS", {name: f"{base}/{name}" for name in SHEETS})
+    monkeypatch.setattr(helpers, "_sheets", {})
+    return handler
+
+
+def test_fetch_data_downloads_sheets_in_parallel(sheets):
+    started = time.perf_counter()
+    result = helpers.fetch_data()
+    elapsed = time.perf_counter() - started
+
+    assert sheets.max_active == len(SHEETS)
+    assert elapsed < 2 * DELAY_SECONDS
+    assert result["df"]["isin"].tolist() == ["I2", "I1"]
+    assert set(result["sheets"]) == set(SHEETS)
+
+
+def test_unchanged_sheets_reuse_previous_result_on_304(sheets):
+    first = helpers.fetch_data()
+    helpers.commit_sheet_states(first["sheets"])
+    frames = {name: state["frame"] for name, state in helpers._sheets.items()}
+
+    second = helpers.fetch_data(first)
+
+    assert second is first
+    assert all(etag is not None for _, etag in sheets.requests[len(SHEETS):])
+    assert all(helpers._sheets[name]["frame"] is frame for name, frame in frames.items())
+
+
+def test_byte_identical_sheet_is_not_parsed_again(sheets, monkeypatch):
+    sheets.honor_etag = False
+    first = helpers.fetch_data()
+    helpers.commit_sheet_states(first["sheets"])
+
+    parsed = []
+    monkeypatch.setitem(helpers.SHEET_PARSERS, "archive", lambda content: parsed.append(content))
+    state, changed = helpers.fetch_sheet("archive", helpers.ARCHIVE_SHEET_URLS["archive"], helpers._sheets["archive"])
+
+    assert not changed
+    assert parsed == []
+    assert state["frame"] is helpers._sheets["archive"]["frame"]
+    assert helpers.fetch_data(first) is first
+
+
+def test_sheet_states_persist_across_restarts(sheets, monkeypatch):
+    helpers.commit_sheet_states(helpers.fetch_data()["sheets"])
+    monkeypatch.setattr(helpers, "_sheets", {})
+
+    result = helpers.fetch_data()
+
+    assert all(etag is not None for _, etag in sheets.requests[len(SHEETS):])
+    assert result["sheets"] == {}
+    assert result["df"]["isin"].tolist() == ["I2", "I1"]
+
+
+def test_cold_start_publishes_even_if_the_snapshot_cannot_be_written(sheets, workdir, monkeypatch):
+    (workdir / "blocker").write_text("not a directory")
+    monkeypatch.setattr(helpers, "ARCHIVE_SNAPSHOT_PATH", str(workdir / "blocker" / "archive.parquet"))
+    monkeypatch.setattr(helpers, "_archive", {"current": None, "fetched_at": 0.0, "refreshing": False})
+
+    archive = helpers.read_archive()
+
+    assert archive["df"]["isin"].tolist() == ["I2", "I1"]
+    # Not committed: the sheets must not run ahead of the snapshot
+    assert helpers._sheets == {name: {} for name in SHEETS}
+
+
+def test_new_validators_of_unchanged_sheets_are_kept(sheets):
+    first = helpers.fetch_data()
+    helpers.commit_sheet_states(first["sheets"])
+    for name in SHEETS:
+        helpers._sheets[name] = {**helpers._sheets[name], "etag": '"stale"'}
+
+    assert helpers.fetch_data(first) is first
+    assert all(state["etag"] != '"stale"' for state in helpers._sheets.values())
+
+    # The next request is conditional again and answered with 304
+    sheets.requests.clear()
+    assert helpers.fetch_data(first) is first
+    assert all(etag not in (None, '"stale"') for _, etag in sheets.requests)
+
+
+def test_missing_archive_sheet_state_rebuilds_the_archive(sheets, monkeypatch):
+    first = helpers.fetch_data()
+    helpers.commit_sheet_states(first["sheets"])
+    (helpers.pathlib.Path(helpers.ARCHIVE_SHEETS_DIR) / "archive.parquet").unlink()
+    monkeypatch.setattr(helpers, "_sheets", {})
+
+    result = helpers.fetch_data(first)
+
+    assert result is not first
+    assert result["df"]["isin"].tolist() == ["I2", "I1"]
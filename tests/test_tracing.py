@@ -0,0 +1,36 @@
+import helpers
+from test_answers import FakeOpenAI
+
+
+def test_finished_traces_are_recorded_without_printing(capsys):
+    tracer = helpers.Tracer()
+
+    with tracer.span("app"):
+        with tracer.span("filters"):
+            pass
+
+    assert capsys.readouterr().out == ""
+    [trace] = tracer.history
+    assert [(span["name"], span["depth"]) for span in trace["spans"]] == [("filters", 1), ("app", 0)]
+
+
+def test_streamed_answer_is_timed_without_holding_a_span(monkeypatch, workdir):
+    tracer = helpers.Tracer()
+    monkeypatch.setattr(helpers, "tracer", tracer)
+    monkeypatch.setattr(helpers, "get_answer_cache", lambda cache=helpers.AnswerCache(): cache)
+    client = FakeOpenAI(["The ", "answer."])
+    for _ in client.words:
+        client.release.release()
+
+    with tracer.span("answer"):
+        answer = helpers.summarize_text_cached(client, "d1", "prompt", [{"id": 1, "content": "page"}])
+    # Read partway while rendering, then dropped
+    with tracer.span("render"):
+        assert next(answer) == "The "
+        with tracer.span("pdf"):
+            pass
+    answer.close()
+
+    assert [[span["name"] for span in trace["spans"]] for trace in tracer.history] == [["gpt", "answer"], ["pdf", "render"]]
+    assert tracer.current() is None
+    assert tracer.span_calls["gpt.stream"] == 1